@@ -269,12 +269,12 @@ def getCacheReadCmd(U, fLog, sLocalId, dSrc, dForm):
 		# 4. The begin index point
 		# 5. The end index point (exclusive upper bound)
 		# 6. The requested resolution		
-		uCmd = u"%s %s %s %s '%s' '%s' %.5e"%(
-		         dSrc['_cache_reader'], dsdf.sPath, sCacheDir, sNormParams,
-					sBeg, sEnd, rRes
-		       )
+		pipe = U.pipeline.Pipeline(
+			dSrc['_cache_reader'], dsdf.sPath, sCacheDir, sNormParams,
+			sBeg, sEnd, "%.5e"%rRes
+		)
 	 
-	return uCmd
+	return pipe
 	
 
 ##############################################################################
@@ -372,24 +372,24 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 		# Only other status out of auth is AUTH_SUCCESS, which means we proceed
 	
 	# Try for a cache read if you can get it
-	uCmd = _getCacheReadCmd(U, fLog, sLocalId, dSrc, dForm)
+	pipe = _getCacheReadCmd(U, fLog, sLocalId, dSrc, dForm)
 	
 	# Well, we have a cache miss, produce reduced data the old fashioned way...
-	if uCmd == None:
+	if pipe == None:
 	
 		# The command building functions always return a string, unless there is an
 		# error in which case they return None
 		uRdrCmd = _buildReaderCmd(U, fLog, sLocalId, dSrc, dForm)
 		if uRdrCmd == None or len(uRdrCmd) == 0:
 			return 17
-		uCmd = uRdrCmd
+		pipe = U.pipeline.Pipeline(uRdrCmd)
 	
 		uReduceCmd = _buildReducerCmd(U, fLog, sLocalId, dSrc, dForm)
 		if uReduceCmd == None:
 			return 17
 	
 		if len(uReduceCmd) > 0:
-			uCmd += "| %s"%uReduceCmd
+			pipe.add(uReduceCmd)
 				
 	# Output transformation...
 	uTransCmd = _buildTransCmd(U, fLog, sLocalId, dSrc, dForm)
@@ -397,26 +397,30 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 		return 17
 		
 	if len(uTransCmd) > 0:
-		uCmd += "| %s"%uTransCmd
+		pipe.add(uTransCmd)
 		
 	# Content disposition
 	sMime = _getOutputMime(dSrc, dForm)
 	sOutFile = _getOutputFile(sLocalId, dForm, sMime)
 	
 	fLog.write(u"   Exec Host: %s"%platform.node())
-	fLog.write(u"   Exec Cmd: %s"%uCmd)
+	fLog.write(u"   Exec Cmd: %s"%pipe)
 	fLog.write(u"   Filename: %s"%sOutFile) 
 	
 	# Run it
+	pipe.setLimits(*dsdf.getLimits(dConf))
 	(nRet, sStdErr, bHdrSent) = U.command.sendCmdOutput(
-		fLog, uCmd, sMimeType, sContentDis, sOutFile)
+		fLog, pipe, sMimeType, sContentDis, sOutFile)
 
 	if nRet != 0:
-		U.webio.serverError(
-			fLog, 
-			u"exec: %s\n%s\nNon-zero exit value, %d from pipeline"%(uCmd, sStdErr, nRet ), 
-			bHdrSent
-		)
+		if pipe.sLimit:
+			U.webio.limitError(fLog, u"Request stopped, %s"%pipe.sLimit, bHdrSent)
+		else:
+			U.webio.serverError(
+				fLog, 
+				u"exec: %s\n%s\n%s"%(pipe, sStdErr, pipe.report()), 
+				bHdrSent
+			)
 	
 	return nRet
 		
@@ -27,6 +27,46 @@ def pout(sOut):
 def getVal(form, sKey, sDefault):
 	# form.getfirst does url decoding, no need to wrap the call below in urlDec
 	return form.getfirst(sKey, sDefault)
+
+##############################################################################
+def _readerPipe(U, dsdf, sInterval, sRes, lParams, sBeg, sEnd):
+	"""Make the reader | reducer pipeline for a time range"""
+	
+	# The Reader...
+	if sInterval != '':
+		pipe = U.pipeline.Pipeline(dsdf[u'reader'], sInterval, sBeg, sEnd, *lParams)
+	else:
+		pipe = U.pipeline.Pipeline(dsdf[u'reader'], sBeg, sEnd, *lParams)
+	
+	# The Reducer...
+	if sRes != '':		
+		if dsdf[u'reducer'] not in [u'not_reducible', u'not_reducable', u'pre_reduced']:	
+			pipe.add(dsdf[u'reducer'], sRes)
+	
+	return pipe
+
+##############################################################################
+def _sendCached(U, fLog, rdr, sMimeType, sContentDis, sOutFile):
+	"""Answer a cache hit with the in-process cache reader"""
+	
+	fLog.write(u"   Exec: in-process cache read")
+	try:
+		nSent = rdr.send(
+			lambda: U.command.sendHdrs(sMimeType, sContentDis, sOutFile)
+		)
+	except U.errors.DasError as e:
+		if rdr.sLimit:
+			U.webio.limitError(fLog, u"Request stopped, %s"%rdr.sLimit, rdr.bHdrSent)
+		else:
+			U.webio.dasErr2HttpMsg(fLog, e, rdr.bHdrSent)
+		return 17
+	except (IOError, OSError) as e:
+		fLog.write("Client went away after %d bytes, %s"%(rdr.nSent, e))
+		U.webio.clientGone()
+		return 0
+	
+	fLog.write("Finished Read, %d bytes sent from %d cache blocks"%(nSent, rdr.nBlocks))
+	return 0
 	
 
 ##############################################################################
@@ -110,6 +150,7 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 			return U.dsdf.handleRedirect(fLog, sDsdf, dsdf)
 		
 		dsdf.fillDefaults(dConf)
+		tLimits = dsdf.getLimits(dConf)
 		
 		(_sBeg, _sEnd) = dsdf.trimToValidRange(fLog, sBeg, sEnd)
 		
@@ -157,8 +198,32 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	else:
 		sOutFmt = 'qds'
 	
+	bAscii = U.misc.isTrue(getVal(form, 'ascii', ''))
+	
+	# Reader parameters are split into words, same as the shell did
+	try:
+		lParams = U.pipeline.split(sParams)
+	except ValueError as e:
+		U.webio.queryError(fLog, u"Invalid params value '%s', %s"%(sParams, e))
+		return 17
+	
+	# Ranges that a reader recently found empty are answered right away
+	try:
+		bKnownEmpty = U.nodata.isEmpty(dConf, dsdf.sName, sNormParams, sBeg, sEnd)
+	except U.errors.DasError as e:
+		U.webio.dasErr2HttpMsg(fLog, e)
+		return 17
+	
+	if bKnownEmpty:
+		fLog.write("   No data cache: %s to %s is known to be empty"%(sBeg, sEnd))
+		U.webio.dasExcept("NoDataInInterval", u"No data in the range %s to %s"%(
+		                  sBeg, sEnd), fLog, False)
+		return 0
+	
 	# Try for a Cache Read if you can get it
 	bCacheMiss = True
+	rdr = None
+	lBuild = []
 	if U.cache.isCacheable(dsdf, sNormParams, rRes):
 		
 		fLog.write("   Cache check: Need resolution '%s' or better with paramset '%s'"%(
@@ -169,40 +234,73 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 		if lMissing != None and len(lMissing) > 0:
 			for t in lMissing:
 				fLog.write("Missing: %s"%str(t))
-				
-			fLog.write("   Cache miss: Submitting build task for %d "%len(lMissing)+\
-			           "cacheLevel_%02d blocks."%lMissing[0][2])
-			U.cache.reqCacheBuild(fLog, dConf, sDsdf, lMissing)
+			
+			# If the stream can be read in-process, send any blocks on disk
+			# and run the reader only for the gaps.  With write-through the
+			# gaps are read at the cache resolution and saved as they go by.
+			if U.cacherdr.canRead(dConf, dsdf):
+				rdr = U.cacherdr.CacheReader(
+					fLog, dConf, dsdf, sNormParams, rRes, sBeg, sEnd
+				)
+				nBlocks = len(rdr.blocks())
+				if U.misc.isTrue('CACHE_WRITE_THROUGH', dConf):
+					fLog.write("   Cache miss: Writing through %d of %d blocks"%(
+					           len(lMissing), nBlocks))
+					rdr.setGaps(lMissing,
+						lambda sGapBeg, sGapEnd: U.cache.blockPipe(
+							dsdf, rdr.nLevel, sGapBeg, sGapEnd
+						).setLimits(*tLimits),
+						True
+					)
+				elif len(lMissing) < nBlocks:
+					fLog.write("   Partial cache hit: %d of %d blocks on disk"%(
+					           nBlocks - len(lMissing), nBlocks))
+					rdr.setGaps(lMissing,
+						lambda sGapBeg, sGapEnd: _readerPipe(
+							U, dsdf, sInterval, sRes, lParams, sGapBeg, sGapEnd
+						).setLimits(*tLimits)
+					)
+				else:
+					rdr = None
+			
+			if rdr != None:
+				bCacheMiss = False
+				pipe = U.pipeline.Pipeline()
+			else:
+				lBuild = U.nodata.dropKnown(fLog, dConf, dsdf.sName, sNormParams, lMissing)
 		else:
 			bCacheMiss = False
 			sCacheDir =  pjoin(dConf['CACHE_ROOT'], 'data', sDsdf)
 			fLog.write("   Cache hit: Reading data from %s"%sCacheDir)
 			
-			# Cache readers are expected to take the following arguments:
-			# 0. The program name (of course)
-			# 1. The DSDF file path
-			# 2. The dataset cache root (= Cache_ROOT + dsdf_rel_path)
-			# 3. The normalized parameter string
-			# 4. The begin index point
-			# 5. The end index point (exclusive upper bound)
-			# 6. The requested resolution		
-			uCmd = u"%s %s %s %s '%s' '%s' %.5e"%(
-			         dsdf[u'cacheReader'], dsdf.sPath, sCacheDir, sNormParams,
-						sBeg, sEnd, rRes
-			       )
+			# Plain das2 streams are read in-process, any converters are fed
+			# from the reader.
+			if U.cacherdr.canRead(dConf, dsdf):
+				rdr = U.cacherdr.CacheReader(
+					fLog, dConf, dsdf, sNormParams, rRes, sBeg, sEnd
+				)
+				pipe = U.pipeline.Pipeline()
+			else:
+				U.cache.touchBlocks(fLog, dConf, dsdf, sNormParams,
+					U.cache.getUseLevel(dsdf, sNormParams, rRes), sBeg, sEnd
+				)
+			
+				# Cache readers are expected to take the following arguments:
+				# 0. The program name (of course)
+				# 1. The DSDF file path
+				# 2. The dataset cache root (= Cache_ROOT + dsdf_rel_path)
+				# 3. The normalized parameter string
+				# 4. The begin index point
+				# 5. The end index point (exclusive upper bound)
+				# 6. The requested resolution		
+				pipe = U.pipeline.Pipeline(
+					dsdf[u'cacheReader'], dsdf.sPath, sCacheDir, sNormParams,
+					sBeg, sEnd, "%.5e"%rRes
+				)
 		
 	# Well, we have a cache miss, produce reduced data the old fashioned way...
 	if bCacheMiss:
-		# The Reader...
-		if sInterval != '':
-			uCmd = u"%s '%s' '%s' '%s' %s"%(dsdf[u'reader'], sInterval, sBeg, sEnd, sParams)
-		else:
-			uCmd = u"%s '%s' '%s' %s"%(dsdf[u'reader'], sBeg, sEnd, sParams)
-		
-		# The Reducer...
-		if sRes != '':		
-			if dsdf[u'reducer'] not in [u'not_reducible', u'not_reducable', u'pre_reduced']:	
-				uCmd += u"| %s '%s'"%(dsdf[u'reducer'], sRes)				
+		pipe = _readerPipe(U, dsdf, sInterval, sRes, lParams, sBeg, sEnd)
 	
 		if sInterval == '':
 			# The reader requires an interval setting but none was provided
@@ -213,21 +311,19 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 		
 		
 	# Converting to ascii
-	sAscii = getVal(form, 'ascii', '')
-	if U.misc.isTrue(sAscii):
+	if bAscii:
 		sOutCat = 'text'
 			
 		if dsdf[ u'qstream'] and 'QDS_TO_UTF8' in dConf:
-			uCmd += u'| %s '%(dConf['QDS_TO_UTF8'])
+			pipe.add(dConf['QDS_TO_UTF8'])
 				
 		elif dsdf[u'das2Stream'] and 'D2S_TO_UTF8' in dConf:
-			uCmd += u'| %s '%(dConf['D2S_TO_UTF8'])
+			pipe.add(dConf['D2S_TO_UTF8'])
 	else:
 		sOutCat = 'bin'
 		
 	
 	fLog.write(u"   Exec Host: %s"%platform.node())
-	fLog.write(u"   Exec Cmd: %s"%uCmd)
 		
 	(sMimeType, sContentDis, sFileExt) = U.webio.getOutputMime(sOutCat, sOutFmt)
 		
@@ -239,16 +335,103 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 									  sFnBeg, sFnEnd, sFileExt)
 	fLog.write(u"   Filename: %s"%sOutFile)
 	
-	(nRet, sStdErr, bHdrSent) = U.command.sendCmdOutput(
-		fLog, uCmd, sMimeType, sContentDis, sOutFile)
+	# Responses made only from cache blocks carry validators, and may have
+	# been saved whole, so repeats can be answered without reading blocks
+	lKey = [sDsdf, sBeg, sEnd, "%.5e"%rRes, sNormParams, sOutCat, "%s"%pipe,
+	        sMimeType, sContentDis, sOutFile]
+	resp = None
+	if (rdr != None) and (len(rdr.setMissing) == 0):
+		try:
+			resp = U.respcache.Response(fLog, dConf, rdr, lKey)
+		except U.errors.DasError as e:
+			U.webio.dasErr2HttpMsg(fLog, e)
+			return 17
+		if resp.answer():
+			return 0
+		resp.record()
+	
+	# Spool locks, response copies and output captures must not outlive the
+	# request in persistent servers, even if a handler error escapes
+	flight = None
+	sniffer = None
+	try:
+		# Identical requests that arrive while a reader is running for this one
+		# get a copy of its output instead of running their own
+		if bCacheMiss or ((rdr != None) and (len(rdr.setMissing) > 0)):
+			flight = U.spool.Flight(fLog, dConf, lKey)
+			if flight.follow():
+				return 0
+	
+		if (rdr != None) and (len(pipe) == 0):
+			nRet = _sendCached(U, fLog, rdr, sMimeType, sContentDis, sOutFile)
+		else:
+			if rdr != None:
+				rdr.feed(pipe)
+			fLog.write(u"   Exec Cmd: %s"%pipe)
+		
+			# Learn if the reader found anything, so empty ranges needn't be
+			# read again
+			if bCacheMiss and (sOutCat == 'bin') and dsdf[u'das2Stream'] and \
+			   U.nodata.isEnabled(dConf):
+				sniffer = U.nodata.Sniffer()
+				U.webio.capture(sniffer)
+		
+			pipe.setLimits(*tLimits)
+			(nRet, sStdErr, bHdrSent) = U.command.sendCmdOutput(
+				fLog, pipe, sMimeType, sContentDis, sOutFile)
+			if rdr != None:
+				rdr.wait()
+		
+			if sniffer != None:
+				U.webio.endCapture(sniffer)
+				if (nRet == 0) and (not U.webio.g_bClientGone) and sniffer.isEmpty():
+					U.nodata.record(fLog, dConf, dsdf.sName, sNormParams, sBeg, sEnd)
 
-	if nRet != 0:
-		U.webio.serverError(
-			fLog, 
-			u"exec: %s\n%s\nNon-zero exit value, %d from pipeline"%(uCmd, sStdErr, nRet ), 
-			bHdrSent
-		)
+			if nRet != 0:
+				if pipe.sLimit:
+					U.webio.limitError(fLog, u"Request stopped, %s"%pipe.sLimit, bHdrSent)
+				else:
+					U.webio.serverError(
+						fLog, 
+						u"exec: %s\n%s\n%s"%(pipe, sStdErr, pipe.report()), 
+						bHdrSent
+					)
+
+			fLog.write(sStdErr)
+	
+		if resp != None:
+			resp.finish(nRet == 0)
+	
+		if flight != None:
+			flight.finish(not U.webio.g_bClientGone)
+	finally:
+		if sniffer != None:
+			U.webio.endCapture(sniffer)
+		if resp != None:
+			resp.finish(False)
+		if flight != None:
+			flight.finish(False)
+	
+	if len(lBuild) > 0:
+		fLog.write("   Cache miss: Submitting build task for %d "%len(lBuild)+\
+		           "cacheLevel_%02d blocks."%lBuild[0][2])
+		U.cache.reqCacheBuild(fLog, dConf, sDsdf, lBuild)
+	
+	if rdr != None:
+		# Anything that wasn't saved on the way by is built later
+		if len(rdr.setMissing) > 0:
+			lLeft = U.nodata.dropKnown(
+				fLog, dConf, dsdf.sName, sNormParams, rdr.unwritten(lMissing)
+			)
+			if len(lLeft) > 0:
+				fLog.write("   Cache miss: Submitting build task for %d "%len(lLeft)+\
+				           "cacheLevel_%02d blocks."%lLeft[0][2])
+				U.cache.reqCacheBuild(fLog, dConf, sDsdf, lLeft)
 
-	fLog.write(sStdErr)
+		# Blocks saved on the way by count against the cache budget too
+		if len(rdr.lWritten) > 0 and U.evict.isEnabled(dConf, dsdf):
+			U.cache.reqEvict(fLog, dConf,
+				None if U.evict.maxBytes(dConf) != None else sDsdf
+			)
 	
 	return nRet
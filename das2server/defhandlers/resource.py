@@ -1,6 +1,5 @@
 """Default Handler for the resource file interface"""
 
-import sys
 import os.path
 import mimetypes
 
@@ -46,11 +45,7 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 		
 		U.webio.pout("Content-Type: %s\r\n\r\n"%sType)
 		
-	fIn = open(sFile, 'rb')
-	if sys.version_info[0] == 2:
-		sys.stdout.write(fIn.read())
-	else:
-		sys.stdout.buffer.write(fIn.read())
+	U.webio.sendFile(sFile)
 	
 	return 0
 
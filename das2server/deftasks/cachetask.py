@@ -3,7 +3,6 @@
 import os
 import os.path
 from os.path import join as pjoin
-import subprocess
 
 from das2.dastime import DasTime
 
@@ -11,8 +10,20 @@ import das2server.util.dsdf as D
 import das2server.util.task as T
 import das2server.util.errors as E
 import das2server.util.cache as C	
+import das2server.util.evict as EV
+import das2server.util.manifest as MF
+import das2server.util.cacherdr as CR
 
-import sys
+import threading
+import signal
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+# Seconds to wait for stopped block pipelines before killing them
+CANCEL_WAIT_SEC = 10
 
 ##############################################################################
 
@@ -34,7 +45,7 @@ class Task(T.TaskHandler):
 		# New variables
 		self.dsdf   = None    # The DSDF object that goes with the datasource
 		self.lLevels = None   # The cache levels to create
-		self.proc    = None   # The current sub-shell process
+		self.lRunning = []    # The blocks being written, see Block
 		self.bShutdown = False # A flag to indicate that processing should be
 		                       # cut off
 		
@@ -70,7 +81,9 @@ class Task(T.TaskHandler):
 		# Get the cache levels to be created
 		sLvlTmp = self.lTask[C.CACHE_FIELDS.LEVEL]
 		if sLvlTmp.lower() == 'all':
-			self.lLevels = self.dsdf['cacheLevel'].keys()
+			# Finest first, so coarse levels can be built from finer ones
+			self.lLevels = sorted(self.dsdf['cacheLevel'].keys(), 
+			                      key=lambda n: C.levelRes(self.dsdf, n))
 		else:
 			nLevel = int(sLvlTmp, 10)
 			if nLevel not in self.dsdf['cacheLevel']:
@@ -101,8 +114,8 @@ class Task(T.TaskHandler):
 	###########################################################################
 	def shutdown(self, signum):
 		self.bShutdown = True
-		if self.proc != None:
-			self.proc.send_signal(signum)
+		for blk in list(self.lRunning):
+			blk.kill(signum)
 
 
 	###########################################################################
@@ -124,144 +137,298 @@ class Task(T.TaskHandler):
 				
 		return nBlks		
 	
+	###########################################################################
+	def _levelBlks(self, nLevel):
+		"""Get the (begin, end) DasTimes of each block in a cache level"""
+		lBlks = []
+		dtBeg = self.dBounds[nLevel][0].copy()
+		tAdj = self.dBounds[nLevel][1]
+		dtEnd = self.dBounds[nLevel][2]
+		while dtBeg < dtEnd:
+			dtBlkEnd = dtBeg.copy()
+			dtBlkEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+			lBlks.append( (dtBeg, dtBlkEnd) )
+			dtBeg = dtBlkEnd
+		return lBlks
+	
+	###########################################################################
+	def _start(self, fLog, nLevel, dtBegBlk, dtEndBlk):
+		"""Set up the pipeline that writes one block.  Returns a Block
+		object, which the caller runs and then passes to _finish()."""
+		
+		(nRes, sUnits, sPeriod, sParams) = self.dsdf['cacheLevel'][nLevel]
+		sNormParams = D.normalizeParams(sParams)
+		sCompress = CR.compression(self.dConf, self.dsdf, nLevel)
+		bPacked = C.isPacked(self.dConf, self.dsdf, nLevel)
+		
+		(sDir, sFile) = C.getBlockPath(self.dConf, self.dsdf, sNormParams,
+		                               nLevel, dtBegBlk, sCompress=sCompress)
+		
+		# Get the output file name, based of the storage scheme, and 
+		# shorten up the times to make the logs easier to read.
+		sBeg = str(dtBegBlk)[:10]
+		sEnd = str(dtEndBlk)[:10]
+
+		if sPeriod == 'hourly' or sPeriod == 'perminute':
+			sBeg = str(dtBegBlk)[:16]
+			sEnd = str(dtEndBlk)[:16]
+
+		if sPeriod == 'persecond':
+			sBeg = str(dtBegBlk)[:19]
+			sEnd = str(dtEndBlk)[:19]
+		
+		sOutFile = pjoin(sDir, sFile)
+		sOutTmp = sOutFile + ".tmp"
+		
+		# Short blocks are written next to their container and then
+		# moved into it
+		if bPacked:
+			(sDir, sPack, iSlot, nSlots) = C.getPackPath(
+				self.dConf, self.dsdf, sNormParams, nLevel, dtBegBlk
+			)
+			sOutTmp = "%s.%d.tmp"%(pjoin(sDir, sPack), iSlot)
+		
+		if not os.path.isdir(sDir):
+			os.makedirs(sDir)
+		
+		# Re-bin from a finer level if one is complete for this block,
+		# that's much cheaper than reading the original files again
+		nFrom = C.sourceLevel(fLog, self.dConf, self.dsdf, nLevel, sBeg, sEnd)
+		rdr = None
+		if nFrom != None:
+			fLog.write("   Deriving from cacheLevel_%02d"%nFrom)
+			
+			# Finer blocks may be compressed, read them in-process if
+			# possible
+			if CR.canRead(self.dConf, self.dsdf):
+				rdr = CR.CacheReader(fLog, self.dConf, self.dsdf, sNormParams,
+				                     C.levelRes(self.dsdf, nFrom), sBeg, sEnd)
+		pipe = C.blockPipe(self.dsdf, nLevel, sBeg, sEnd, self.dConf, nFrom,
+		                   rdr != None)
+		if sCompress != None:
+			pipe.add(*C.compressCmd(sCompress))
+		pipe.setOutput(sOutTmp)
+		pipe.setLimits(*self.dsdf.getLimits(self.dConf))
+		
+		fLog.write("   Exec: %s"%pipe)
+		
+		blk = Block(nLevel, sNormParams, dtBegBlk, dtEndBlk, sFile, sOutFile,
+		            sOutTmp, bPacked, pipe, rdr)
+		return blk
+	
+	###########################################################################
+	def _finish(self, fLog, blk):
+		"""Move a finished block into place.  Returns the block's return code"""
+		
+		# Yet another python3 problem... just treat everything like bytes
+		# (UNIX got this right).  Worring about decoding is VAX IO problems
+		# all over again because someone can't learn from history.
+		# Thank's python3 for breaking this code...
+		fLog.write(blk.pipe.errBytes())
+		nRet = blk.nRet
+		sOutTmp = blk.sOutTmp
+		
+		# If we get a non-zero return, nuke the temp file, otherwise
+		# move the tmp file to the permanent location
+		if nRet != 0: 
+			fLog.write(blk.pipe.report())
+			if os.path.isfile(sOutTmp):
+				fLog.write("Error detected in run, cleaning output: %s"%sOutTmp)
+				try:
+					os.remove(sOutTmp)
+				except IOError as e:
+					fLog.write("File '%s' could not be removed!"%sOutTmp)
+					pass
+		else:
+			if os.path.isfile(sOutTmp):
+				tSum = MF.checksum(sOutTmp)
+				if blk.bPacked:
+					C.storePacked(self.dConf, self.dsdf, blk.sNormParams, blk.nLevel,
+					              blk.dtBeg, sOutTmp)
+				else:
+					os.rename(sOutTmp, blk.sOutFile)
+					C.dropVariants(blk.sOutFile)
+					CR.writeTimeIndex(blk.sOutFile)
+				C.indexBlock(fLog, self.dConf, self.dsdf, blk.sNormParams, blk.nLevel,
+				             blk.dtBeg, blk.dtEnd, self.dBounds[blk.nLevel][1], tSum)
+			else:
+				fLog.write("Error detected, expected output file missing!")
+				nRet = 5
+		
+		return nRet
+	
+	###########################################################################
+	def _abandon(self, fLog, qDone):
+		"""Wait for the pipelines stopped by shutdown() to exit and remove
+		the partial output of their blocks"""
+		for i in range(CANCEL_WAIT_SEC):
+			for blk in [b for b in self.lRunning
+			            if (b.thread == None) or (not b.thread.is_alive())]:
+				self.lRunning.remove(blk)
+				blk.removeTmp(fLog)
+			if len(self.lRunning) == 0:
+				break
+			try:
+				qDone.get(True, 1.0)
+			except queue.Empty:
+				pass
+		
+		# Anything still going ignored SIGTERM
+		for blk in self.lRunning:
+			blk.kill(signal.SIGKILL)
+			blk.removeTmp(fLog)
+		self.lRunning = []
+	
 	###########################################################################
 	def run(self, fLog):
-		"""Loop over all cache levels and all block periods making cache files
+		"""Loop over all cache levels and all block periods making cache files.
+		Up to CACHE_BUILD_JOBS blocks of a level are written at once, each by
+		it's own pipeline.  Levels are done one after another so that coarse
+		levels can be derived from the finer ones just written.
 		"""
-				
-		sReader = self.dsdf[u'reader']		
-		sReducer = self.dsdf[u'reducer']  # Check in init make sure this is
-		                                  # not None for non-intrinsic a cache
 		
+		nJobs = C.buildJobs(self.dConf)
 		nTotalBlks = self._totalBlks()
 		nDoneBlks = 0
 		nSuccessBlks = 0
 		
 		# Assume that nothing get's processed, until at least one item succeedes
 		self.nRetCode = 13
-				
-		# Outer loop is cache levels since different levels may have different
-		# blocking periods.
-		for nLevel in self.lLevels:
 		
-			(nRes, sUnits, sPeriod, sParams) = self.dsdf['cacheLevel'][nLevel]
-			sNormParams = D.normalizeParams(sParams)
-			if sParams == None:
-				sParams = ''
+		if nJobs > 1:
+			fLog.write("   Writing up to %d blocks at a time"%nJobs)
 		
-			dtBegBlk = self.dBounds[nLevel][0].copy()
-			tAdj = self.dBounds[nLevel][1]
-			
-			dtEnd = self.dBounds[nLevel][2]
-						
-			while dtBegBlk < dtEnd:
+		qDone = queue.Queue()
+				
+		try:
+			# Outer loop is cache levels since different levels may have different
+			# blocking periods.
+			for nLevel in self.lLevels:
 			
-				#sys.stderr.write("Beg Block: %s  End All: %s\n"%(dtBegBlk, dtEnd))
+				lTodo = self._levelBlks(nLevel)
+				lTodo.reverse()
 			
-				(sDir, sFile) = C.getBlockPath(self.dConf, self.dsdf, sNormParams,
-				                               nLevel, dtBegBlk)
-														 
-				# get the time range
-				dtEndBlk = dtBegBlk.copy()
-				dtEndBlk.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
-								
-				# Get the output file name, based of the storage scheme, and 
-				# shorten up the times to make the logs easier to read.
-				sBeg = str(dtBegBlk)[:10]
-				sEnd = str(dtEndBlk)[:10]
-
-				if sPeriod == 'hourly' or sPeriod == 'perminute':
-					sBeg = str(dtBegBlk)[:16]
-					sEnd = str(dtEndBlk)[:16]
-
-				if sPeriod == 'persecond':
-					sBeg = str(dtBegBlk)[:19]
-					sEnd = str(dtEndBlk)[:19]
-				
-				sOutFile = pjoin(sDir, sFile)
-				sOutTmp = sOutFile + ".tmp"
+				while (len(lTodo) > 0 or len(self.lRunning) > 0):
 				
-				if not os.path.isdir(sDir):
-					os.makedirs(sDir)
-				
-				rRes = float(nRes)
-				if nRes == 0:
-					uCmd = u'%s %s %s %s > %s'%(sReader, sBeg, sEnd, sParams, sOutTmp)
-				else:
-					if sUnits.lower() in ('ms','millisec','millisecond','milliseconds'):
-						rRes /= 1000.0
-
-					uCmd = u'%s %s %s %s | %s -b %s %f > %s'%(sReader, sBeg, sEnd, 
-			   		     sParams, sReducer, sBeg, rRes, sOutTmp)
-				
-				fLog.write("   Exec: %s"%uCmd)
-				
-				rProg = float(nDoneBlks)/float(nTotalBlks)
-				self.setProgress(rProg, "Writing: %s"%sFile)
-				
-				# Yet another python3 problem... just treat everything like bytes
-				# (UNIX got this right).  Worring about decoding is VAX IO problems
-				# all over again because someone can't learn from history.
-				# Thank's python3 for breaking this code...
-				self.proc = subprocess.Popen(
-					uCmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-					stderr=subprocess.PIPE, close_fds=True
-				)
-				
-				(xStdOut, xStdErr) = self.proc.communicate()
-				fLog.write(xStdErr)
-				
-				# If we get a non-zero return, nuke the temp file, otherwise
-				# move the tmp file to the permanent location
-				if self.proc.returncode != 0: 
-					if os.path.isfile(sOutTmp):
-						fLog.write("Error detected in run, cleaning output: %s"%sOutTmp)
-						try:
-							os.remove(sOutTmp)
-						except IOError as e:
-							fLog.write("File '%s' could not be removed!"%sOutTmp)
-							pass
-				else:
-					if os.path.isfile(sOutTmp):
-						os.rename(sOutTmp, sOutFile)
-					else:
-						fLog.write("Error detected, expected output file missing!")
-						self.proc.returncode = 5
+					# Keep the pool full
+					while (len(lTodo) > 0) and (len(self.lRunning) < nJobs) and \
+					      (not self.bShutdown):
+						(dtBegBlk, dtEndBlk) = lTodo.pop()
+						blk = self._start(fLog, nLevel, dtBegBlk, dtEndBlk)
+						self.lRunning.append(blk)
+						blk.start(qDone)
+					
+						rProg = float(nDoneBlks)/float(nTotalBlks)
+						self.setProgress(rProg, "Writing: %s"%blk.sFile)
 				
-				# If anything succedded return a code of 0, otherwise 13
-				if self.proc.returncode == 0:
-					self.nRetCode = 0
-					nSuccessBlks += 1
+					if len(self.lRunning) == 0:
+						break   # Shutting down
 				
-				self.proc = None
+					# Wake up now and then, signals aren't delivered while waiting
+					# on a queue in python 2
+					try:
+						blk = qDone.get(True, 1.0)
+					except queue.Empty:
+						continue
+					nRet = self._finish(fLog, blk)
+					self.lRunning.remove(blk)
 				
-				dtBegBlk = dtEndBlk
-				nDoneBlks += 1
+					# If anything succedded return a code of 0, otherwise 13
+					if nRet == 0:
+						self.nRetCode = 0
+						nSuccessBlks += 1
 				
+					nDoneBlks += 1
+					if len(self.lRunning) > 0:
+						self.setProgress(float(nDoneBlks)/float(nTotalBlks), 
+							"Writing %d blocks, finished: %s"%(len(self.lRunning), blk.sFile)
+						)
+			
+				if self.bShutdown:
+					break
+		except E.CancelOp:
+			self._abandon(fLog, qDone)
+			raise
 		
 		self.sStatus = "Successfully processed %d of %d cache blocks"%(
 		               nSuccessBlks, nTotalBlks)
 		
+		# New blocks may have pushed the cache over budget
+		if nSuccessBlks > 0 and EV.isEnabled(self.dConf, self.dsdf):
+			C.reqEvict(fLog, self.dConf,
+				None if EV.maxBytes(self.dConf) != None else self.dsdf.sName
+			)
+		
 		return None
+
+
+##############################################################################
+
+class Block(object):
+	"""One cache block being written.  The pipeline is started from the
+	task's thread and waited on in a thread of it's own, the work is done by
+	the pipeline's processes so these don't compete for the interpreter.
+	"""
+	
+	def __init__(self, nLevel, sNormParams, dtBeg, dtEnd, sFile, sOutFile,
+	             sOutTmp, bPacked, pipe, rdr):
+		self.nLevel = nLevel
+		self.sNormParams = sNormParams
+		self.dtBeg = dtBeg
+		self.dtEnd = dtEnd
+		self.sFile = sFile
+		self.sOutFile = sOutFile
+		self.sOutTmp = sOutTmp
+		self.bPacked = bPacked
+		self.pipe = pipe
+		self.rdr = rdr
+		self.nRet = None
+		self.thread = None
+	
+	def start(self, qDone):
+		"""Start the pipeline, putting this object on qDone when it exits.
+		Processes are only started here, never from the waiting threads.
+		"""
+		try:
+			if self.rdr != None:
+				self.rdr.feed(self.pipe)
+			self.pipe.start()
+		except Exception as e:
+			fdIn = self.pipe.takeInput()
+			if fdIn != None:
+				os.close(fdIn)
+			if self.rdr != None:
+				self.rdr.wait()
+			if len(self.pipe.lStdErr) == 0:
+				self.pipe.lStdErr = [ [] ]
+			self.pipe.addErr(0, ("%s\n"%e).encode('utf-8'))
+			self.nRet = 5
+			qDone.put(self)
+			return
 		
+		self.thread = threading.Thread(target=self._run, args=(qDone,))
+		self.thread.daemon = True
+		self.thread.start()
 	
+	def _run(self, qDone):
+		try:
+			nRet = self.pipe.finish()
+			if (self.rdr != None) and (self.rdr.wait() != None) and (nRet == 0):
+				nRet = 5
+		except Exception as e:
+			self.pipe.addErr(0, ("%s\n"%e).encode('utf-8'))
+			nRet = 5
+		self.nRet = nRet
+		qDone.put(self)
 	
+	def kill(self, signum):
+		# The whole process group, readers may have children of their own
+		self.pipe.signal(signum)
 	
-		
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+	def removeTmp(self, fLog):
+		if os.path.isfile(self.sOutTmp):
+			fLog.write("Removing unfinished output: %s"%self.sOutTmp)
+			try:
+				os.remove(self.sOutTmp)
+			except OSError:
+				fLog.write("File '%s' could not be removed!"%self.sOutTmp)
@@ -0,0 +1,46 @@
+"""Cache eviction tasks"""
+
+import das2server.util.task as T
+import das2server.util.errors as E
+import das2server.util.evict as EV
+
+##############################################################################
+# Little Enum to help keep eviction job field numbers straight
+
+class EVICT_FIELDS(T.JOB_FIELDS):
+	DATASET = 7   # Optional, only apply this data source's quota
+
+	LEN_MIN = 7
+	LEN_MAX = 8
+
+##############################################################################
+
+class Task(T.TaskHandler):
+	"""Remove least recently used cache blocks until the cache is back under
+	it's budgets, see das2server.util.evict
+	"""
+
+	def __init__(self, dConf, broker, sQueue, iJobIdx, sTask, fLog):
+		T.TaskHandler.__init__(self, dConf, broker, sQueue, iJobIdx, sTask, fLog)
+
+		if len(self.lTask) < EVICT_FIELDS.LEN_MIN or \
+		   len(self.lTask) > EVICT_FIELDS.LEN_MAX:
+			raise E.QueryError("Expected %d or %d fields for cache eviction "%(
+			                   EVICT_FIELDS.LEN_MIN, EVICT_FIELDS.LEN_MAX)+\
+			                   "tasks, entry has %d."%len(self.lTask))
+
+		self.sDsdf = None
+		if len(self.lTask) > EVICT_FIELDS.DATASET:
+			if len(self.lTask[EVICT_FIELDS.DATASET].strip()) > 0:
+				self.sDsdf = self.lTask[EVICT_FIELDS.DATASET].strip()
+
+	def shutdown(self, signum):
+		pass
+
+	def run(self, fLog):
+		(nGone, nFreed, nBefore) = EV.evict(
+			fLog, self.dConf, self.sDsdf, fProgress=self.setProgress
+		)
+		self.nRetCode = 0
+		self.sStatus = "Removed %d cache blocks, %d of %d bytes freed"%(
+		               nGone, nFreed, nBefore)
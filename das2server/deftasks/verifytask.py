@@ -0,0 +1,213 @@
+"""Cache verification tasks"""
+
+import os
+import os.path
+from os.path import join as pjoin
+
+from das2.dastime import DasTime
+
+import das2server.util.task as T
+import das2server.util.errors as E
+import das2server.util.dsdf as D
+import das2server.util.cache as C
+import das2server.util.blkindex as BI
+import das2server.util.blkpack as PK
+import das2server.util.manifest as MF
+
+##############################################################################
+# Little Enum to help keep verification job field numbers straight
+
+class VERIFY_FIELDS(T.JOB_FIELDS):
+	DATASET = 7   # Optional, only check this data source's cache
+
+	LEN_MIN = 7
+	LEN_MAX = 8
+
+##############################################################################
+
+class Task(T.TaskHandler):
+	"""Check cache blocks against their manifests, see das2server.util.manifest.
+	Blocks whose checksum no longer matches, and blocks made by an older
+	reader, reducer or DSDF, are removed so that they are rebuilt the next
+	time they are needed.
+	"""
+
+	def __init__(self, dConf, broker, sQueue, iJobIdx, sTask, fLog):
+		T.TaskHandler.__init__(self, dConf, broker, sQueue, iJobIdx, sTask, fLog)
+
+		if len(self.lTask) < VERIFY_FIELDS.LEN_MIN or \
+		   len(self.lTask) > VERIFY_FIELDS.LEN_MAX:
+			raise E.QueryError("Expected %d or %d fields for cache verification "%(
+			                   VERIFY_FIELDS.LEN_MIN, VERIFY_FIELDS.LEN_MAX)+\
+			                   "tasks, entry has %d."%len(self.lTask))
+
+		self.sDsdf = None
+		if len(self.lTask) > VERIFY_FIELDS.DATASET:
+			if len(self.lTask[VERIFY_FIELDS.DATASET].strip()) > 0:
+				self.sDsdf = self.lTask[VERIFY_FIELDS.DATASET].strip().strip('/')
+
+		self.bShutdown = False
+
+	def shutdown(self, signum):
+		self.bShutdown = True
+
+	###########################################################################
+	def _levels(self):
+		"""Get (level_dir, dsdf_name) for each cache level with a manifest"""
+		sTop = pjoin(self.dConf['CACHE_ROOT'], 'data')
+		sStart = sTop
+		if self.sDsdf != None:
+			sStart = pjoin(sTop, self.sDsdf)
+
+		lOut = []
+		for (sDir, lDirs, lFiles) in os.walk(sStart):
+			sName = os.path.basename(sDir)
+			if (sName != 'intrinsic') and not sName.startswith('bin-'):
+				continue
+			lDirs[:] = []
+			if MF.MANIFEST_NAME not in lFiles:
+				continue
+
+			# CACHE_ROOT/data/DSDF/PARAMS/RES
+			sDsdf = os.path.relpath(os.path.dirname(os.path.dirname(sDir)), sTop)
+			lOut.append( (sDir, sDsdf) )
+
+		lOut.sort()
+		return lOut
+
+	def _findLevel(self, fLog, sLevelDir, sDsdf):
+		"""Get (dsdf, normalized params, level) for a level directory, or None
+		if it's data source no longer defines it"""
+		try:
+			dsdf = D.Dsdf(sDsdf, self.dConf, None, fLog)
+			dsdf.fillDefaults(self.dConf)
+		except (E.DasError, IOError, OSError) as e:
+			fLog.write("   Skipping %s, %s"%(sLevelDir, e))
+			return None
+
+		for nLevel in dsdf['cacheLevel']:
+			sNormParam = D.normalizeParams(dsdf['cacheLevel'][nLevel][3])
+			sDir = C.getLevelDir(self.dConf, dsdf, sNormParam, nLevel)
+			if os.path.normpath(sDir) == os.path.normpath(sLevelDir):
+				return (dsdf, sNormParam, nLevel)
+
+		fLog.write("   Skipping %s, not a cache level of %s"%(sLevelDir, sDsdf))
+		return None
+
+	def _stored(self, dsdf, sNormParam, nLevel, sPath, dtBeg):
+		"""Get the (size, CRC-32) of a block as stored"""
+		if sPath.endswith(PK.PACK_EXT):
+			iSlot = C.getPackPath(self.dConf, dsdf, sNormParam, nLevel, dtBeg)[2]
+			return MF.checksumData(b''.join(PK.read(sPath, iSlot, 1)))
+		return MF.checksum(sPath)
+
+	def _remove(self, fLog, sLevelDir, dsdf, sNormParam, nLevel, lBlocks):
+		"""Remove a list of (path, dtBeg, dtEnd) blocks"""
+		lFiles = []
+		dSlots = {}
+		for (sPath, dtBeg, dtEnd) in lBlocks:
+			if sPath.endswith(PK.PACK_EXT):
+				iSlot = C.getPackPath(self.dConf, dsdf, sNormParam, nLevel, dtBeg)[2]
+				dSlots.setdefault(sPath, []).append(
+					(iSlot, (BI.timeKey(dtBeg), BI.timeKey(dtEnd)))
+				)
+			else:
+				lFiles.append(sPath)
+
+		if len(lFiles) > 0:
+			BI.removeBlocks(sLevelDir, lFiles)
+		for sPath in dSlots:
+			BI.forget(sLevelDir, [t[1] for t in dSlots[sPath]])
+			PK.clear(sPath, [t[0] for t in dSlots[sPath]])
+
+	def _verify(self, fLog, sLevelDir, dsdf, sNormParam, nLevel):
+		"""Check one cache level, returns (checked, damaged, stale)"""
+		lGens = MF.read(sLevelDir)
+		dSums = MF.readSums(sLevelDir)
+		sDigest = MF.fingerprint(self.dConf, dsdf, nLevel)[0]
+		dPacks = {}
+
+		# Blocks from an older configuration
+		lStale = []
+		for (sBeg, sEnd) in MF.stale(lGens or [], sDigest, '', '~'):
+			(dtBlk, tAdj, dtEnd) = C.snapToTimeBlks(fLog, dsdf, sBeg, sEnd, nLevel)
+			while dtBlk < dtEnd:
+				dtBlkEnd = dtBlk.copy()
+				dtBlkEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+				sPath = C.findBlock(self.dConf, dsdf, sNormParam, nLevel, dtBlk, dPacks,
+				                    True)
+				if sPath != None:
+					lStale.append( (sPath, dtBlk, dtBlkEnd) )
+				dtBlk = dtBlkEnd
+		setStale = set([BI.timeKey(t[1]) for t in lStale])
+
+		# Blocks that no longer match their checksum
+		lBad = []
+		nChecked = 0
+		for sKey in sorted(dSums.keys()):
+			if self.bShutdown:
+				break
+			dtBeg = DasTime(sKey)
+			sPath = C.findBlock(self.dConf, dsdf, sNormParam, nLevel, dtBeg, dPacks,
+			                    True)
+			if sPath == None:
+				del dSums[sKey]
+				continue
+			if sKey in setStale:
+				continue
+
+			nChecked += 1
+			try:
+				tSum = self._stored(dsdf, sNormParam, nLevel, sPath, dtBeg)
+			except (IOError, OSError) as e:
+				fLog.write("   Can't read block %s of %s, %s"%(sKey, sPath, e))
+				tSum = None
+			if tSum != dSums[sKey]:
+				fLog.write("   Checksum mismatch for block %s in %s"%(sKey, sPath))
+				tAdj = C.snapToTimeBlks(fLog, dsdf, sKey, sKey, nLevel)[1]
+				dtEnd = dtBeg.copy()
+				dtEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+				lBad.append( (sPath, dtBeg, dtEnd) )
+
+		if len(lStale) + len(lBad) > 0:
+			fLog.write("   Removing %d damaged and %d stale blocks from %s"%(
+			           len(lBad), len(lStale), sLevelDir))
+			self._remove(fLog, sLevelDir, dsdf, sNormParam, nLevel, lStale + lBad)
+			for (sPath, dtBeg, dtEnd) in lStale + lBad:
+				dSums.pop(BI.timeKey(dtBeg), None)
+
+		MF.compact(sLevelDir, BI.read(sLevelDir), dSums)
+		return (nChecked, len(lBad), len(lStale))
+
+	###########################################################################
+	def run(self, fLog):
+		if not os.path.isdir(pjoin(self.dConf['CACHE_ROOT'], 'data')):
+			self.nRetCode = 0
+			self.sStatus = "No cache to verify"
+			return
+
+		lLevels = self._levels()
+		nChecked = 0
+		nBad = 0
+		nStale = 0
+		for i in range(len(lLevels)):
+			if self.bShutdown:
+				break
+			(sLevelDir, sDsdf) = lLevels[i]
+			self.setProgress(float(i)/len(lLevels), "Verifying: %s"%sLevelDir)
+
+			tLevel = self._findLevel(fLog, sLevelDir, sDsdf)
+			if tLevel == None:
+				continue
+			try:
+				(nLvlChecked, nLvlBad, nLvlStale) = self._verify(fLog, sLevelDir, *tLevel)
+			except (IOError, OSError) as e:
+				fLog.write("ERROR: Couldn't verify %s, %s"%(sLevelDir, e))
+				continue
+			nChecked += nLvlChecked
+			nBad += nLvlBad
+			nStale += nLvlStale
+
+		self.nRetCode = 0
+		self.sStatus = "Checked %d cache blocks in %d levels, "%(nChecked, len(lLevels))+\
+		               "removed %d damaged and %d stale blocks"%(nBad, nStale)
@@ -8,6 +8,7 @@ if not sys.platform.lower().startswith('win'):
 	import pwd
 
 import das2server.util.task as T
+import das2server.util.errors as E
 
 # Task Strings for hapi server stuff
 
@@ -106,14 +107,6 @@ class HINFO_CACHE(T.JOB_FIELDS):
 
 ##############################################################################
 
-# From user 'tgambin' at StackOverflow --Thanks!
-def find_nth(haystack, needle, n):
-    start = haystack.find(needle)
-    while start >= 0 and n > 1:
-        start = haystack.find(needle, start+len(needle))
-        n -= 1
-    return start
-	 
 def reqInfoCacheBuild(fLog, dConf, sId, sHParams):
 	"""
 	Request that an hapi datasource have it's info cached for a particular
@@ -127,27 +120,11 @@ def reqInfoCacheBuild(fLog, dConf, sId, sHParams):
 		fLog.write("   WARNING: Work queue unreachable, dropping cache request")
 		return
 		
-	# See what jobs are aready on the build list, only need to compare against
-	# the Job-Type, and ID and params fields
-	lTmp = broker.lrange('das2_todo', 0, 1)
-	lWaiting = []
-	for sTmp in lTmp:
-		if sTmp.find(g_sInfoCache) > -1:
-			i = find_nth(sTmp, '|', HINFO_CACHE.ID)
-			if i > -1:
-				lWaiting.append( sTmp[i+1:] )  # Already has the pipe embedded
-	
 	# make sure the params string is in sort order
 	lHParams = [s.strip() for s in sHParams.split(',')]
 	lHParams.sort()
 	sHParams = ','.join(lHParams)
 	
-	sJobId = '%s|%s'%(sId, sHParams)
-	
-	if sJobId in lWaiting:
-		fLog.write('   Info cache miss: Job %s already in queue, dropping cache request')
-		return None
-		
 	lTask = ['']*(HINFO_CACHE.HPARAMS+1)
 	
 	if 'SERVER_NAME' in os.environ:
@@ -175,7 +152,9 @@ def reqInfoCacheBuild(fLog, dConf, sId, sHParams):
 	sTask = '|'.join(lTask)
 
 	try:
-		broker.lpush('das2_todo', sTask)
+		if not T.submitTask(broker, sTask, T.LANE_INTERACTIVE):
+			fLog.write('   Info cache miss: Job %s|%s already in queue, dropping cache request'%(
+			           sId, sHParams))
 	except E.ServerError as e:
 		fLog.write('ERROR: %s'%str(e))
 	
@@ -82,6 +82,7 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	try:
 		dsdf = U.dsdf.Dsdf(sDsdf, dConf, form, fLog)
 		dsdf.fillDefaults(dConf)
+		tLimits = dsdf.getLimits(dConf)
 	except U.errors.DasError as e:
 		error.sendDasError(fLog, U, e, True)
 		return 11
@@ -148,6 +149,20 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 							True)
 		return 17
 	
+	# Parameters are split into words, same as the shell did
+	try:
+		lRdrParams = U.pipeline.split(sRdrParams)
+	except ValueError as e:
+		error.sendDasError(fLog, U, U.errors.QueryError(
+			"Invalid reader parameters '%s', %s"%(sRdrParams, e)), True)
+		return 17
+	try:
+		lHapiParams = U.pipeline.split(sHapiParam)
+	except ValueError as e:
+		error.sendDasError(fLog, U, U.errors.QueryError(
+			"Invalid parameters value '%s', %s"%(sHapiParam, e)), True)
+		return 17
+	
 	# Looks good, try to get the info...
 	
 	fLog.write("   Sending HAPI 1.1 Info Message for data source %s"%(",".join(lId)))
@@ -155,37 +170,51 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	# To get the parameters we have to run a reader (at least for a little bit)
 	# and pipe the output to the HAPI converter.  See if we can just hit the
 	# intrinsic resolution cache and not have to run the reader
-	uRdrCmd = None
+	pipe = None
+	rdr = None
 	if not bReqInterval and U.cache.isExactlyCacheable(dsdf, sNormParams, rResolution):
 		lMissing = U.cache.missList(fLog,dConf,dsdf,sNormParams,rResolution,sBeg,sEnd)
 		if (lMissing == None) or len(lMissing) == 0:
 			sCacheDir =  pjoin(dConf['CACHE_ROOT'], 'data', sDsdf)
 			fLog.write("   Cache hit: Reading data from %s"%sCacheDir)
 			
-			# Cache readers are expected to take the following arguments:
-			# 0. The program name (of course)
-			# 1. The DSDF file path
-			# 2. The dataset cache root (= Cache_ROOT + dsdf_rel_path)
-			# 3. The normalized parameter string
-			# 4. The begin index point
-			# 5. The end index point (exclusive upper bound)
-			# 6. The requested resolution		
-			uRdrCmd = u"%s %s %s %s '%s' '%s' %.5e"%(
-			         dsdf[u'cacheReader'], dsdf.sPath, sCacheDir, sNormParams,
-						sBeg, sEnd, rResolution
-			       )
+			# Plain das2 streams are read in-process and fed to the converter
+			if U.cacherdr.canRead(dConf, dsdf):
+				rdr = U.cacherdr.CacheReader(
+					fLog, dConf, dsdf, sNormParams, rResolution, sBeg, sEnd
+				)
+				pipe = U.pipeline.Pipeline()
+			else:
+				U.cache.touchBlocks(fLog, dConf, dsdf, sNormParams,
+					U.cache.getUseLevel(dsdf, sNormParams, rResolution), sBeg, sEnd
+				)
+			
+				# Cache readers are expected to take the following arguments:
+				# 0. The program name (of course)
+				# 1. The DSDF file path
+				# 2. The dataset cache root (= Cache_ROOT + dsdf_rel_path)
+				# 3. The normalized parameter string
+				# 4. The begin index point
+				# 5. The end index point (exclusive upper bound)
+				# 6. The requested resolution		
+				pipe = U.pipeline.Pipeline(
+					dsdf[u'cacheReader'], dsdf.sPath, sCacheDir, sNormParams,
+					sBeg, sEnd, "%.5e"%rResolution
+				)
 		else:
 			# Cache miss, ask the worker to fix this problem
 			fLog.write("   Cache miss: Submitting build task for %d "%len(lMissing)+\
 			           "cacheLevel_%02d blocks."%lMissing[0][2])
 			U.cache.reqCacheBuild(fLog, dConf, sDsdf, lMissing)
 					 
-	if uRdrCmd == None:
+	if pipe == None:
 		# Must of not been cachable or we had a cache miss
 		if bReqInterval:
-			uRdrCmd = u"%s '%e' '%s' '%s' %s"%(dsdf[u'reader'], rInterval, sBeg, sEnd, sRdrParams)
+			pipe = U.pipeline.Pipeline(
+				dsdf[u'reader'], "%e"%rInterval, sBeg, sEnd, *lRdrParams
+			)
 		else:
-			uRdrCmd = u"%s '%s' '%s' %s"%(dsdf[u'reader'], sBeg, sEnd, sRdrParams)
+			pipe = U.pipeline.Pipeline(dsdf[u'reader'], sBeg, sEnd, *lRdrParams)
 
 	
 	# Here the command options are:
@@ -193,21 +222,35 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	# 2. Don't output data (-n)
 	# 3. Use DSDF file for extra information (-d %s)
 	# 4. Use parameter select list (%s)
-	sOpt = ""
+	lOpt = []
 	if bHeader:
-		sOpt = " -i -d %s"%dsdf.sPath
+		lOpt = ['-i', '-d', dsdf.sPath]
 	
 	# HAPI datasources can't be flattened (Grrr)
 	#if dsdf[u'flattenHapi']:
-	#	sOpt += "-f"
+	#	lOpt.append("-f")
 
-	uHapiCmd = u"das2_hapi %s -b %s -e %s %s"%(
-	            sOpt, sBeg, sEnd, sHapiParam)
+	lOpt += ['-b', sBeg, '-e', sEnd] + lHapiParams
+	pipe.add(u"das2_hapi", *lOpt)
 	
-	uCmd = u"%s | %s"%(uRdrCmd, uHapiCmd)
+	# Answer repeats of responses made only from cache blocks without
+	# reading the blocks, see das2server.util.respcache
+	resp = None
+	if rdr != None:
+		try:
+			resp = U.respcache.Response(fLog, dConf, rdr, [
+				'hapi', sId, sBeg, sEnd, "%.5e"%rResolution, sNormParams, "%s"%pipe
+			])
+		except U.errors.DasError as e:
+			error.sendDasError(fLog, U, e, True)
+			return 17
+		if resp.answer():
+			return 0
+		resp.record()
+		rdr.feed(pipe)
 	
 	fLog.write(u"   Exec Host: %s"%platform.node())
-	fLog.write(u"   Exec Cmd: %s"%uCmd)
+	fLog.write(u"   Exec Cmd: %s"%pipe)
 	
 	# Make a decent file name for this dataset in case they just want
 	# to save it to disk
@@ -220,8 +263,13 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	sOutFile = "%s_%s_%s.csv"%(sName, sFnBeg, sFnEnd)
 	fLog.write(u"   Filename: %s"%sOutFile)
 	
+	pipe.setLimits(*tLimits)
 	(nRet, sStdErr, bHdrSent) = U.command.sendCmdOutput(
-		fLog, uCmd, 'text/csv; charset=utf-8', 'attachment', sOutFile)
+		fLog, pipe, 'text/csv; charset=utf-8', 'attachment', sOutFile)
+	if rdr != None:
+		rdr.wait()
+	if resp != None:
+		resp.finish(nRet == 0)
 
 	# Handle the no data case
 	if nRet == 0:
@@ -233,6 +281,7 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 			pout(b'Status: 200 OK\r\n')
 			fLog.write("   Not data in range, empty message body sent")
 	else:
+		fLog.write("   %s"%pipe.report())
 		if not bHdrSent:
 			# If headers haven't went out the door, I can send a proper error
 			# response
@@ -244,6 +293,8 @@ def handleReq(U, sReqType, dConf, fLog, form, sPathInfo):
 	
 			dStatus = {'code':1500, 'message': 'Internal Server Error'}
 			dOut = {"HAPI": "1.1", 'status':dStatus}
+			if pipe.sLimit:
+				sStdErr = u"Request stopped, %s\n%s"%(pipe.sLimit, sStdErr)
 			dStatus['x_reason'] = sStdErr.replace('\\', '\\\\').replace('"','\"') 
 		
 			sOut = json.dumps(dOut, ensure_ascii=False, sort_keys=True, indent=3)
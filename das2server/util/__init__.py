@@ -8,7 +8,14 @@ from . import dsid
 from . import auth
 from . import task
 from . import cache
+from . import cacherdr
+from . import evict
+from . import respcache
+from . import nodata
+from . import spool
+from . import pipeline
 from . import command
+from . import route
 
 if webio.isBrowser():
 	from . import site
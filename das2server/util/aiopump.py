@@ -0,0 +1,426 @@
+"""asyncio based streaming of sub-command output
+
+The pump coroutine reads a sub-process's standard output in bounded chunks,
+coalesces small reads into larger writes and waits on the sink before
+reading more, so a slow client slows down the reader instead of growing a
+buffer in the server.  Standard error is collected separately.
+
+This module uses async/await syntax and is only imported by command.py when
+the running interpreter supports it.
+"""
+
+import os
+import time
+import signal
+import asyncio
+
+from . import webio
+from . import errors as E
+
+##############################################################################
+# Tuning
+
+# Largest single read from a sub-process pipe
+PUMP_READ_SZ = 16384
+
+# Write to the sink once this many bytes have been collected ...
+PUMP_COALESCE_SZ = 65536
+
+# ... or once no new data has arrived for this many seconds
+PUMP_FLUSH_SEC = 0.05
+
+# Time allowed for a cancelled pipeline to exit after SIGTERM
+CANCEL_GRACE_SEC = 2.0
+
+##############################################################################
+class PumpStop(Exception):
+	"""Raised by pump() when it has to quit before the end of the input.
+	The sKind member is one of:
+
+	   'client' - The sink can no longer be written
+	   'deadline' - The wall clock deadline passed
+	   'output' - The output limit was reached
+	"""
+
+	def __init__(self, sKind, sReason, nSent):
+		Exception.__init__(self, sReason)
+		self.sKind = sKind
+		self.nSent = nSent
+
+##############################################################################
+# Sinks, objects with start(), write(), drain() and close() methods
+
+class StdoutSink(object):
+	"""Send output to sys.stdout, as used by CGI and WSGI handlers.
+
+	Writes block, so backpressure from the client is applied directly to the
+	event loop.
+	"""
+
+	def __init__(self, fStart=None):
+		"""fStart - A function to call before the first byte is written,
+		   typically used to send the HTTP headers.
+		"""
+		self.fStart = fStart
+
+	def start(self):
+		if self.fStart:
+			self.fStart()
+
+	def write(self, xData):
+		webio.pout(xData)
+
+	async def drain(self):
+		webio.flushOut()
+
+	def close(self):
+		webio.flushOut()
+
+
+class StreamSink(object):
+	"""Send output to an asyncio StreamWriter, for servers that answer many
+	requests from one event loop.
+	"""
+
+	def __init__(self, writer, xPrefix=None):
+		"""writer - An asyncio.StreamWriter
+		xPrefix - Bytes to send ahead of the first data write, typically the
+		   HTTP response headers.
+		"""
+		self.writer = writer
+		self.xPrefix = xPrefix
+
+	def start(self):
+		if self.xPrefix:
+			self.writer.write(self.xPrefix)
+
+	def write(self, xData):
+		self.writer.write(xData)
+
+	async def drain(self):
+		await self.writer.drain()
+
+	def close(self):
+		pass
+
+
+class BufferSink(object):
+	"""Collect all output in memory, only for small outputs"""
+
+	def __init__(self):
+		self.lOut = []
+
+	def start(self):
+		pass
+
+	def write(self, xData):
+		self.lOut.append(xData)
+
+	async def drain(self):
+		pass
+
+	def close(self):
+		pass
+
+	def getvalue(self):
+		return b''.join(self.lOut)
+
+
+##############################################################################
+async def pump(reader, sink, rDeadline=None, nMaxOut=None):
+	"""Copy all bytes from an asyncio StreamReader to a sink.
+
+	Reads are at most PUMP_READ_SZ bytes.  Data are handed to the sink in
+	blocks of up to PUMP_COALESCE_SZ bytes, or sooner if the reader goes
+	quiet for PUMP_FLUSH_SEC seconds.  sink.start() is called just before the
+	first write, it is not called at all if the reader produced no data.
+
+	rDeadline - Optional time.time() value at which to give up
+
+	nMaxOut - Optional limit on the number of bytes to copy
+
+	Returns the number of bytes written to the sink.  If the sink fails or
+	a limit is reached PumpStop is raised instead.
+	"""
+	lBuf = []
+	nBuf = 0
+	nTotal = 0
+	bStarted = False
+	tRead = None
+
+	try:
+		while True:
+			# Keep one read outstanding, a timed out wait must not cancel it
+			# or any bytes it collected would be lost.
+			if tRead is None:
+				tRead = asyncio.ensure_future(reader.read(PUMP_READ_SZ))
+
+			rWait = None
+			if nBuf > 0:
+				rWait = PUMP_FLUSH_SEC
+			if rDeadline != None:
+				rLeft = rDeadline - time.time()
+				if rLeft <= 0:
+					raise PumpStop('deadline', "deadline reached", nTotal)
+				if (rWait == None) or (rLeft < rWait):
+					rWait = rLeft
+
+			await asyncio.wait([tRead], timeout=rWait)
+
+			if tRead.done():
+				xRead = tRead.result()
+				tRead = None
+			else:
+				xRead = None
+
+			if xRead:
+				lBuf.append(xRead)
+				nBuf += len(xRead)
+
+				if (nMaxOut != None) and (nTotal + nBuf > nMaxOut):
+					raise PumpStop('output', "output limit reached", nTotal)
+
+				if nBuf < PUMP_COALESCE_SZ:
+					continue
+
+			if nBuf > 0:
+				try:
+					if not bStarted:
+						sink.start()
+						bStarted = True
+					sink.write(b''.join(lBuf))
+					await sink.drain()
+				except (IOError, OSError) as e:
+					raise PumpStop('client', str(e), nTotal)
+
+				nTotal += nBuf
+				lBuf = []
+				nBuf = 0
+
+			if xRead is not None and len(xRead) == 0:
+				break
+	except:
+		# A cancelled or failed pump must not leave a read pending on the
+		# stream, whoever drains it next would fail
+		if tRead is not None:
+			tRead.cancel()
+		raise
+
+	return nTotal
+
+
+async def collect(reader, lOut):
+	"""Gather everything from a StreamReader into the list lOut"""
+	while True:
+		xRead = await reader.read(PUMP_READ_SZ)
+		if len(xRead) == 0:
+			break
+		lOut.append(xRead)
+
+
+async def discard(reader):
+	"""Read a StreamReader to the end, throwing away the data"""
+	while True:
+		xRead = await reader.read(PUMP_READ_SZ)
+		if len(xRead) == 0:
+			break
+
+
+async def runCmd(uCmd, sink):
+	"""Run a shell command, pumping it's standard output to the sink.
+
+	Returns the tuple (return_code, stderr_bytes, bytes_sent)
+	"""
+	proc = await asyncio.create_subprocess_shell(
+		uCmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+		limit=PUMP_READ_SZ * 2
+	)
+
+	lErr = []
+	(nSent, _) = await asyncio.gather(
+		pump(proc.stdout, sink), collect(proc.stderr, lErr)
+	)
+	nRet = await proc.wait()
+	sink.close()
+
+	return (nRet, b''.join(lErr), nSent)
+
+
+async def runPipeline(pipe, sink):
+	"""Run a pipeline.Pipeline object, pumping the standard output of the
+	last stage to the sink.  Exit values and standard error text are stored
+	in the pipeline object.
+
+	Returns the number of bytes sent to the sink.  If the sink fails the
+	pipeline's process group is stopped and the reason is saved in the
+	pipeline's sCancel member.  If the pipeline runs over it's wall clock or
+	output limits it is stopped and sLimit is set as well.
+	"""
+	lProcs = []
+	fdIn = pipe.takeInput()
+	nStages = len(pipe.lStages)
+	pipe.nPgid = None
+	pipe.sCancel = None
+	pipe.sLimit = None
+	pipe.rStart = time.time()
+	try:
+		for i in range(nStages):
+			fdNext = None
+			if i < nStages - 1:
+				(fdNext, fdOut) = os.pipe()
+			else:
+				fdOut = asyncio.subprocess.PIPE
+
+			try:
+				proc = await asyncio.create_subprocess_exec(
+					*pipe.lStages[i], stdin=fdIn, stdout=fdOut,
+					stderr=asyncio.subprocess.PIPE, limit=PUMP_READ_SZ * 2,
+					**pipe.spawnArgs()
+				)
+			except OSError as e:
+				if fdNext != None:
+					os.close(fdNext)
+					os.close(fdOut)
+				raise E.ServerError("Couldn't run pipeline stage %d, %s: %s"%(
+				                    i+1, pipe.lNames[i], e))
+			lProcs.append(proc)
+			pipe.joined(proc.pid)
+
+			if fdIn != None:
+				os.close(fdIn)
+			if fdNext != None:
+				os.close(fdOut)
+			fdIn = fdNext
+	except:
+		if fdIn != None:
+			os.close(fdIn)
+		for proc in lProcs:
+			if proc.returncode == None:
+				proc.kill()
+		raise
+
+	lErr = [ [] for proc in lProcs]
+	tPump = asyncio.ensure_future(
+		pump(lProcs[-1].stdout, sink, pipe.deadline(), pipe.maxOutput())
+	)
+	lJobs = [tPump]
+	lJobs += [
+		asyncio.ensure_future(collect(lProcs[i].stderr, lErr[i]))
+		for i in range(nStages)
+	]
+	nSent = 0
+	try:
+		await asyncio.wait([tPump])
+		if tPump.exception() != None:
+			ex = tPump.exception()
+			if not isinstance(ex, PumpStop):
+				raise ex
+			nSent = ex.nSent
+			if ex.sKind == 'deadline':
+				pipe.sLimit = "wall clock limit of %g seconds exceeded"%pipe.rWallSec
+			elif ex.sKind == 'output':
+				pipe.sLimit = "output limit of %g MB exceeded"%pipe.rOutMB
+			if pipe.sLimit:
+				pipe.sCancel = "%s after %d bytes"%(pipe.sLimit, nSent)
+			else:
+				pipe.sCancel = "client disconnected after %d bytes (%s)"%(nSent, ex)
+			await _stopGroup(pipe, lProcs)
+
+			# Pick up what error output there is, but don't wait on processes
+			# that left the group and still hold the pipe open
+			(lDone, lPending) = await asyncio.wait(lJobs[1:], timeout=CANCEL_GRACE_SEC)
+			for t in lPending:
+				t.cancel()
+		else:
+			nSent = tPump.result()
+			await _endErr(pipe, lProcs, lJobs[1:], nSent)
+			sink.close()
+	except:
+		# Don't leave readers running or tasks pending, persistent servers
+		# would collect them with every failed request
+		lLeft = [t for t in lJobs if not t.done()]
+		for t in lLeft:
+			t.cancel()
+		if len(lLeft) > 0:
+			await asyncio.wait(lLeft)
+		if any([proc.returncode == None for proc in lProcs]):
+			await _stopGroup(pipe, lProcs)
+		raise
+
+	lRetCodes = []
+	for proc in lProcs:
+		if proc.returncode == None:
+			await proc.wait()
+		lRetCodes.append(proc.returncode)
+
+	pipe.setResults(lRetCodes, [b''.join(l) for l in lErr])
+	return nSent
+
+
+async def _endErr(pipe, lProcs, lCollect, nSent):
+	"""Wait for the standard error collectors once the output has ended.  The
+	stages have until the wall clock deadline to exit, then the group is
+	stopped.  Descendants that left the process group may hold standard
+	error open for ever, so once the stages are gone the collectors get
+	CANCEL_GRACE_SEC seconds more before they are cancelled.
+	"""
+	rGiveUp = None
+	while True:
+		lPending = [t for t in lCollect if not t.done()]
+		if len(lPending) == 0:
+			return
+		
+		rNow = time.time()
+		rDeadline = pipe.deadline()
+		if rGiveUp == None:
+			if len([proc for proc in lProcs if proc.returncode == None]) == 0:
+				rGiveUp = rNow + CANCEL_GRACE_SEC
+			elif (rDeadline != None) and (rNow >= rDeadline):
+				pipe.sLimit = "wall clock limit of %g seconds exceeded"%pipe.rWallSec
+				pipe.sCancel = "%s after %d bytes"%(pipe.sLimit, nSent)
+				await _stopGroup(pipe, lProcs)
+				rGiveUp = time.time() + CANCEL_GRACE_SEC
+		elif rNow >= rGiveUp:
+			for t in lPending:
+				t.cancel()
+			await asyncio.wait(lPending)
+			
+			# Let go of the pipes held open, asyncio has no public call for
+			# this short of killing the (already exited) stages
+			for proc in lProcs:
+				proc._transport.close()
+			return
+		
+		await asyncio.wait(lPending, timeout=0.1)
+
+
+async def _stopGroup(pipe, lProcs):
+	"""SIGTERM the pipeline's process group, then SIGKILL it if the stages
+	haven't exited within CANCEL_GRACE_SEC seconds"""
+	pipe.signal(signal.SIGTERM)
+
+	# Nobody is reading the last stage's output anymore, the exit status is
+	# not delivered until that pipe reaches end of file.
+	tDrain = asyncio.ensure_future(discard(lProcs[-1].stdout))
+
+	lWaits = [asyncio.ensure_future(proc.wait()) for proc in lProcs]
+	await asyncio.wait(lWaits, timeout=CANCEL_GRACE_SEC)
+
+	# Also catches grandchildren that ignored SIGTERM
+	pipe.signal(signal.SIGKILL)
+	await asyncio.wait(lWaits + [tDrain])
+
+
+##############################################################################
+def runSync(coro):
+	"""Run a coroutine to completion on a private event loop, for callers
+	that are not themselves asynchronous.
+	"""
+	loop = asyncio.new_event_loop()
+	try:
+		# Sub-process child watchers need a current loop on older pythons
+		asyncio.set_event_loop(loop)
+		return loop.run_until_complete(coro)
+	finally:
+		asyncio.set_event_loop(None)
+		loop.close()
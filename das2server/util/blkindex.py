@@ -0,0 +1,317 @@
+"""Presence index for the time-block disk cache
+
+Each cache level directory, CACHE_ROOT/data/DSDF/PARAMS/RES, may hold a
+file named _blocks.idx that lists which block periods have been written.
+The file is plain text, one half-open time interval per line:
+
+   2019-01-01T00:00:00.000 2019-03-15T00:00:00.000
+   2019-04-01T00:00:00.000 2019-04-02T00:00:00.000
+
+Intervals are sorted and adjacent blocks are merged, so a fully populated
+level is a single line no matter how many block files it holds.  Times are
+fixed width strings so they compare correctly as text.
+
+The index is only a summary of what the cache builder has done.  It is
+created by scanning the level directory the first time a block is added,
+and may be deleted at any time, readers fall back to checking for each
+block file when there is no index.  Delete it after removing block files
+by hand, or use removeBlocks() which keeps it up to date.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+from os.path import join as pjoin
+from bisect import bisect_right
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+import das2
+
+from . import blkpack as PK
+
+INDEX_NAME = '_blocks.idx'
+
+# Block file endings, cache blocks may be stored compressed or, for short
+# periods, in containers
+COMPRESS_EXT = ('.gz', '.zst')
+PACK_EXT = '.d2s' + PK.PACK_EXT
+BLOCK_EXT = tuple([s + c for s in ('.d2s', '.qds') for c in ('',) + COMPRESS_EXT]) + \
+            (PACK_EXT,)
+
+# Ending added to a block file name for it's time index sidecar
+TIX_EXT = '.tix'
+
+##############################################################################
+def timeKey(dt):
+	"""Get the sortable index string for a DasTime"""
+	return "%04d-%02d-%02dT%02d:%02d:%06.3f"%(dt.year(), dt.month(), dt.dom(),
+	       dt.hour(), dt.minute(), dt.sec())
+
+
+def merge(lIntervals):
+	"""Sort a list of (sBeg, sEnd) intervals and combine any that overlap or
+	touch"""
+	lIntervals = sorted(lIntervals)
+	lOut = []
+	for (sBeg, sEnd) in lIntervals:
+		if len(lOut) > 0 and sBeg <= lOut[-1][1]:
+			if sEnd > lOut[-1][1]:
+				lOut[-1] = (lOut[-1][0], sEnd)
+		else:
+			lOut.append( (sBeg, sEnd) )
+	return lOut
+
+
+def gaps(lIntervals, sBeg, sEnd):
+	"""Get the parts of [sBeg, sEnd) not covered by a merged interval list.
+
+	Returns a list of (sBeg, sEnd) tuples, empty if the whole range is
+	present.
+	"""
+	lOut = []
+
+	# First interval that ends after the start of the range
+	i = bisect_right([t[1] for t in lIntervals], sBeg)
+	sCur = sBeg
+	while (i < len(lIntervals)) and (sCur < sEnd):
+		(sIntBeg, sIntEnd) = lIntervals[i]
+		if sIntBeg >= sEnd:
+			break
+		if sIntBeg > sCur:
+			lOut.append( (sCur, sIntBeg) )
+		if sIntEnd > sCur:
+			sCur = sIntEnd
+		i += 1
+
+	if sCur < sEnd:
+		lOut.append( (sCur, sEnd) )
+
+	return lOut
+
+
+def subtract(lIntervals, sBeg, sEnd):
+	"""Remove [sBeg, sEnd) from a merged interval list"""
+	lOut = []
+	for (sIntBeg, sIntEnd) in lIntervals:
+		if (sIntEnd <= sBeg) or (sIntBeg >= sEnd):
+			lOut.append( (sIntBeg, sIntEnd) )
+			continue
+		if sIntBeg < sBeg:
+			lOut.append( (sIntBeg, sBeg) )
+		if sEnd < sIntEnd:
+			lOut.append( (sEnd, sIntEnd) )
+	return lOut
+
+##############################################################################
+def read(sLevelDir):
+	"""Load the index for a cache level directory.
+
+	Returns a merged list of (sBeg, sEnd) tuples, or None if the directory has
+	no index.
+	"""
+	sPath = pjoin(sLevelDir, INDEX_NAME)
+	try:
+		fIn = open(sPath, 'r')
+	except (IOError, OSError):
+		return None
+
+	lOut = []
+	try:
+		for sLine in fIn:
+			lLine = sLine.split()
+			if len(lLine) != 2 or sLine.startswith('#'):
+				continue
+			lOut.append( (lLine[0], lLine[1]) )
+	finally:
+		fIn.close()
+
+	return lOut
+
+
+def _write(sLevelDir, lIntervals):
+	"""Replace the index in a single rename so readers never see part of it"""
+	sPath = pjoin(sLevelDir, INDEX_NAME)
+	sTmp = "%s.%d.tmp"%(sPath, os.getpid())
+	fOut = open(sTmp, 'w')
+	try:
+		fOut.write("# das2server cache block index, begin end\n")
+		for (sBeg, sEnd) in lIntervals:
+			fOut.write("%s %s\n"%(sBeg, sEnd))
+	finally:
+		fOut.close()
+	os.rename(sTmp, sPath)
+
+##############################################################################
+def _nameTime(sName):
+	"""Get the block begin time from a cache file name such as
+	2019-04-01T13-05_bin-60s.d2s, or None if it doesn't look like a block
+	"""
+	sStamp = sName.split('_')[0]
+	lPart = sStamp.split('T')
+	try:
+		lDate = [int(s, 10) for s in lPart[0].split('-')]
+		lTime = []
+		if len(lPart) > 1:
+			lTime = [int(s, 10) for s in lPart[1].split('-')]
+	except ValueError:
+		return None
+
+	if len(lDate) == 2:
+		lDate.append(1)
+	if len(lDate) != 3 or len(lTime) > 3:
+		return None
+
+	return das2.DasTime(*(lDate + lTime + [0]*(3 - len(lTime))))
+
+
+# Block step for each number of time fields in a block file name
+g_dNameAdj = {
+	2:(0, 1, 0, 0, 0, 0), 3:(0, 0, 1, 0, 0, 0), 4:(0, 0, 0, 1, 0, 0),
+	5:(0, 0, 0, 0, 1, 0), 6:(0, 0, 0, 0, 0, 1)
+}
+
+def nameSpan(sName):
+	"""Get the (sBeg, sEnd) index keys of the block stored in a cache file.
+	The storage period follows from the number of time fields in the name,
+	monthly blocks have two, daily blocks three and so on down to one second
+	blocks with six.  For containers this is the span of the whole container.
+	Returns None if the name doesn't look like a block.
+	"""
+	dtBeg = _nameTime(sName)
+	if dtBeg is None:
+		return None
+
+	nFields = len(sName.split('_')[0].replace('T', '-').split('-'))
+	if nFields not in g_dNameAdj:
+		return None
+	tAdj = g_dNameAdj[nFields]
+
+	dtEnd = dtBeg.copy()
+	dtEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+	return (timeKey(dtBeg), timeKey(dtEnd))
+
+
+def scan(sLevelDir, tAdj, lExt=BLOCK_EXT):
+	"""Build an interval list by looking at the block files present under a
+	cache level directory.  Containers are opened to see which of their
+	blocks are present.
+
+	tAdj - The 6-tuple that steps from one block start time to the next
+	"""
+	lBlocks = []
+	for (sDir, lDirs, lFiles) in os.walk(sLevelDir):
+		for sFile in lFiles:
+			if not sFile.endswith(lExt):
+				continue
+			dtBeg = _nameTime(sFile)
+			if dtBeg is None:
+				continue
+			if sFile.endswith(PACK_EXT):
+				lBlocks += _packed(pjoin(sDir, sFile), dtBeg, tAdj)
+				continue
+			dtEnd = dtBeg.copy()
+			dtEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+			lBlocks.append( (timeKey(dtBeg), timeKey(dtEnd)) )
+
+	return merge(lBlocks)
+
+
+def _packed(sPath, dtPack, tAdj):
+	"""Get index intervals for the blocks present in a container"""
+	lTable = PK.readTable(sPath)
+	if lTable == None:
+		return []
+	lOut = []
+	for iSlot in PK.filled(lTable):
+		dtBeg = dtPack.copy()
+		dtBeg.adjust(*[n*iSlot for n in tAdj])
+		dtEnd = dtBeg.copy()
+		dtEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+		lOut.append( (timeKey(dtBeg), timeKey(dtEnd)) )
+	return lOut
+
+
+def addBlock(sLevelDir, tAdj, dtBeg, dtEnd):
+	"""Record that the block [dtBeg, dtEnd) is now on disk.  If the level
+	directory has no index yet one is built from the files already present.
+	Concurrent writers are serialized with an advisory lock.
+	"""
+	sLock = pjoin(sLevelDir, INDEX_NAME + '.lock')
+	fLock = open(sLock, 'a')
+	try:
+		if fcntl:
+			fcntl.flock(fLock.fileno(), fcntl.LOCK_EX)
+
+		lIntervals = read(sLevelDir)
+		if lIntervals == None:
+			lIntervals = scan(sLevelDir, tAdj)
+
+		lIntervals.append( (timeKey(dtBeg), timeKey(dtEnd)) )
+		_write(sLevelDir, merge(lIntervals))
+	finally:
+		fLock.close()
+
+
+def removeBlocks(sLevelDir, lPaths):
+	"""Delete block files, and their time index sidecars, from a cache
+	level.  The blocks are taken out of the index before the files are
+	removed, under the same lock as addBlock(), so the index never lists a
+	block that isn't on disk.
+
+	Returns the list of paths actually removed.
+	"""
+	sLock = pjoin(sLevelDir, INDEX_NAME + '.lock')
+	fLock = open(sLock, 'a')
+	try:
+		if fcntl:
+			fcntl.flock(fLock.fileno(), fcntl.LOCK_EX)
+
+		lIntervals = read(sLevelDir)
+		if lIntervals != None:
+			for sPath in lPaths:
+				tSpan = nameSpan(os.path.basename(sPath))
+				if tSpan != None:
+					lIntervals = subtract(lIntervals, tSpan[0], tSpan[1])
+			_write(sLevelDir, lIntervals)
+
+		lGone = []
+		for sPath in lPaths:
+			try:
+				os.remove(sPath)
+				lGone.append(sPath)
+			except OSError:
+				pass
+			try:
+				os.remove(sPath + TIX_EXT)
+			except OSError:
+				pass
+	finally:
+		fLock.close()
+
+	return lGone
+
+
+def forget(sLevelDir, lSpans):
+	"""Take (sBeg, sEnd) spans out of a level's index, for blocks that are
+	about to be removed from their container.  Uses the same lock as
+	addBlock().
+	"""
+	sLock = pjoin(sLevelDir, INDEX_NAME + '.lock')
+	fLock = open(sLock, 'a')
+	try:
+		if fcntl:
+			fcntl.flock(fLock.fileno(), fcntl.LOCK_EX)
+
+		lIntervals = read(sLevelDir)
+		if lIntervals != None:
+			for (sBeg, sEnd) in lSpans:
+				lIntervals = subtract(lIntervals, sBeg, sEnd)
+			_write(sLevelDir, lIntervals)
+	finally:
+		fLock.close()
@@ -0,0 +1,190 @@
+"""Container files for short cache blocks
+
+Cache levels stored 'persecond' or 'perminute' would otherwise need one
+file per block, tens of millions of them for a mission-year.  Such levels
+may instead be packed: all blocks of an hour (persecond) or a day
+(perminute) are kept in one container file, named like a block of the
+longer period with a .pack ending, for example:
+
+   2019-04-01T13_intrinsic.d2s.pack
+
+A container starts with a fixed size header followed by a slot table,
+then the block data:
+
+   magic    8 bytes   b'das2pack'
+   version  uint32
+   slots    uint32    Number of blocks the container can hold
+   table    slots x (uint64 offset, uint64 length)
+   data     ...
+
+All integers are big endian.  Unused slots have an offset of zero, blocks
+that hold no data have a real offset and a length of zero.  New
+blocks are appended to the end of the file and only then entered in the
+table, so readers never see a slot that points at incomplete data and
+don't need to lock anything.  Writers are serialized with an advisory lock
+on the container itself.  Rewriting a block leaves it's old data behind as
+dead space until the container is removed.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import struct
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+PACK_EXT = '.pack'
+
+MAGIC = b'das2pack'
+VERSION = 1
+
+g_sHdrFmt = '>8sII'
+g_nHdrSz = struct.calcsize(g_sHdrFmt)
+g_sSlotFmt = '>QQ'
+g_nSlotSz = struct.calcsize(g_sSlotFmt)
+
+# Copy size when appending a block
+COPY_SZ = 1048576
+
+##############################################################################
+def _table(fIn):
+	"""Read the slot table from an open container, or None if it isn't one"""
+	fIn.seek(0)
+	xHdr = fIn.read(g_nHdrSz)
+	if len(xHdr) < g_nHdrSz:
+		return None
+	(xMagic, nVer, nSlots) = struct.unpack(g_sHdrFmt, xHdr)
+	if (xMagic != MAGIC) or (nVer != VERSION):
+		return None
+
+	xTable = fIn.read(nSlots * g_nSlotSz)
+	if len(xTable) < nSlots * g_nSlotSz:
+		return None
+	return [struct.unpack_from(g_sSlotFmt, xTable, i * g_nSlotSz)
+	        for i in range(nSlots)]
+
+
+def readTable(sPath):
+	"""Get the slot table of a container as a list of (offset, length)
+	tuples, or None if the file is missing or is not a container."""
+	try:
+		fIn = open(sPath, 'rb')
+	except (IOError, OSError):
+		return None
+	try:
+		return _table(fIn)
+	finally:
+		fIn.close()
+
+
+def filled(lTable):
+	"""Get the numbers of the slots that hold a block"""
+	return [i for i in range(len(lTable)) if lTable[i][0] > 0]
+
+
+def read(sPath, iFirst, nCount):
+	"""Read blocks iFirst through iFirst + nCount - 1 from a container.
+
+	Blocks that are next to each other in the file are read together, so a
+	run of blocks written in time order costs a single read.  Returns a list
+	of byte strings, each holding one or more whole blocks in slot order.
+	Raises IOError if the file is not a container or a slot is unused.
+	"""
+	fIn = open(sPath, 'rb')
+	try:
+		lTable = _table(fIn)
+		if lTable == None:
+			raise IOError("%s is not a cache block container"%sPath)
+		if iFirst + nCount > len(lTable):
+			raise IOError("Slot %d is outside of %s"%(iFirst + nCount - 1, sPath))
+
+		lRuns = []
+		for i in range(iFirst, iFirst + nCount):
+			(nOff, nLen) = lTable[i]
+			if nOff == 0:
+				raise IOError("Slot %d of %s is unused"%(i, sPath))
+			if nLen == 0:
+				continue
+			if len(lRuns) > 0 and lRuns[-1][1] == nOff:
+				lRuns[-1][1] = nOff + nLen
+			else:
+				lRuns.append( [nOff, nOff + nLen] )
+
+		lOut = []
+		for (nBeg, nEnd) in lRuns:
+			fIn.seek(nBeg)
+			xData = fIn.read(nEnd - nBeg)
+			if len(xData) < nEnd - nBeg:
+				raise IOError("%s is truncated"%sPath)
+			lOut.append(xData)
+		return lOut
+	finally:
+		fIn.close()
+
+##############################################################################
+def put(sPath, nSlots, iSlot, sSrc):
+	"""Store the contents of file sSrc as block iSlot of a container,
+	creating the container with room for nSlots blocks if needed.  Any block
+	already in the slot is replaced.
+	"""
+	nFd = os.open(sPath, os.O_RDWR | os.O_CREAT, 0o644)
+	fPack = os.fdopen(nFd, 'r+b')
+	try:
+		if fcntl:
+			fcntl.flock(fPack.fileno(), fcntl.LOCK_EX)
+
+		lTable = _table(fPack)
+		if lTable == None:
+			# New, or left unusable by a crash while being created
+			fPack.seek(0)
+			fPack.truncate()
+			fPack.write(struct.pack(g_sHdrFmt, MAGIC, VERSION, nSlots))
+			fPack.write(b'\0' * (nSlots * g_nSlotSz))
+			lTable = [(0, 0)] * nSlots
+
+		if iSlot >= len(lTable):
+			raise IOError("Slot %d is outside of %s"%(iSlot, sPath))
+
+		fPack.seek(0, os.SEEK_END)
+		nOff = fPack.tell()
+		nLen = 0
+		fIn = open(sSrc, 'rb')
+		try:
+			while True:
+				xData = fIn.read(COPY_SZ)
+				if len(xData) == 0:
+					break
+				fPack.write(xData)
+				nLen += len(xData)
+		finally:
+			fIn.close()
+		fPack.flush()
+
+		fPack.seek(g_nHdrSz + iSlot * g_nSlotSz)
+		fPack.write(struct.pack(g_sSlotFmt, nOff, nLen))
+		fPack.flush()
+	finally:
+		fPack.close()
+
+
+def clear(sPath, lSlots):
+	"""Mark blocks of a container as unused.  Their data stays in the file
+	as dead space."""
+	fPack = open(sPath, 'r+b')
+	try:
+		if fcntl:
+			fcntl.flock(fPack.fileno(), fcntl.LOCK_EX)
+		lTable = _table(fPack)
+		if lTable == None:
+			return
+		for iSlot in lSlots:
+			if iSlot < len(lTable):
+				fPack.seek(g_nHdrSz + iSlot * g_nSlotSz)
+				fPack.write(struct.pack(g_sSlotFmt, 0, 0))
+		fPack.flush()
+	finally:
+		fPack.close()
@@ -5,6 +5,8 @@ from __future__ import absolute_import
 
 import sys
 import time
+import gzip
+import subprocess
 
 import os.path
 from os.path import join as pjoin
@@ -12,11 +14,23 @@ from os.path import join as pjoin
 if not sys.platform.lower().startswith('win'):
 	import pwd
 
+try:
+	import zstandard
+	g_bHaveZstd = True
+except ImportError:
+	g_bHaveZstd = False
+
 import das2
 
 from . import task as T
 from . import dsdf as D
+from . import misc as M
 from . import errors as E
+from . import evict as EV
+from . import blkindex as BI
+from . import blkpack as PK
+from . import manifest as MF
+from . import pipeline as P
 
 
 ##############################################################################
@@ -152,10 +166,10 @@ def snapToTimeBlks(fLog, dsdf, sBeg, sEnd, nLevel, bCoverage=False):
 
 		return (
 			das2.DasTime(dtB.year(), dtB.month(), dtB.dom(), dtB.hour(),
-			             dtB.minute(), dtB.sec()),
+			             dtB.minute(), int(dtB.sec())),
 			(0, 0, 0, 0, 0, 1),
 			das2.DasTime(dtE.year(), dtE.month(), dtE.dom(), dtE.hour(),
-			            dtE.minute(), dtE.sec())
+			            dtE.minute(), int(dtE.sec()))
 		)
 	
 	elif sPeriod == 'perminute':
@@ -203,32 +217,27 @@ def snapToTimeBlks(fLog, dsdf, sBeg, sEnd, nLevel, bCoverage=False):
 		                    sPeriod, sDsdf))
 
 ##############################################################################
-def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False):
-	
-	sDsdf = dsdf.sName
-	
-	sCacheRoot = pjoin(dConf['CACHE_ROOT'], "data")
-	
+def _resStub(dsdf, nLevel):
 	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
-	
-	# Get the resolution stub
 	if nRes > 0:
 		if sUnits != None and len(sUnits) > 0:
-			sRes = "bin-%d%s"%(nRes, sUnits)
+			return "bin-%d%s"%(nRes, sUnits)
 		else:
-			sRes = "bin-%d"%nRes
-	else:
-		sRes = 'intrinsic'
+			return "bin-%d"%nRes
+	return 'intrinsic'
 
-	sExt = 'd2s'
-	if dsdf[u'qstream']:
-		sExt = 'qds'
-				
-	# Get the output directory and file name based of the storage scheme
-	# and time period.
+def getLevelDir(dConf, dsdf, sNormParam, nLevel):
+	"""Get the top directory holding all blocks for one cache level"""
+	return pjoin(dConf['CACHE_ROOT'], "data", dsdf.sName, sNormParam,
+	             _resStub(dsdf, nLevel))
+
+##############################################################################
+def _periodPath(sLevelDir, sPeriod, dtBeg, sRes, sExt):
+	"""Get the output directory and file name based of the storage scheme
+	and time period."""
 	
 	if sPeriod == 'persecond':
-		sDir = pjoin(sCacheRoot, sDsdf, sNormParam, sRes,
+		sDir = pjoin(sLevelDir,
 			     "%04d"%dtBeg.year(),"%02d"%dtBeg.month(),
 			     "%02d"%dtBeg.dom(),"%02d"%dtBeg.hour(),  
 			     "%02d"%dtBeg.minute())
@@ -239,7 +248,7 @@ def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False):
 			
 
 	elif sPeriod == 'perminute':
-		sDir = pjoin(sCacheRoot, sDsdf, sNormParam, sRes,
+		sDir = pjoin(sLevelDir,
 			     "%04d"%dtBeg.year(),"%02d"%dtBeg.month(),
 			     "%02d"%dtBeg.dom(),"%02d"%dtBeg.hour())
 
@@ -248,7 +257,7 @@ def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False):
 			dtBeg.minute(), sRes, sExt)
 
 	elif sPeriod == 'hourly':
-		sDir = pjoin(sCacheRoot, sDsdf, sNormParam, sRes, 
+		sDir = pjoin(sLevelDir, 
 		             "%04d"%dtBeg.year(),"%02d"%dtBeg.month(),
 		             "%02d"%dtBeg.dom())
 		
@@ -257,14 +266,14 @@ def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False):
 				  sRes, sExt)
 									  				
 	elif sPeriod == 'daily':
-		sDir = pjoin(sCacheRoot, sDsdf, sNormParam, sRes, 
+		sDir = pjoin(sLevelDir, 
 		             "%04d"%dtBeg.year(),"%02d"%dtBeg.month())
 		
 		sFile = "%04d-%02d-%02d_%s.%s"%(dtBeg.year(),
 		        dtBeg.month(), dtBeg.dom(), sRes, sExt)
 				
 	elif sPeriod == 'monthly':
-		sDir = pjoin(sCacheRoot, sDsdf, sNormParam, sRes, 
+		sDir = pjoin(sLevelDir, 
 		             "%04d"%dtBeg.year())
 		
 		sFile = "%04d-%02d_%s.%s"%(dtBeg.year(), dtBeg.month(),
@@ -274,22 +283,405 @@ def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False):
 
 	return (sDir, sFile)
 
+
+def getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg, bCoverage=False,
+                 sCompress=None):
+	"""Get the (directory, file name) for a cache block.  If sCompress is
+	one of the compression modes in g_dCompress the name has the matching
+	suffix.  Blocks may be on disk in any form, see findBlock().
+	"""
+	
+	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
+	
+	sExt = 'd2s'
+	if dsdf[u'qstream']:
+		sExt = 'qds'
+	
+	(sDir, sFile) = _periodPath(getLevelDir(dConf, dsdf, sNormParam, nLevel),
+	                            sPeriod, dtBeg, _resStub(dsdf, nLevel), sExt)
+
+	if sCompress != None:
+		sFile += g_dCompress[sCompress][0]
+
+	return (sDir, sFile)
+
+
+# Present in a level directory once blocks have been stored compressed or
+# in containers, forms that only the in-process cache reader can open.
+# Missing blocks of such a level are not taken from the block index when
+# an external reader is used, see levelMissList().
+NATIVE_MARK = '_native'
+
+def _findFile(dConf, dsdf, sNormParam, nLevel, dtBeg, bNative):
+	(sDir, sFile) = getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg)
+	
+	# Only the in-process reader understands compressed blocks
+	if not bNative:
+		sPath = pjoin(sDir, sFile)
+		return sPath if os.path.isfile(sPath) else None
+	
+	# Try the form new blocks of the level are written in first, most
+	# blocks will be in it.  Imported here since the reader module needs
+	# this one.
+	from . import cacherdr
+	try:
+		sMode = cacherdr.compression(dConf, dsdf, nLevel)
+	except E.ServerError:
+		sMode = None
+	lExt = ('',) + BI.COMPRESS_EXT
+	if sMode != None:
+		sFirst = g_dCompress[sMode][0]
+		lExt = (sFirst,) + tuple([sExt for sExt in lExt if sExt != sFirst])
+	
+	for sExt in lExt:
+		sPath = pjoin(sDir, sFile + sExt)
+		if os.path.isfile(sPath):
+			return sPath
+	return None
+
+
+def findBlock(dConf, dsdf, sNormParam, nLevel, dtBeg, dPacks=None,
+              bNative=None):
+	"""Get the path to a cache block as stored on disk, compressed or not,
+	or None if the block is not present.  For blocks kept in a container the
+	container's path is returned, see getPackPath().
+
+	dPacks - Optional dictionary of container slot tables by path.  Pass the
+	   same one when looking up many blocks so each container is read once.
+	
+	bNative - If false only uncompressed block files are found, not blocks
+	   in containers.  These are the only ones an external cache reader can
+	   open.  The default is to find every form if cacherdr.canRead() is
+	   true for the data source.
+	"""
+	if bNative == None:
+		# Imported here since the reader module needs this one
+		from . import cacherdr
+		bNative = cacherdr.canRead(dConf, dsdf)
+	
+	if (dsdf['cacheLevel'][nLevel][2] not in g_dPacking) or (not bNative):
+		return _findFile(dConf, dsdf, sNormParam, nLevel, dtBeg, bNative)
+	
+	# Look where new blocks go first, the level may have been switched
+	# between single files and containers
+	if isPacked(dConf, dsdf, nLevel):
+		sPath = _findPacked(dConf, dsdf, sNormParam, nLevel, dtBeg, dPacks)
+		if sPath == None:
+			sPath = _findFile(dConf, dsdf, sNormParam, nLevel, dtBeg, bNative)
+	else:
+		sPath = _findFile(dConf, dsdf, sNormParam, nLevel, dtBeg, bNative)
+		if sPath == None:
+			sPath = _findPacked(dConf, dsdf, sNormParam, nLevel, dtBeg, dPacks)
+	return sPath
+
+
+def dropVariants(sPath):
+	"""Remove any other forms of the cache block just written to sPath, left
+	over from when the block was stored with a different compression mode"""
+	sBase = sPath
+	for sExt in BI.COMPRESS_EXT:
+		if sPath.endswith(sExt):
+			sBase = sPath[:-len(sExt)]
+	lOther = [sBase + sExt for sExt in ('',) + BI.COMPRESS_EXT]
+	if sBase != sPath:
+		lOther.append(sBase + BI.TIX_EXT)
+	for sOther in lOther:
+		if sOther != sPath:
+			try:
+				os.remove(sOther)
+			except OSError:
+				pass
+
 ##############################################################################
+# Packed blocks, see blkpack.py
+
+# Container period and number of blocks per container for each storage
+# period that can be packed
+g_dPacking = {
+	'persecond': ('hourly', 3600),
+	'perminute': ('daily', 1440)
+}
+
+def isPacked(dConf, dsdf, nLevel):
+	"""True if new blocks for a cache level go into container files.  This is
+	set by the DSDF keyword cachePack, or else the server setting CACHE_PACK,
+	and only applies to levels stored persecond or perminute.  Containers
+	are only understood by the in-process cache reader, so blocks of data
+	sources it can't read are never packed.
+	"""
+	if dsdf['cacheLevel'][nLevel][2] not in g_dPacking:
+		return False
+	
+	if u'cachePack' in dsdf:
+		bPack = M.isTrue(u'cachePack', dsdf)
+	else:
+		bPack = M.isTrue('CACHE_PACK', dConf)
+	if not bPack:
+		return False
+	
+	# Imported here since the reader module needs this one
+	from . import cacherdr
+	return cacherdr.canRead(dConf, dsdf)
 
-def missList(fLog, dConf, dsdf, sNormParam, rRes, sBeg, sEnd, bCoverage=True):
-	"""Get a list of all block periods that are not present in the disk
-	cache for a particular dataset.  Arguments are:
 
-	  rRes - The resolution in seconds (may be fractional seconds)
+def getPackPath(dConf, dsdf, sNormParam, nLevel, dtBeg):
+	"""Get the container that holds a block of a persecond or perminute
+	cache level.
 	
-	Return value is a list of the following tuples:
+	Returns the tuple (directory, file name, slot, number of slots)
+	"""
+	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
+	(sPackPeriod, nSlots) = g_dPacking[sPeriod]
 	
-	     (sBegIdx, sEndIdx, nCacheLevel)
-		  
-	Here sBegIdx and sEndIdx are times, but when we move to Das 2.3 they
-	will need to be a general index.
+	(sDir, sFile) = _periodPath(getLevelDir(dConf, dsdf, sNormParam, nLevel),
+	                            sPackPeriod, dtBeg, _resStub(dsdf, nLevel), 'd2s')
+	
+	if sPeriod == 'persecond':
+		iSlot = dtBeg.minute()*60 + int(dtBeg.sec())
+	else:
+		iSlot = dtBeg.hour()*60 + dtBeg.minute()
+	
+	return (sDir, sFile + PK.PACK_EXT, iSlot, nSlots)
+
+
+def _findPacked(dConf, dsdf, sNormParam, nLevel, dtBeg, dPacks):
+	(sDir, sFile, iSlot, nSlots) = getPackPath(dConf, dsdf, sNormParam,
+	                                           nLevel, dtBeg)
+	sPath = pjoin(sDir, sFile)
+	if dPacks == None:
+		dPacks = {}
+	if sPath not in dPacks:
+		dPacks[sPath] = PK.readTable(sPath)
+	
+	lTable = dPacks[sPath]
+	if (lTable != None) and (iSlot < len(lTable)) and (lTable[iSlot][0] > 0):
+		return sPath
+	return None
+
+
+def storePacked(dConf, dsdf, sNormParam, nLevel, dtBeg, sTmp):
+	"""Move a newly written block file into it's container.  The file is
+	removed, as are any copies of the block stored as a single file.
+
+	Returns the container path.
+	"""
+	(sDir, sFile, iSlot, nSlots) = getPackPath(dConf, dsdf, sNormParam,
+	                                           nLevel, dtBeg)
+	if not os.path.isdir(sDir):
+		os.makedirs(sDir)
+	sPath = pjoin(sDir, sFile)
+	try:
+		PK.put(sPath, nSlots, iSlot, sTmp)
+	finally:
+		os.remove(sTmp)
+	
+	(sDir, sFile) = getBlockPath(dConf, dsdf, sNormParam, nLevel, dtBeg)
+	for sExt in ('', BI.TIX_EXT) + BI.COMPRESS_EXT:
+		try:
+			os.remove(pjoin(sDir, sFile + sExt))
+		except OSError:
+			pass
+	
+	return sPath
+
+##############################################################################
+# Compressed blocks
+
+# File name suffix, compressor and decompressor for each compression mode.
+# The zstandard module is used for zstd if it is installed, otherwise the
+# zstd program is run.
+g_dCompress = {
+	'gzip': ('.gz',  ['gzip', '-c'], ['gzip', '-d', '-c']),
+	'zstd': ('.zst', ['zstd', '-q', '-c'], ['zstd', '-d', '-q', '-c'])
+}
+
+# Errors that mean a compressed block is damaged
+g_tBlockErrors = (IOError, OSError, EOFError)
+if g_bHaveZstd:
+	g_tBlockErrors += (zstandard.ZstdError,)
+
+def compressCmd(sMode):
+	"""Get the filter command that compresses a block for a mode"""
+	return g_dCompress[sMode][1]
+
+
+class _FilterFile(object):
+	"""File like access to a block through a (de)compression program"""
+
+	def __init__(self, lCmd, sPath, bWrite):
+		self.sCmd = ' '.join(lCmd)
+		self.bEof = False
+		if bWrite:
+			self.fFile = open(sPath, 'wb')
+			self.proc = subprocess.Popen(
+				lCmd, stdin=subprocess.PIPE, stdout=self.fFile, close_fds=True
+			)
+			self.fPipe = self.proc.stdin
+		else:
+			self.fFile = open(sPath, 'rb')
+			self.proc = subprocess.Popen(
+				lCmd, stdin=self.fFile, stdout=subprocess.PIPE, close_fds=True
+			)
+			self.fPipe = self.proc.stdout
+		self.bWrite = bWrite
+
+	def read(self, nSize):
+		xData = self.fPipe.read(nSize)
+		if len(xData) == 0:
+			self.bEof = True
+		return xData
+
+	def write(self, xData):
+		self.fPipe.write(xData)
+
+	def close(self):
+		if self.proc == None:
+			return
+		self.fPipe.close()
+		nRet = self.proc.wait()
+		self.fFile.close()
+		self.proc = None
+
+		# Readers that stop early kill the decompressor with SIGPIPE
+		if (nRet != 0) and (self.bWrite or self.bEof):
+			raise IOError("%s exited with status %d"%(self.sCmd, nRet))
+
+
+def _mode(sPath):
+	for sMode in g_dCompress:
+		if sPath.endswith(g_dCompress[sMode][0]):
+			return sMode
+	return None
+
+
+def openBlock(sPath):
+	"""Open a cache block for reading, decompressing as it's read if the
+	file name has a compression suffix.  Returns a file like object with
+	read() and close() methods.
+	"""
+	sMode = _mode(sPath)
+	if sMode == 'gzip':
+		return gzip.open(sPath, 'rb')
+	if sMode == 'zstd':
+		if g_bHaveZstd:
+			return zstandard.ZstdDecompressor().stream_reader(open(sPath, 'rb'))
+		return _FilterFile(g_dCompress[sMode][2], sPath, False)
+	return open(sPath, 'rb')
+
+
+def createBlock(sPath, sMode=None):
+	"""Create a cache block file, compressing everything written to it with
+	the given mode.  Returns a file like object with write() and close()
+	methods, close() raises IOError if the data couldn't be saved.
+	"""
+	if sMode == 'gzip':
+		return gzip.open(sPath, 'wb')
+	if sMode == 'zstd':
+		if g_bHaveZstd:
+			return zstandard.ZstdCompressor().stream_writer(open(sPath, 'wb'))
+		return _FilterFile(g_dCompress[sMode][1], sPath, True)
+	return open(sPath, 'wb')
+
+##############################################################################
+def levelRes(dsdf, nLevel):
+	"""Get the resolution of a cache level in seconds, 0.0 for intrinsic"""
+	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
+	rRes = float(nRes)
+	if (nRes != 0) and \
+	   sUnits.lower() in ('ms','millisec','millisecond','milliseconds'):
+		rRes /= 1000.0
+	return rRes
+
+
+def blockPipe(dsdf, nLevel, sBeg, sEnd, dConf=None, nFromLevel=None,
+              bFed=False):
+	"""Make the reader | reducer pipeline that produces data for cache level
+	nLevel over [sBeg, sEnd).  sBeg should be on a block boundary so that
+	the reducer's bins line up with the blocks.
+	
+	If nFromLevel is given the data are re-binned from that, finer, cache
+	level using the data source's cache reader instead of running the
+	reader.  dConf is required in that case.  If bFed is also True the
+	cache reader is left off, the caller supplies the finer level's stream
+	on the pipeline's input, see cacherdr.CacheReader.feed().
+	"""
+	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
+	
+	if bFed:
+		pipe = P.Pipeline()
+	elif nFromLevel != None:
+		# Same arguments as for a cache hit, see dsdfDataset.py
+		pipe = P.Pipeline(
+			dsdf[u'cacheReader'], dsdf.sPath, 
+			pjoin(dConf['CACHE_ROOT'], 'data', dsdf.sName),
+			D.normalizeParams(sParams), sBeg, sEnd,
+			"%.5e"%levelRes(dsdf, nFromLevel)
+		)
+	else:
+		pipe = P.Pipeline(dsdf[u'reader'], sBeg, sEnd, *P.split(sParams))
+	
+	if nRes != 0:
+		pipe.add(dsdf[u'reducer'], '-b', sBeg, '%f'%levelRes(dsdf, nLevel))
+	
+	return pipe
+
+
+def sourceLevel(fLog, dConf, dsdf, nLevel, sBeg, sEnd):
+	"""Find a finer cache level that cache level nLevel can be re-binned
+	from over [sBeg, sEnd).  The candidate levels have the same parameters,
+	and are either intrinsic or have a resolution that evenly divides the
+	resolution of nLevel.  The finest such level with every block in the
+	range already on disk is returned, or None if there isn't one.
+	"""
+	rRes = levelRes(dsdf, nLevel)
+	if rRes == 0.0:
+		return None
+	
+	sNormParam = D.normalizeParams(dsdf['cacheLevel'][nLevel][3])
+	
+	lCand = []
+	for nCand in dsdf['cacheLevel']:
+		if nCand == nLevel:
+			continue
+		if D.normalizeParams(dsdf['cacheLevel'][nCand][3]) != sNormParam:
+			continue
+		rCand = levelRes(dsdf, nCand)
+		if rCand >= rRes:
+			continue
+		if rCand > 0.0:
+			rRatio = rRes / rCand
+			if abs(rRatio - round(rRatio)) > 1e-6:
+				continue
+		lCand.append( (rCand, nCand) )
+	
+	lCand.sort()
+	for (rCand, nCand) in lCand:
+		if len(levelMissList(fLog, dConf, dsdf, sNormParam, nCand, sBeg, sEnd)) == 0:
+			return nCand
+	
+	return None
+
+
+def buildJobs(dConf):
+	"""Get the number of blocks a cache build task may write at once, from
+	the server setting CACHE_BUILD_JOBS, default 1"""
+	if 'CACHE_BUILD_JOBS' not in dConf:
+		return 1
+	try:
+		nJobs = int(dConf['CACHE_BUILD_JOBS'], 10)
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key CACHE_BUILD_JOBS to an integer"%(
+			dConf['CACHE_BUILD_JOBS'])
+		)
+	return max(nJobs, 1)
+
+##############################################################################
+def getUseLevel(dsdf, sNormParam, rRes):
+	"""Get the cache level to read for a parameter set and resolution.  This
+	is the coarsest level that is not coarser than rRes, or the finest level
+	if they all are.
 	"""
-		
 	# Rank levels that match our normalized parameter string in order from
 	# highest resolution to lowest (lowest rRes to highest rRes) .
 	dRes = {}
@@ -302,7 +694,7 @@ def missList(fLog, dConf, dsdf, sNormParam, rRes, sBeg, sEnd, bCoverage=True):
 			dRes[fRes] = nLevel
 	
 	if len(dRes) == 0:
-		raise E.ServerError("missList called for data that are not cacheable")
+		raise E.ServerError("No cache levels for data with parameters %s"%sNormParam)
 	
 	lRes = list(dRes.keys())
 	lRes.sort()
@@ -313,50 +705,186 @@ def missList(fLog, dConf, dsdf, sNormParam, rRes, sBeg, sEnd, bCoverage=True):
 			break
 		iRes += 1
 	
-#	fLog.write("dRes: %s"%dRes)
+	return dRes[lRes[iRes]]
+
+
+def missList(fLog, dConf, dsdf, sNormParam, rRes, sBeg, sEnd, bCoverage=True):
+	"""Get a list of all block periods that are not present in the disk
+	cache for a particular dataset.  The level's block index is used if
+	present, otherwise each block file is checked.  Arguments are:
+
+	  rRes - The resolution in seconds (may be fractional seconds)
 	
-	nUseLevel = dRes[lRes[iRes]]
+	Return value is a list of the following tuples:
+	
+	     (sBegIdx, sEndIdx, nCacheLevel)
+		  
+	Here sBegIdx and sEndIdx are times, but when we move to Das 2.3 they
+	will need to be a general index.
+	"""
+	nUseLevel = getUseLevel(dsdf, sNormParam, rRes)
+	return levelMissList(fLog, dConf, dsdf, sNormParam, nUseLevel, sBeg, sEnd)
+
+
+def levelMissList(fLog, dConf, dsdf, sNormParam, nUseLevel, sBeg, sEnd):
+	"""Same as missList, but for a given cache level instead of the level
+	that best matches a resolution."""
 	
 	(dtBeg, tAdj, dtEnd) = snapToTimeBlks(fLog, dsdf, sBeg, sEnd, nUseLevel)
 	
-	lMissing = []
-	while dtBeg < dtEnd:
-		#fLog.write(" tAdj = %s\n"%str(tAdj))
-		#fLog.write(  "   Checking for: %s %s %s"%(dsdf.sName, sNormParam, dtBeg))
-		(sDir, sFile) = getBlockPath(dConf, dsdf, sNormParam, nUseLevel, dtBeg)
-		#fLog.write(" Need cache block %s/%s"%(sDir, sFile))
-		dtEndBlk = dtBeg.copy()
-		dtEndBlk.adjust(tAdj[0],tAdj[1],tAdj[2],tAdj[3],tAdj[4],tAdj[5])
-		#fLog.write(" dtEndBlk = %s"%str(dtEndBlk))
-		
-		if not os.path.isfile(pjoin(sDir, sFile)):
-			# Trim  the time strings based on the period
-			nSz = 10
-			if dsdf['cacheLevel'][nUseLevel][2] == 'hourly':
-				nSz = 16
-			elif dsdf['cacheLevel'][nUseLevel][2] == 'perminute':
-				nSz = 16
-			elif dsdf['cacheLevel'][nUseLevel][2] == 'persecond':
-				nSz = 19
-			lMissing.append( (str(dtBeg)[:nSz], str(dtEndBlk)[:nSz], nUseLevel) )
-		
-		dtBeg = dtEndBlk
+	# Trim  the time strings based on the period
+	nSz = 10
+	if dsdf['cacheLevel'][nUseLevel][2] == 'hourly':
+		nSz = 16
+	elif dsdf['cacheLevel'][nUseLevel][2] == 'perminute':
+		nSz = 16
+	elif dsdf['cacheLevel'][nUseLevel][2] == 'persecond':
+		nSz = 19
+	
+	sLevelDir = getLevelDir(dConf, dsdf, sNormParam, nUseLevel)
+	sBegKey = BI.timeKey(dtBeg)
+	sEndKey = BI.timeKey(dtEnd)
+	
+	def blocksIn(sSpanBeg, sSpanEnd):
+		lOut = []
+		dtBlk = das2.DasTime(sSpanBeg)
+		dtSpanEnd = das2.DasTime(sSpanEnd)
+		while dtBlk < dtSpanEnd:
+			dtEndBlk = dtBlk.copy()
+			dtEndBlk.adjust(tAdj[0],tAdj[1],tAdj[2],tAdj[3],tAdj[4],tAdj[5])
+			lOut.append( (str(dtBlk)[:nSz], str(dtEndBlk)[:nSz], nUseLevel) )
+			dtBlk = dtEndBlk
+		return lOut
+	
+	# Use the block index if there is one, only the uncovered stretches then
+	# need to be walked block by block, and none at all on a full hit.
+	lIdx = BI.read(sLevelDir)
+	
+	# The index doesn't say how blocks are stored.  If the level has blocks
+	# only the in-process reader can open, and it can't be used now, each
+	# block has to be looked for as a plain file.
+	from . import cacherdr
+	bNative = cacherdr.canRead(dConf, dsdf)
+	if (not bNative) and os.path.exists(pjoin(sLevelDir, NATIVE_MARK)):
+		lIdx = None
+	
+	if lIdx != None:
+		lMissing = []
+		for (sGapBeg, sGapEnd) in BI.gaps(lIdx, sBegKey, sEndKey):
+			lMissing += blocksIn(sGapBeg, sGapEnd)
+	
+	else:
+		lMissing = []
+		dPacks = {}
+		while dtBeg < dtEnd:
+			#fLog.write(" tAdj = %s\n"%str(tAdj))
+			#fLog.write(  "   Checking for: %s %s %s"%(dsdf.sName, sNormParam, dtBeg))
+			dtEndBlk = dtBeg.copy()
+			dtEndBlk.adjust(tAdj[0],tAdj[1],tAdj[2],tAdj[3],tAdj[4],tAdj[5])
+			#fLog.write(" dtEndBlk = %s"%str(dtEndBlk))
 			
+			if findBlock(dConf, dsdf, sNormParam, nUseLevel, dtBeg, dPacks,
+			             bNative) == None:
+				lMissing.append( (str(dtBeg)[:nSz], str(dtEndBlk)[:nSz], nUseLevel) )
+			
+			dtBeg = dtEndBlk
+	
+	# Blocks made by an older reader, reducer or DSDF have to be made again
+	lGens = MF.read(sLevelDir)
+	if not lGens:
+		return lMissing
+	try:
+		sDigest = MF.fingerprint(dConf, dsdf, nUseLevel)[0]
+	except (IOError, OSError) as e:
+		fLog.write("WARNING: Can't check cache blocks in %s are current, %s"%(
+		           sLevelDir, e))
+		return lMissing
+	
+	lStale = MF.stale(lGens, sDigest, sBegKey, sEndKey)
+	if len(lStale) > 0:
+		fLog.write("   Cache check: Blocks in %d spans were made by an older "%len(lStale)+\
+		           "DSDF or reader, treating them as missing")
+		setHave = set([t[0] for t in lMissing])
+		for (sStaleBeg, sStaleEnd) in lStale:
+			lMissing += [t for t in blocksIn(sStaleBeg, sStaleEnd) if t[0] not in setHave]
+		lMissing.sort()
+	
 	return lMissing
 
-##############################################################################
-
-# 
-# From user 'tgambin' at StackOverflow --Thanks!
-def find_nth(haystack, needle, n):
-    start = haystack.find(needle)
-    while start >= 0 and n > 1:
-        start = haystack.find(needle, start+len(needle))
-        n -= 1
-    return start
+def indexBlock(fLog, dConf, dsdf, sNormParam, nLevel, dtBeg, dtEnd, tAdj,
+               tSum=None):
+	"""Record a newly written cache block in the level's block index and
+	manifest.  tAdj is the block step tuple from snapToTimeBlks, tSum is
+	the (size, CRC-32) of the block file from manifest.checksum().  Index
+	problems are logged but not raised, missList falls back to looking for
+	block files if the index is missing.
+	"""
+	sLevelDir = getLevelDir(dConf, dsdf, sNormParam, nLevel)
+	try:
+		BI.addBlock(sLevelDir, tAdj, dtBeg, dtEnd)
+	except (IOError, OSError) as e:
+		fLog.write("WARNING: Couldn't update block index in %s, %s"%(sLevelDir, e))
+		try:
+			os.remove(pjoin(sLevelDir, BI.INDEX_NAME))
+		except OSError:
+			pass
+	
+	try:
+		MF.addBlock(sLevelDir, MF.fingerprint(dConf, dsdf, nLevel),
+		            BI.timeKey(dtBeg), BI.timeKey(dtEnd), tSum)
+	except (IOError, OSError) as e:
+		fLog.write("WARNING: Couldn't update cache manifest in %s, %s"%(sLevelDir, e))
+	
+	_markNative(fLog, dConf, dsdf, sLevelDir, nLevel)
+
+def _markNative(fLog, dConf, dsdf, sLevelDir, nLevel):
+	"""Leave NATIVE_MARK in a level directory if new blocks are stored
+	compressed or in containers"""
+	# Imported here since the reader module needs this one
+	from . import cacherdr
+	try:
+		bNative = isPacked(dConf, dsdf, nLevel) or \
+		          (cacherdr.compression(dConf, dsdf, nLevel) != None)
+	except E.ServerError:
+		bNative = False
+	sMark = pjoin(sLevelDir, NATIVE_MARK)
+	if (not bNative) or os.path.exists(sMark):
+		return
+	try:
+		open(sMark, 'a').close()
+	except (IOError, OSError) as e:
+		fLog.write("WARNING: Couldn't mark %s as holding compressed or packed blocks, %s"%(
+		           sLevelDir, e))
+
+def touchBlocks(fLog, dConf, dsdf, sNormParam, nLevel, sBeg, sEnd):
+	"""Mark the blocks of a cache level that cover [sBeg, sEnd) as just
+	read, so that they are the last to be evicted.  Used when an external
+	cache reader answers a request, the in-process reader marks the blocks
+	it sends itself.
+	"""
+	(dtBeg, tAdj, dtEnd) = snapToTimeBlks(fLog, dsdf, sBeg, sEnd, nLevel)
+	
+	# Blocks marked by a recent request are skipped, repeated hits on the
+	# same range then don't cost a stat() per block
+	sLevelDir = getLevelDir(dConf, dsdf, sNormParam, nLevel)
+	lGaps = EV.untouched(sLevelDir, BI.timeKey(dtBeg), BI.timeKey(dtEnd))
+	
+	dPacks = {}
+	setDone = set()
+	for (sGapBeg, sGapEnd) in lGaps:
+		dtBlk = das2.DasTime(sGapBeg)
+		dtGapEnd = das2.DasTime(sGapEnd)
+		while dtBlk < dtGapEnd:
+			sPath = findBlock(dConf, dsdf, sNormParam, nLevel, dtBlk, dPacks)
+			if (sPath != None) and (sPath not in setDone):
+				EV.touch(sPath)
+				setDone.add(sPath)
+			dtBlk.adjust(tAdj[0],tAdj[1],tAdj[2],tAdj[3],tAdj[4],tAdj[5])
 
+##############################################################################
 
-def reqCacheBuild(fLog, dConf, sDsdf, lToBuild, bCoverage=False):
+def reqCacheBuild(fLog, dConf, sDsdf, lToBuild, bCoverage=False,
+                  sLane=T.LANE_INTERACTIVE):
 	"""
 	Request that one or more cache areas be built (or rebuilt)
 	
@@ -365,10 +893,10 @@ def reqCacheBuild(fLog, dConf, sDsdf, lToBuild, bCoverage=False):
 	
 	   (sBeg, sEnd, nCacheLevel)
 		
-	For each tuple if the job is already listed in das2_todo, it's not
-	re-added.  This isn't a complete solution since jobs are likely 
-	in the process of being worked on, but it least this means we won't
-	sumbit more duplicate jobs than there are worker processes
+	For each tuple if the job is already waiting in the todo queue, it's not
+	re-added, see task.submitTask().  Jobs that are being worked on may
+	still be submitted again.  Builds go in the interactive lane by default
+	since they are usually needed by someone waiting for data.
 	"""
 	# Try to get the broker, if you can't just ignore the request
 	broker = T.getBroker(fLog, dConf)
@@ -376,16 +904,6 @@ def reqCacheBuild(fLog, dConf, sDsdf, lToBuild, bCoverage=False):
 		fLog.write("   WARNING: Work queue unreachable, dropping cache request")
 		return
 		
-	# See what jobs are aready on the build list, only need to compare against
-	# the Job-Type, DSDF, Start, Stop and Level keys.
-	lTmp = broker.lrange('das2_todo', 0, 1)
-	lWaiting = []
-	for sTmp in lTmp:
-		if sTmp.find('TASK_CACHE') > -1:
-			i = find_nth(sTmp, '|', CACHE_FIELDS.DATASET)
-			if i > -1:
-				lWaiting.append( sTmp[i+1:] ) 
-		
 	for (sBeg, sEnd, nLevel) in lToBuild:
 	
 		lTask = ['']*CACHE_FIELDS.LEN_INITAL
@@ -408,18 +926,40 @@ def reqCacheBuild(fLog, dConf, sDsdf, lToBuild, bCoverage=False):
 		lTask[CACHE_FIELDS.END] = sEnd
 		lTask[CACHE_FIELDS.LEVEL] = "%d"%nLevel
 		
-		sJobId = '|'.join(lTask[CACHE_FIELDS.DATASET:])
-		if sJobId in lWaiting:
-			fLog.write('   Cache miss: Job %s already in queue, dropping cache request'%sJobId)
-			return 			
-		
 		lTask[0] = T.curTime()
 		sTask = '|'.join(lTask)
 		
 		try:
-			broker.lpush('das2_todo', sTask)
+			if not T.submitTask(broker, sTask, sLane):
+				fLog.write('   Cache miss: Job %s already in queue, dropping cache request'%(
+				           '|'.join(lTask[CACHE_FIELDS.DATASET:])))
 		except E.ServerError as e:
 			fLog.write('ERROR: %s'%str(e))
 	
 	return None
 
+
+def reqEvict(fLog, dConf, sDsdf=None):
+	"""Request an eviction pass over the disk cache.  Nothing is queued if
+	an eviction task is already waiting.
+
+	sDsdf - If not None only this data source's quota is checked
+	"""
+	broker = T.getBroker(fLog, dConf)
+	if broker == None:
+		fLog.write("   WARNING: Work queue unreachable, dropping eviction request")
+		return
+
+	lTask = ['']*T.JOB_FIELDS.CATEGORY + ['TASK_CACHE_EVICT']
+	if sDsdf != None:
+		lTask.append(sDsdf)
+
+	try:
+		if sys.platform.lower().startswith('win'):
+			lTask[T.JOB_FIELDS.USER] = os.environ['USERNAME']
+		else:
+			lTask[T.JOB_FIELDS.USER] = pwd.getpwuid( os.getuid() )[0]
+		lTask[T.JOB_FIELDS.REQ_TIME] = T.curTime()
+		T.submitTask(broker, '|'.join(lTask))
+	except E.ServerError as e:
+		fLog.write('ERROR: %s'%str(e))
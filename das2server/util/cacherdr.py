@@ -0,0 +1,1029 @@
+"""In-process reader for das2 stream cache blocks
+
+Cache hits used to be answered by running an external cache reader program.
+For das2 streams the work is simple enough to do here: each block file for
+the requested range is opened in time order, the stream header is sent
+once, packet headers are only sent when they change, and data packets in
+the first and last block are trimmed to the requested time range.  Runs of
+packets that pass through unchanged are handed to webio.sendFile() so the
+kernel can copy them without them passing through python.  Large blocks
+have a time index sidecar, see writeTimeIndex(), so that only the part of
+the first and last block inside the range has to be scanned.
+
+When only some blocks are on disk, the reader pipeline is run for the
+missing stretches and its output is merged into the same stream.  Blocks
+stored compressed are decompressed as they are read, runs of blocks kept
+in a container file are read with one seek.  For requests that
+need a format conversion the stream is fed into the converter pipeline
+instead of being sent to the client, see CacheReader.feed().  QStreams
+still go through the external reader.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import time
+import mmap
+import select
+import struct
+import calendar
+import threading
+from bisect import bisect_left
+from os.path import join as pjoin
+import xml.etree.ElementTree as ET
+
+import das2
+
+from . import webio
+from . import cache as C
+from . import evict as EV
+from . import errors as E
+from . import blkindex as BI
+from . import blkpack as PK
+from . import manifest as MF
+from . import nodata as ND
+
+# Kept runs at least this long are sent by sendFile instead of a write
+SENDFILE_MIN = 65536
+
+# Read size for compressed blocks
+INFLATE_READ_SZ = 65536
+
+# Blocks at least this big get a time index sidecar, with an entry about
+# every TIX_STRIDE bytes
+TIX_MIN = 262144
+TIX_STRIDE = 65536
+
+##############################################################################
+# Time conversion, everything is compared as seconds since 2000-01-01
+
+T2000_EPOCH_1970 = 946684800.0
+
+def _t2000(dt):
+	"""Seconds since 2000-01-01 for a DasTime"""
+	rSec = dt.sec()
+	nSec = calendar.timegm( (dt.year(), dt.month(), dt.dom(), dt.hour(),
+	                         dt.minute(), 0, 0, 0, 0) )
+	return nSec - T2000_EPOCH_1970 + rSec
+
+def _isoT2000(xTime):
+	"""Seconds since 2000-01-01 for an ISO time in bytes"""
+	return _t2000(das2.DasTime(xTime.decode('ascii').strip()))
+
+# Units to (scale, offset) giving t2000 = value * scale + offset
+g_dUnits = {
+	'us2000': (1.0e-6, 0.0),
+	't2000':  (1.0, 0.0),
+	'mj1958': (86400.0, -15340.0 * 86400.0),
+	't1970':  (1.0, -T2000_EPOCH_1970),
+	'ms1970': (1.0e-3, -T2000_EPOCH_1970),
+	'ns1970': (1.0e-9, -T2000_EPOCH_1970),
+}
+
+# Binary value types to struct formats
+g_dBinTypes = {
+	'sun_real8': '>d', 'sun_real4': '>f',
+	'little_endian_real8': '<d', 'little_endian_real4': '<f',
+}
+
+##############################################################################
+class PacketDef(object):
+	"""The parts of a das2 packet header needed to step over data packets
+	and find their time values"""
+
+	def __init__(self, sPath, xHdr):
+		try:
+			elPkt = ET.fromstring(xHdr)
+		except ET.ParseError as e:
+			raise E.ServerError("Bad packet header in cache block %s, %s"%(sPath, e))
+
+		self.nSize = 0
+		self.fTime = None
+		for el in elPkt:
+			sType = el.get('type', '')
+			i = len(sType)
+			while i > 0 and sType[i-1].isdigit():
+				i -= 1
+			if i == len(sType):
+				raise E.ServerError(
+					"Unknown value type '%s' in cache block %s"%(sType, sPath)
+				)
+			nItems = 1
+			if el.tag == 'yscan':
+				nItems = int(el.get('nitems', '1'), 10)
+
+			if el.tag == 'x' and self.nSize == 0:
+				self.fTime = self._timeFunc(sType, int(sType[i:], 10),
+				                            el.get('units', ''))
+
+			self.nSize += int(sType[i:], 10) * nItems
+
+	def _timeFunc(self, sType, nSz, sUnits):
+		"""Get a function that converts the start of a data packet body to
+		seconds since 2000, or None if the x values can't be understood"""
+		if sType.startswith('time'):
+			return lambda xBuf, iOff: _isoT2000(xBuf[iOff:iOff+nSz])
+
+		if sUnits not in g_dUnits:
+			return None
+		(rScale, rOffset) = g_dUnits[sUnits]
+
+		if sType in g_dBinTypes:
+			sFmt = g_dBinTypes[sType]
+			return lambda xBuf, iOff: \
+			       struct.unpack_from(sFmt, xBuf, iOff)[0] * rScale + rOffset
+
+		if sType.startswith('ascii'):
+			return lambda xBuf, iOff: float(xBuf[iOff:iOff+nSz]) * rScale + rOffset
+
+		return None
+
+##############################################################################
+class CacheReader(object):
+	"""Sends a range of das2 stream cache blocks to standard output.
+
+	If some blocks are missing, setGaps() arranges for a reader pipeline to
+	be run for each stretch of missing blocks, and it's output is merged into
+	the stream in time order.
+
+	After send() returns, or raises, these members describe what happened:
+
+	   bHdrSent - True if the HTTP headers have gone out
+	   nSent    - Bytes of message body sent
+	   nBlocks  - Number of block files read
+	   lPipes   - Pipelines run to fill gaps
+	   lWritten - (sBeg, sEnd) of each block saved by write-through
+	   sLimit   - Set if a gap pipeline was stopped by a resource limit
+	   sError   - Set if a feed() thread stopped early
+	"""
+
+	def __init__(self, fLog, dConf, dsdf, sNormParam, rRes, sBeg, sEnd):
+		self.fLog = fLog
+		self.dConf = dConf
+		self.dsdf = dsdf
+		self.sNormParam = sNormParam
+		self.nLevel = C.getUseLevel(dsdf, sNormParam, rRes)
+		self.sBeg = sBeg
+		self.sEnd = sEnd
+
+		self.bHdrSent = False
+		self.nSent = 0
+		self.nBlocks = 0
+		self.lPipes = []
+		self.sLimit = None
+		self.lWritten = []
+		self.sError = None
+		self.fdOut = None     # Output descriptor when feeding a pipeline
+		self.thread = None
+
+		self.fStart = None
+		self.bStreamHdr = False
+		self.nDataPkts = 0
+		self.dSentHdrs = {}
+		self.setMissing = set()
+		self.fMakePipe = None
+		self.bWriteThrough = False
+		self.lBlocks = None
+
+	def setGaps(self, lMissing, fMakePipe, bWriteThrough=False):
+		"""Fill in missing blocks by running pipelines.
+
+		lMissing - The list of (sBeg, sEnd, nLevel) tuples from cache.missList()
+
+		fMakePipe - A function taking begin and end time strings that returns
+		   a pipeline.Pipeline producing a das2 stream for that range
+
+		bWriteThrough - If True the pipelines are run over whole blocks and
+		   their output is saved as cache blocks as well as being sent.  The
+		   pipelines must then produce data for the cache level being read,
+		   see cache.blockPipe().  The blocks saved are listed in lWritten
+		   after send().
+		"""
+		self.setMissing = set([BI.timeKey(das2.DasTime(t[0])) for t in lMissing])
+		self.fMakePipe = fMakePipe
+		self.bWriteThrough = bWriteThrough
+
+	def unwritten(self, lMissing):
+		"""Get the items from a missList() list that were not saved by
+		write-through"""
+		setDone = set([BI.timeKey(das2.DasTime(t[0])) for t in self.lWritten])
+		return [t for t in lMissing if BI.timeKey(das2.DasTime(t[0])) not in setDone]
+
+	def blocks(self):
+		"""Get the list of (path, dtBeg, dtEnd) tuples for the blocks covering
+		the range, in order"""
+		if self.lBlocks != None:
+			return self.lBlocks
+		
+		(dtBlk, tAdj, dtEnd) = C.snapToTimeBlks(
+			self.fLog, self.dsdf, self.sBeg, self.sEnd, self.nLevel
+		)
+		lOut = []
+		dPacks = {}
+		while dtBlk < dtEnd:
+			sPath = C.findBlock(
+				self.dConf, self.dsdf, self.sNormParam, self.nLevel, dtBlk, dPacks
+			)
+			if sPath == None:
+				sPath = pjoin(*C.getBlockPath(
+					self.dConf, self.dsdf, self.sNormParam, self.nLevel, dtBlk
+				))
+			dtBlkEnd = dtBlk.copy()
+			dtBlkEnd.adjust(tAdj[0], tAdj[1], tAdj[2], tAdj[3], tAdj[4], tAdj[5])
+			lOut.append( (sPath, dtBlk, dtBlkEnd) )
+			dtBlk = dtBlkEnd
+		self.lBlocks = lOut
+		return lOut
+
+	def _start(self):
+		if not self.bHdrSent:
+			if self.fStart:
+				self.fStart()
+			self.bHdrSent = True
+
+	def _write(self, xData):
+		if self.fdOut == None:
+			webio.pout(xData)
+			return
+		while len(xData) > 0:
+			xData = xData[os.write(self.fdOut, xData):]
+
+	def _out(self, sPath, xBuf, lRuns):
+		"""Send a list of (offset, end) runs from one block"""
+		for (iBeg, iEnd) in lRuns:
+			self._start()
+			if (sPath != None) and (self.fdOut == None) and \
+			   (iEnd - iBeg >= SENDFILE_MIN):
+				self.nSent += webio.sendFile(sPath, iBeg, iEnd - iBeg)
+			else:
+				self._write(xBuf[iBeg:iEnd])
+				self.nSent += iEnd - iBeg
+
+	def _scan(self, sSrc, xBuf, dDefs, rBeg, rEnd, bPartial=False, tee=None,
+	          iStart=0, iStop=None):
+		"""Work out which parts of a das2 stream buffer to send.  Data packets
+		with time values outside [rBeg, rEnd) are skipped, use None for no
+		trimming.  dDefs holds the packet definitions seen so far in this
+		source.  If bPartial is true the buffer may end part way through a
+		packet.  All packets are also given to the BlockTee object tee, if
+		there is one.  Only the packets from offset iStart up to iStop, or
+		the end of the buffer, are looked at.
+
+		Returns the tuple (runs, stop), where runs is a list of (offset, end)
+		tuples and stop is the offset of the first byte not scanned.
+		"""
+		lRuns = []
+		nLen = len(xBuf)
+		if iStop != None:
+			nLen = iStop
+		i = iStart
+
+		def keep(iBeg, iEnd):
+			if len(lRuns) > 0 and lRuns[-1][1] == iBeg:
+				lRuns[-1] = (lRuns[-1][0], iEnd)
+			else:
+				lRuns.append( (iBeg, iEnd) )
+
+		while i < nLen:
+			xTag = xBuf[i:i+4]
+			if len(xTag) < 4:
+				if bPartial:
+					break
+				raise E.ServerError("Truncated packet in %s"%sSrc)
+
+			# Header and out-of-band packets: [NN]LLLLLL<xml>
+			if xTag[0:1] == b'[':
+				if i + 10 > nLen:
+					if bPartial:
+						break
+					raise E.ServerError("Truncated packet in %s"%sSrc)
+				try:
+					nHdr = int(xBuf[i+4:i+10], 10)
+				except ValueError:
+					raise E.ServerError(
+						"Bad header length at offset %d in %s"%(i, sSrc)
+					)
+				iEnd = i + 10 + nHdr
+				if iEnd > nLen:
+					if bPartial:
+						break
+					raise E.ServerError("Truncated packet in %s"%sSrc)
+				sId = xTag[1:3].decode('ascii')
+
+				if (tee != None) and (sId != 'xx'):
+					tee.header(sId, xBuf[i:iEnd])
+
+				if sId == '00':
+					if not self.bStreamHdr:
+						keep(i, iEnd)
+						self.bStreamHdr = True
+
+				elif sId == 'xx':
+					# Comments and exceptions from the individual block builds
+					# don't mean anything in the combined stream
+					pass
+
+				else:
+					xHdr = xBuf[i+10:iEnd]
+					dDefs[sId] = PacketDef(sSrc, xHdr)
+					if self.dSentHdrs.get(sId) != xHdr:
+						keep(i, iEnd)
+						self.dSentHdrs[sId] = xHdr
+
+				i = iEnd
+				continue
+
+			# Data packets: :NN:<fixed size body>
+			if xTag[0:1] == b':':
+				sId = xTag[1:3].decode('ascii')
+				if sId not in dDefs:
+					raise E.ServerError(
+						"Data packet :%s: before it's header in %s"%(sId, sSrc)
+					)
+				pkt = dDefs[sId]
+				iEnd = i + 4 + pkt.nSize
+				if iEnd > nLen:
+					if bPartial:
+						break
+					raise E.ServerError("Truncated packet in %s"%sSrc)
+
+				bKeep = True
+				rTime = None
+				if (pkt.fTime != None) and \
+				   ((rBeg != None) or (rEnd != None) or (tee != None)):
+					rTime = pkt.fTime(xBuf, i + 4)
+				if tee != None:
+					tee.data(xBuf[i:iEnd], rTime)
+				if rTime != None:
+					if (rBeg != None) and (rTime < rBeg):
+						bKeep = False
+					if (rEnd != None) and (rTime >= rEnd):
+						bKeep = False
+
+				if bKeep:
+					keep(i, iEnd)
+					self.nDataPkts += 1
+				i = iEnd
+				continue
+
+			raise E.ServerError(
+				"Unknown packet tag %r at offset %d in %s"%(xTag, i, sSrc)
+			)
+
+		return (lRuns, i)
+
+	def _sendBlock(self, sPath, dtBeg, nCount, rBeg, rEnd):
+		"""Send a block file, or nCount blocks from a container starting
+		with the one for dtBeg"""
+		if not os.path.isfile(sPath):
+			raise E.ServerError("Cache block %s is missing"%sPath)
+
+		self.nBlocks += nCount
+		EV.touch(sPath)
+		if sPath.endswith(PK.PACK_EXT):
+			return self._sendSlots(sPath, dtBeg, nCount, rBeg, rEnd)
+		if sPath.endswith(BI.COMPRESS_EXT):
+			return self._sendPacked(sPath, rBeg, rEnd)
+		if os.path.getsize(sPath) == 0:
+			return
+
+		sSrc = "cache block %s"%sPath
+		fIn = open(sPath, 'rb')
+		try:
+			tix = None
+			if (rBeg != None) or (rEnd != None):
+				tix = readTimeIndex(sPath, os.fstat(fIn.fileno()))
+			xBuf = mmap.mmap(fIn.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				if tix == None:
+					(lRuns, i) = self._scan(sSrc, xBuf, {}, rBeg, rEnd)
+					self._out(sPath, xBuf, lRuns)
+				else:
+					# Headers, then just the indexed stretch covering the range
+					dDefs = {}
+					(lRuns, i) = self._scan(sSrc, xBuf, dDefs, None, None,
+					                        iStop=tix.nHdrEnd)
+					self._out(sPath, xBuf, lRuns)
+					(iStart, iStop) = tix.span(rBeg, rEnd, len(xBuf))
+					(lRuns, i) = self._scan(sSrc, xBuf, dDefs, rBeg, rEnd,
+					                        iStart=iStart, iStop=iStop)
+					self._out(sPath, xBuf, lRuns)
+			finally:
+				xBuf.close()
+		finally:
+			fIn.close()
+
+	def _sendPacked(self, sPath, rBeg, rEnd):
+		"""Send a compressed block, decompressing a piece at a time"""
+		sSrc = "cache block %s"%sPath
+		dDefs = {}
+		xBuf = b''
+		fIn = C.openBlock(sPath)
+		try:
+			while True:
+				try:
+					xRead = fIn.read(INFLATE_READ_SZ)
+				except C.g_tBlockErrors as e:
+					raise E.ServerError("Couldn't decompress %s, %s"%(sSrc, e))
+				if len(xRead) == 0:
+					break
+				xBuf += xRead
+				(lRuns, i) = self._scan(sSrc, xBuf, dDefs, rBeg, rEnd, True)
+				self._out(None, xBuf, lRuns)
+				xBuf = xBuf[i:]
+		except:
+			try:
+				fIn.close()
+			except C.g_tBlockErrors:
+				pass
+			raise
+
+		try:
+			fIn.close()
+		except C.g_tBlockErrors as e:
+			raise E.ServerError("Couldn't decompress %s, %s"%(sSrc, e))
+		if len(xBuf) > 0:
+			raise E.ServerError("Truncated packet at end of %s"%sSrc)
+
+	def _sendSlots(self, sPath, dtBeg, nCount, rBeg, rEnd):
+		"""Send a run of blocks from a container"""
+		sSrc = "cache container %s"%sPath
+		iSlot = C.getPackPath(
+			self.dConf, self.dsdf, self.sNormParam, self.nLevel, dtBeg
+		)[2]
+		try:
+			lData = PK.read(sPath, iSlot, nCount)
+		except (IOError, OSError) as e:
+			raise E.ServerError("Couldn't read %s, %s"%(sSrc, e))
+
+		for xBuf in lData:
+			(lRuns, i) = self._scan(sSrc, xBuf, {}, rBeg, rEnd)
+			self._out(None, xBuf, lRuns)
+
+	def _sendGap(self, dtBeg, dtEnd, rBeg, rEnd, tee=None):
+		"""Run a pipeline for a stretch of missing blocks and merge it's output
+		into the stream, trimmed to [rBeg, rEnd).  If tee is not None the
+		output is also written to cache blocks."""
+		pipe = self.fMakePipe(str(dtBeg), str(dtEnd))
+		self.lPipes.append(pipe)
+		self.fLog.write("   Gap %s to %s: %s"%(dtBeg, dtEnd, pipe))
+
+		fdOut = pipe.start().fileno()
+		dErr = {}
+		for i, fErr in enumerate(pipe.errFiles()):
+			dErr[fErr.fileno()] = i
+
+		sSrc = "output of %s"%pipe
+		dDefs = {}
+		xBuf = b''
+		try:
+			while True:
+				rWait = None
+				if pipe.deadline() != None:
+					rWait = max(pipe.deadline() - time.time(), 0.0)
+
+				lReady = select.select([fdOut] + list(dErr.keys()), [], [], rWait)[0]
+				if (len(lReady) == 0) and (rWait != None):
+					pipe.limitHit("wall clock limit of %g seconds exceeded"%pipe.rWallSec)
+					break
+
+				if fdOut not in lReady:
+					for fd in lReady:
+						xRead = os.read(fd, 65536)
+						if len(xRead) == 0:
+							del dErr[fd]
+						else:
+							pipe.addErr(dErr[fd], xRead)
+					continue
+
+				xRead = os.read(fdOut, 65536)
+				if len(xRead) == 0:
+					break
+				xBuf += xRead
+				(lRuns, i) = self._scan(sSrc, xBuf, dDefs, rBeg, rEnd, True, tee)
+				self._out(None, xBuf, lRuns)
+				xBuf = xBuf[i:]
+
+		except (IOError, OSError) as e:
+			pipe.cancel("client disconnected after %d bytes (%s)"%(self.nSent, e))
+			pipe.finish()
+			if tee != None:
+				tee.abort()
+			raise
+		except:
+			if tee != None:
+				tee.abort()
+			raise
+
+		nRet = pipe.finish()
+		sErr = None
+		if pipe.sLimit:
+			self.sLimit = pipe.sLimit
+			sErr = "Gap reader stopped, %s"%pipe.sLimit
+		elif nRet != 0:
+			sErr = u"exec: %s\n%s\n%s"%(pipe, pipe.errText(), pipe.report())
+		elif len(xBuf) > 0:
+			sErr = "Truncated packet at end of %s"%sSrc
+
+		if sErr != None:
+			if tee != None:
+				tee.abort()
+			raise E.ServerError(sErr)
+
+		if len(pipe.errBytes()) > 0:
+			self.fLog.write(pipe.errBytes())
+		if tee != None:
+			self.lWritten += tee.commit()
+
+	def send(self, fStart=None):
+		"""Send the stream.  fStart is called just before the first byte of the
+		body is written, typically to output the HTTP headers.
+
+		Returns the number of bytes sent.
+		"""
+		self.fStart = fStart
+		dtBeg = das2.DasTime(self.sBeg)
+		dtEnd = das2.DasTime(self.sEnd)
+		rBeg = _t2000(dtBeg)
+		rEnd = _t2000(dtEnd)
+
+		# Blocks to read and [begin, end) ranges to fill, in time order.
+		# Blocks are [path, begin, count], consecutive blocks in the same
+		# container are read together.  Gaps are [None, begin, end, blocks].
+		lItems = []
+		for (sPath, dtBlkBeg, dtBlkEnd) in self.blocks():
+			if BI.timeKey(dtBlkBeg) not in self.setMissing:
+				if len(lItems) > 0 and lItems[-1][0] == sPath and \
+				   sPath.endswith(PK.PACK_EXT):
+					lItems[-1][2] += 1
+				else:
+					lItems.append( [sPath, dtBlkBeg, 1] )
+			elif len(lItems) > 0 and lItems[-1][0] == None:
+				lItems[-1][2] = dtBlkEnd
+				lItems[-1][3].append( (sPath, dtBlkBeg, dtBlkEnd) )
+			else:
+				lItems.append( [None, dtBlkBeg, dtBlkEnd, [(sPath, dtBlkBeg, dtBlkEnd)]] )
+
+		lEmpty = []
+		if len(self.setMissing) > 0:
+			lEmpty = ND.spans(self.dConf, self.dsdf.sName, self.sNormParam)
+
+		for iItem in range(len(lItems)):
+			if lItems[iItem][0] != None:
+				(sPath, dtBlkBeg, nCount) = lItems[iItem]
+				self._sendBlock(sPath, dtBlkBeg, nCount,
+					rBeg if iItem == 0 else None,
+					rEnd if iItem == len(lItems) - 1 else None
+				)
+				continue
+
+			(dtGapBeg, dtGapEnd) = lItems[iItem][1:3]
+			
+			# Only the part of the gap inside the request has to be read
+			sNeedBeg = str(dtBeg if dtGapBeg < dtBeg else dtGapBeg)
+			sNeedEnd = str(dtEnd if dtEnd < dtGapEnd else dtGapEnd)
+			if ND.covered(lEmpty, sNeedBeg, sNeedEnd):
+				self.fLog.write("   Gap %s to %s: Known to be empty"%(sNeedBeg, sNeedEnd))
+				continue
+			nPkts = self.nDataPkts
+			
+			if self.bWriteThrough:
+				# Read whole blocks so they can be saved
+				tee = BlockTee(self.fLog, self.dConf, self.dsdf, self.sNormParam,
+				               self.nLevel, lItems[iItem][3])
+				self._sendGap(dtGapBeg, dtGapEnd, rBeg, rEnd, tee)
+			else:
+				if dtGapBeg < dtBeg:
+					dtGapBeg = dtBeg
+				if dtEnd < dtGapEnd:
+					dtGapEnd = dtEnd
+				self._sendGap(dtGapBeg, dtGapEnd, None, None)
+			
+			if self.nDataPkts == nPkts:
+				ND.record(self.fLog, self.dConf, self.dsdf.sName, self.sNormParam,
+				          sNeedBeg, sNeedEnd)
+
+		if self.nDataPkts == 0:
+			sMsg = "No data in the range %s to %s"%(self.sBeg, self.sEnd)
+			if (not self.bStreamHdr) and (self.fdOut == None):
+				webio.dasExcept('NoDataInInterval', sMsg, self.fLog, self.bHdrSent)
+				self.bHdrSent = True
+			else:
+				if not self.bStreamHdr:
+					# Converters need a stream to work on
+					xOut = b'<stream version="2.2">\n</stream>\n'
+					self._write(b'[00]' + ("%06d"%len(xOut)).encode('ascii') + xOut)
+					self.nSent += len(xOut) + 10
+				xOut = ('<exception type="NoDataInInterval" message="%s" />\n'%sMsg).encode('utf-8')
+				self._write(b'[xx]' + ("%06d"%len(xOut)).encode('ascii') + xOut)
+				self.nSent += len(xOut) + 10
+
+		if self.fdOut == None:
+			webio.flushOut()
+		return self.nSent
+
+	def feed(self, pipe):
+		"""Send the stream into a pipeline instead of to the client, for
+		format converters and reducers that work on the cache output.  The
+		stream is written by a separate thread while the caller runs the
+		pipeline as usual.  Call this just before running the pipeline, and
+		wait() after it has finished.
+
+		Returns the pipeline.
+		"""
+		(fdRead, fdWrite) = os.pipe()
+		pipe.setInput(fdRead, "(in-process cache read)")
+		self.fdOut = fdWrite
+		self.thread = threading.Thread(target=self._feed)
+		self.thread.daemon = True
+		self.thread.start()
+		return pipe
+
+	def _feed(self):
+		try:
+			self.send()
+		except E.DasError as e:
+			self.sError = str(e)
+		except (IOError, OSError) as e:
+			self.sError = "pipeline stopped reading after %d bytes, %s"%(self.nSent, e)
+		finally:
+			os.close(self.fdOut)
+
+	def wait(self):
+		"""Wait for the thread started by feed() to finish.  Returns None, or
+		the reason the cache read ended early."""
+		if self.thread != None:
+			self.thread.join()
+			self.thread = None
+			if self.sError != None:
+				self.fLog.write("   Cache read ended early, %s"%self.sError)
+		return self.sError
+
+##############################################################################
+# Time index sidecars
+#
+# Next to a large uncompressed block file, say 2019-04-01_bin-60s.d2s, there
+# may be a file 2019-04-01_bin-60s.d2s.tix listing the time and offset of
+# a data packet about every TIX_STRIDE bytes:
+#
+#   magic    8 bytes   b'das2tix\0'
+#   version  uint32
+#   entries  uint32
+#   hdr_end  uint64    End of the headers before the first data packet
+#   size     uint64    Size of the block the index was made from
+#   mtime    float64   Modification time of that block
+#   entries x (float64 seconds since 2000, uint64 offset)
+#
+# All values are big endian.  Blocks are only indexed if all packet headers
+# come before the first data packet and packet times never decrease.  An
+# index whose size and mtime don't match the block is ignored.
+
+TIX_MAGIC = b'das2tix\0'
+TIX_VERSION = 1
+g_sTixHdrFmt = '>8sIIQQd'
+g_nTixHdrSz = struct.calcsize(g_sTixHdrFmt)
+g_sTixEntFmt = '>dQ'
+g_nTixEntSz = struct.calcsize(g_sTixEntFmt)
+
+
+class TimeIndex(object):
+	"""A loaded time index sidecar"""
+
+	def __init__(self, nHdrEnd, lTimes, lOffsets):
+		self.nHdrEnd = nHdrEnd
+		self.lTimes = lTimes
+		self.lOffsets = lOffsets
+
+	def span(self, rBeg, rEnd, nSize):
+		"""Get the (begin, end) byte offsets of the data packets that may
+		fall in [rBeg, rEnd).  Packets before an entry with a time less than
+		rBeg are earlier still, and those from an entry with a time at or
+		past rEnd are later."""
+		iStart = self.nHdrEnd
+		if rBeg != None:
+			k = bisect_left(self.lTimes, rBeg) - 1
+			if k >= 0:
+				iStart = self.lOffsets[k]
+		iStop = nSize
+		if rEnd != None:
+			k = bisect_left(self.lTimes, rEnd)
+			if k < len(self.lTimes):
+				iStop = self.lOffsets[k]
+		return (iStart, max(iStart, iStop))
+
+
+def readTimeIndex(sPath, st):
+	"""Load the time index for a block file, or None if it has no current
+	index.  st is the os.stat() result for the block."""
+	try:
+		fIn = open(sPath + BI.TIX_EXT, 'rb')
+	except (IOError, OSError):
+		return None
+	try:
+		xHdr = fIn.read(g_nTixHdrSz)
+		if len(xHdr) < g_nTixHdrSz:
+			return None
+		(xMagic, nVer, nEnts, nHdrEnd, nSize, rMtime) = struct.unpack(g_sTixHdrFmt, xHdr)
+		if (xMagic != TIX_MAGIC) or (nVer != TIX_VERSION) or \
+		   (nSize != st.st_size) or (rMtime != st.st_mtime):
+			return None
+		xEnts = fIn.read(nEnts * g_nTixEntSz)
+		if len(xEnts) < nEnts * g_nTixEntSz:
+			return None
+	finally:
+		fIn.close()
+
+	lTimes = []
+	lOffsets = []
+	for i in range(nEnts):
+		(rTime, nOff) = struct.unpack_from(g_sTixEntFmt, xEnts, i * g_nTixEntSz)
+		lTimes.append(rTime)
+		lOffsets.append(nOff)
+	return TimeIndex(nHdrEnd, lTimes, lOffsets)
+
+
+def _timeEntries(sPath, xBuf):
+	"""Get (header end, [(time, offset), ...]) for a block, or None if the
+	block can't be indexed"""
+	dDefs = {}
+	nHdrEnd = None
+	lEnts = []
+	rLast = None
+	nNext = 0
+	i = 0
+	nLen = len(xBuf)
+	while i < nLen:
+		xTag = xBuf[i:i+4]
+		if xTag[0:1] == b'[':
+			iEnd = i + 10 + int(xBuf[i+4:i+10], 10)
+			sId = xTag[1:3].decode('ascii')
+			if sId != 'xx':
+				if nHdrEnd != None:
+					return None    # Header after data
+				if sId != '00':
+					dDefs[sId] = PacketDef(sPath, xBuf[i+10:iEnd])
+			i = iEnd
+			continue
+
+		if xTag[0:1] != b':':
+			return None
+		pkt = dDefs.get(xTag[1:3].decode('ascii'))
+		if (pkt == None) or (pkt.fTime == None):
+			return None
+		if nHdrEnd == None:
+			nHdrEnd = i
+		rTime = pkt.fTime(xBuf, i + 4)
+		if (rLast != None) and (rTime < rLast):
+			return None
+		rLast = rTime
+		if i >= nNext:
+			lEnts.append( (rTime, i) )
+			nNext = i + TIX_STRIDE
+		i += 4 + pkt.nSize
+
+	if (nHdrEnd == None) or (i != nLen):
+		return None
+	return (nHdrEnd, lEnts)
+
+
+def writeTimeIndex(sPath):
+	"""Make or replace the time index sidecar for a block file just moved
+	into place.  Small, compressed or unsuitable blocks get no index, and
+	any old one is removed.  Problems are not raised, blocks are readable
+	without an index.
+
+	Returns True if an index was written.
+	"""
+	sTix = sPath + BI.TIX_EXT
+	tEnts = None
+	try:
+		st = os.stat(sPath)
+		if (st.st_size >= TIX_MIN) and not sPath.endswith(BI.COMPRESS_EXT):
+			fIn = open(sPath, 'rb')
+			try:
+				xBuf = mmap.mmap(fIn.fileno(), 0, access=mmap.ACCESS_READ)
+				try:
+					tEnts = _timeEntries(sPath, xBuf)
+				finally:
+					xBuf.close()
+			finally:
+				fIn.close()
+	except (E.DasError, IOError, OSError, ValueError, struct.error):
+		tEnts = None
+
+	if tEnts == None:
+		try:
+			os.remove(sTix)
+		except OSError:
+			pass
+		return False
+
+	(nHdrEnd, lEnts) = tEnts
+	sTmp = "%s.%d.tmp"%(sTix, os.getpid())
+	try:
+		fOut = open(sTmp, 'wb')
+		try:
+			fOut.write(struct.pack(g_sTixHdrFmt, TIX_MAGIC, TIX_VERSION,
+			           len(lEnts), nHdrEnd, st.st_size, st.st_mtime))
+			for (rTime, nOff) in lEnts:
+				fOut.write(struct.pack(g_sTixEntFmt, rTime, nOff))
+		finally:
+			fOut.close()
+		os.rename(sTmp, sTix)
+	except (IOError, OSError):
+		try:
+			os.remove(sTmp)
+		except OSError:
+			pass
+		return False
+	return True
+
+##############################################################################
+class BlockTee(object):
+	"""Splits a das2 stream into cache block files.
+
+	Each block gets the stream header, all packet headers seen so far and the
+	data packets with times inside the block.  Files are written under
+	temporary names and only renamed into place by commit(), after the whole
+	stream has been read successfully, or moved into their container for
+	packed levels.  If a packet can't be placed in a block the tee gives up
+	quietly, the response is not affected.
+	"""
+
+	def __init__(self, fLog, dConf, dsdf, sNormParam, nLevel, lBlocks):
+		"""lBlocks - List of (path, dtBeg, dtEnd) tuples for consecutive blocks"""
+		self.fLog = fLog
+		self.dConf = dConf
+		self.dsdf = dsdf
+		self.sNormParam = sNormParam
+		self.nLevel = nLevel
+		self.lBlocks = lBlocks
+		self.lBounds = [(_t2000(t[1]), _t2000(t[2])) for t in lBlocks]
+		self.bPacked = C.isPacked(dConf, dsdf, nLevel)
+		self.sMode = compression(dConf, dsdf, nLevel)
+		self.lPaths = [t[0] for t in lBlocks]
+		if self.bPacked:
+			self.lPaths = []
+			for (sPath, dtBeg, dtEnd) in lBlocks:
+				(sDir, sFile, iSlot, nSlots) = C.getPackPath(
+					dConf, dsdf, sNormParam, nLevel, dtBeg
+				)
+				self.lPaths.append("%s.%d"%(pjoin(sDir, sFile), iSlot))
+		elif self.sMode != None:
+			self.lPaths = [s + C.g_dCompress[self.sMode][0] for s in self.lPaths]
+		self.lTmp = ["%s.%d.tmp"%(s, os.getpid()) for s in self.lPaths]
+		self.tAdj = C.snapToTimeBlks(
+			fLog, dsdf, str(lBlocks[0][1]), str(lBlocks[0][2]), nLevel
+		)[1]
+
+		self.iCur = -1
+		self.fOut = None
+		self.xStream = None
+		self.lHdrs = []       # Packet headers in the order seen
+		self.bFailed = False
+
+	def _fail(self, sWhy):
+		self.fLog.write("   Write-through disabled for this request, %s"%sWhy)
+		self.abort()
+		self.bFailed = True
+
+	def _open(self, iBlk):
+		"""Start the file for block iBlk, blocks skipped over get headers only"""
+		while self.iCur < iBlk:
+			if self.fOut != None:
+				self.fOut.close()
+			self.iCur += 1
+			sDir = os.path.dirname(self.lTmp[self.iCur])
+			if not os.path.isdir(sDir):
+				os.makedirs(sDir)
+			self.fOut = C.createBlock(self.lTmp[self.iCur], self.sMode)
+			if self.xStream != None:
+				self.fOut.write(self.xStream)
+			for (sId, xPkt) in self.lHdrs:
+				self.fOut.write(xPkt)
+
+	def header(self, sId, xPkt):
+		if self.bFailed:
+			return
+		if sId == '00':
+			if self.xStream == None:
+				self.xStream = bytes(xPkt)
+			return
+
+		self.lHdrs = [t for t in self.lHdrs if t[0] != sId]
+		self.lHdrs.append( (sId, bytes(xPkt)) )
+		if self.fOut != None:
+			self.fOut.write(xPkt)
+
+	def data(self, xPkt, rTime):
+		if self.bFailed:
+			return
+		if rTime == None:
+			return self._fail("packet times can't be read")
+
+		iBlk = max(self.iCur, 0)
+		while (iBlk < len(self.lBounds)) and (rTime >= self.lBounds[iBlk][1]):
+			iBlk += 1
+		if iBlk >= len(self.lBounds):
+			return   # Past the last block, reducers may emit a partial bin
+		if rTime < self.lBounds[iBlk][0]:
+			if iBlk == 0:
+				return
+			return self._fail("packets are not in time order")
+
+		try:
+			self._open(iBlk)
+			self.fOut.write(xPkt)
+		except (IOError, OSError) as e:
+			self._fail(str(e))
+
+	def abort(self):
+		"""Remove any temporary files"""
+		if self.fOut != None:
+			try:
+				self.fOut.close()
+			except (IOError, OSError):
+				pass
+			self.fOut = None
+		for sTmp in self.lTmp[:self.iCur + 1]:
+			try:
+				os.remove(sTmp)
+			except OSError:
+				pass
+		self.bFailed = True
+
+	def commit(self):
+		"""Move all block files into place.  Returns a list of (sBeg, sEnd)
+		tuples for the blocks saved."""
+		if self.bFailed:
+			return []
+
+		lOut = []
+		try:
+			self._open(len(self.lBlocks) - 1)
+			self.fOut.close()
+			self.fOut = None
+			for i in range(len(self.lBlocks)):
+				(sPath, dtBeg, dtEnd) = self.lBlocks[i]
+				tSum = MF.checksum(self.lTmp[i])
+				if self.bPacked:
+					C.storePacked(self.dConf, self.dsdf, self.sNormParam,
+					              self.nLevel, dtBeg, self.lTmp[i])
+				else:
+					os.rename(self.lTmp[i], self.lPaths[i])
+					C.dropVariants(self.lPaths[i])
+					writeTimeIndex(self.lPaths[i])
+				C.indexBlock(self.fLog, self.dConf, self.dsdf, self.sNormParam,
+				             self.nLevel, dtBeg, dtEnd, self.tAdj, tSum)
+				lOut.append( (str(dtBeg), str(dtEnd)) )
+		except (IOError, OSError) as e:
+			self.fLog.write("   Write-through failed, %s"%e)
+			self.abort()
+			return lOut
+
+		self.fLog.write("   Write-through saved %d cache blocks"%len(lOut))
+		return lOut
+
+##############################################################################
+def canRead(dConf, dsdf):
+	"""True if cache hits for this data source can be read in-process.  This
+	is the case for das2 streams that use the site's default cache reader,
+	unless NATIVE_CACHE_RDR is set to false in the server configuration.
+	"""
+	if dConf.get('NATIVE_CACHE_RDR', 'true').lower() in ('false', 'no', '0'):
+		return False
+
+	if dsdf[u'qstream'] or not dsdf[u'das2Stream']:
+		return False
+
+	return dsdf[u'cacheReader'] == dConf.get('D2S_CACHE_RDR', 'das2_cache_rdr')
+
+
+def compression(dConf, dsdf, nLevel=None):
+	"""Get the compression mode for new cache blocks of a data source, one of
+	the keys of cache.g_dCompress, or None.  The mode is taken from the DSDF
+	keyword cacheCompress, or else the server setting CACHE_COMPRESS.
+	Compressed blocks are only understood by this module, so blocks of data
+	sources it can't read are never compressed.  Neither are blocks of cache
+	level nLevel if it is packed into containers.
+	"""
+	sMode = dConf.get('CACHE_COMPRESS', 'none')
+	sFrom = "server config key CACHE_COMPRESS"
+	if u'cacheCompress' in dsdf:
+		sMode = dsdf[u'cacheCompress']
+		sFrom = "DSDF keyword cacheCompress"
+
+	sMode = sMode.strip().lower()
+	if sMode in ('', 'none', 'false', 'no', '0'):
+		return None
+	if sMode not in C.g_dCompress:
+		raise E.ServerError("Unknown compression '%s' for %s, expected one of: %s"%(
+		                    sMode, sFrom, ', '.join(sorted(C.g_dCompress.keys()))))
+
+	if not canRead(dConf, dsdf):
+		return None
+	if (nLevel != None) and C.isPacked(dConf, dsdf, nLevel):
+		return None
+	return sMode
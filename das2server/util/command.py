@@ -1,17 +1,64 @@
 """Helpers for running sub-commands"""
 
 import sys
+import time
 import subprocess
 import select
 import fcntl
 import os
 
 from . import webio
+from . import pipeline
+
+# The asyncio pump needs python 3.5 or better, keep the select loop for older
+# interpreters
+try:
+	from . import aiopump
+	g_bHaveAsyncio = True
+except (ImportError, SyntaxError):
+	g_bHaveAsyncio = False
+
+# Largest single splice from the command output to standard output
+SPLICE_SZ = 1048576
+
+##############################################################################
+def sendHdrs(sMimeType, sContentDis, sOutFile):
+	webio.pout('Access-Control-Allow-Origin: *\r\n')
+	webio.pout('Access-Control-Allow-Methods: GET\r\n')
+	webio.pout('Access-Control-Allow-Headers: Content-Type\r\n')
+	webio.pout("Content-Type: %s\r\n"%sMimeType)
+	webio.pout("Status: 200 OK\r\n")
+	webio.pout("Expires: now\r\n")
+	for sHdr in webio.g_lRespHdrs:
+		webio.pout("%s\r\n"%sHdr)
+	webio.pout('Content-Disposition: %s; filename="%s"\r\n\r\n'%(
+	      sContentDis, sOutFile))
+	webio.flushOut()
+
+def _decode(xStdErr):
+	if sys.version_info[0] == 2:
+		return xStdErr
+	return xStdErr.decode('utf-8')
+
+def _stopped(fLog, pipe):
+	"""Log why a pipeline was stopped early"""
+	if pipe.sLimit:
+		fLog.write("Resource limit reached, %s"%pipe.report())
+	else:
+		fLog.write("Client went away, %s"%pipe.report())
+	fLog.write("   Killed process group %s, stage exit values: %s"%(
+	           pipe.nPgid, pipe.retCodes()))
+	if not pipe.sLimit:
+		webio.clientGone()
 
 ##############################################################################
 def sendCmdOutput(fLog, uCmd, sMimeType, sContentDis, sOutFile):
 	"""Send the output of a command pipeline as an HTTP message body.
 	
+	uCmd may be a command string or a pipeline.Pipeline object.  For
+	Pipeline objects the per-stage exit values and standard error output
+	are also left in the object after the call.
+	
 	Standard output is sent on as an http message body, standard error
 	output is spooled and send back to the caller.  Output is:
 	
@@ -35,71 +82,114 @@ def sendCmdOutput(fLog, uCmd, sMimeType, sContentDis, sOutFile):
 	# Solution: Check the 1st non-zero read from stdout, if it starts
 	# with anything that looks like <stream> then you're good, say it's data
 	
-	# Change shell=False, and fix fillDsdfDefaults to work on windows
-	proc = subprocess.Popen(uCmd, shell=True, stdout=subprocess.PIPE, 
-	                        stderr=subprocess.PIPE, bufsize=-1)
+	# Plain strings are run via /bin/sh only if they need shell features
+	if isinstance(uCmd, pipeline.Pipeline):
+		pipe = uCmd
+	else:
+		pipe = pipeline.Pipeline(uCmd)
 	
-	fdStdOut = proc.stdout.fileno()
-	fdStdErr = proc.stderr.fileno()
+	# When standard output is a pipe or socket the kernel can move the data
+	# directly, otherwise use the asyncio pump if we have it.
+	fdSplice = webio.spliceFd()
 	
-	fl = fcntl.fcntl(fdStdOut, fcntl.F_GETFL)
-	fcntl.fcntl(fdStdOut, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+	if g_bHaveAsyncio and (fdSplice == None):
+		sink = aiopump.StdoutSink(
+			lambda: sendHdrs(sMimeType, sContentDis, sOutFile)
+		)
+		nSent = aiopump.runSync(aiopump.runPipeline(pipe, sink))
+		if pipe.sCancel:
+			_stopped(fLog, pipe)
+		else:
+			fLog.write("Finished Read, %d bytes sent"%nSent)
+		return (pipe.retCode(), pipe.errText(), nSent > 0)
 	
-	fl = fcntl.fcntl(fdStdErr, fcntl.F_GETFL)
-	fcntl.fcntl(fdStdErr, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+	fStdOut = pipe.start()
+	fdStdOut = fStdOut.fileno()
+	dErr = {}
+	for i, fErr in enumerate(pipe.errFiles()):
+		dErr[fErr.fileno()] = i
 	
-	bBreakNext = False
 	bHttpHdrsSent = False
-	lStdErr = []
+	bOutDone = False
+	nSent = 0
+	nMaxOut = pipe.maxOutput()
+	while not bOutDone:
+		rWait = None
+		rDeadline = pipe.deadline()
+		if rDeadline != None:
+			rWait = max(rDeadline - time.time(), 0.0)
 		
-	while True:
-		lReads = [fdStdOut, fdStdErr]
-		lReady = select.select(lReads, [], [])
+		lReady = select.select([fdStdOut] + list(dErr.keys()), [], [], rWait)[0]
 		
-		for fd in lReady[0]:
-			
+		if (len(lReady) == 0) and (rWait != None):
+			pipe.limitHit("wall clock limit of %g seconds exceeded"%pipe.rWallSec)
+			break
+		
+		for fd in lReady:
 			if fd == fdStdOut:
-				xRead = proc.stdout.read()
-				if len(xRead) != 0:
-					
+				
+				# After the headers are out, splice straight to the client
+				if bHttpHdrsSent and (fdSplice != None):
+					nChunk = SPLICE_SZ
+					if nMaxOut != None:
+						nChunk = min(nChunk, nMaxOut - nSent)
+						if (nChunk <= 0) and (len(os.read(fd, 1)) > 0):
+							pipe.limitHit("output limit of %g MB exceeded"%pipe.rOutMB)
+							bOutDone = True
+							break
+					if nChunk <= 0:
+						bOutDone = True
+						break
+					try:
+						n = os.splice(fdStdOut, fdSplice, nChunk, flags=os.SPLICE_F_MOVE)
+					except (IOError, OSError) as e:
+						pipe.cancel("client disconnected after %d bytes (%s)"%(nSent, e))
+						bOutDone = True
+						break
+					if n == 0:
+						bOutDone = True
+					nSent += n
+					continue
+				
+				xRead = os.read(fd, 65536)
+				if len(xRead) == 0:
+					bOutDone = True
+					continue
+				
+				if (nMaxOut != None) and (nSent + len(xRead) > nMaxOut):
+					pipe.limitHit("output limit of %g MB exceeded"%pipe.rOutMB)
+					bOutDone = True
+					break
+				
+				try:
 					if not bHttpHdrsSent:
-						webio.pout('Access-Control-Allow-Origin: *\r\n')
-						webio.pout('Access-Control-Allow-Methods: GET\r\n')
-						webio.pout('Access-Control-Allow-Headers: Content-Type\r\n')	
-						webio.pout("Content-Type: %s\r\n"%sMimeType)
-						webio.pout("Status: 200 OK\r\n")
-						webio.pout("Expires: now\r\n")
-						webio.pout('Content-Disposition: %s; filename="%s"\r\n\r\n'%(
-						      sContentDis, sOutFile))
-						webio.flushOut()
 						bHttpHdrsSent = True
-					
+						sendHdrs(sMimeType, sContentDis, sOutFile)
 					webio.pout(xRead)
 					webio.flushOut()
+				except (IOError, OSError) as e:
+					pipe.cancel("client disconnected after %d bytes (%s)"%(nSent, e))
+					bOutDone = True
+					break
+				nSent += len(xRead)
 				
-			if fd == fdStdErr:
-				xRead = proc.stderr.read()
-				if len(xRead) != 0:
-					#fLog.write(xRead)
-					lStdErr.append(xRead)
-		
-		if bBreakNext:
-			break
-		
-		if proc.poll() != None:
-			# Go around again to make sure we have read everything
-			bBreakNext = True
-	
+			else:
+				xRead = os.read(fd, 65536)
+				if len(xRead) == 0:
+					del dErr[fd]
+				else:
+					pipe.addErr(dErr[fd], xRead)
 	
-	fLog.write("Finished Read")
-	
-	if sys.version_info[0] == 2:
-		sStdErr = ''.join(lStdErr)
+	# Picks up any remaining error output
+	pipe.finish()
+	if pipe.sCancel:
+		_stopped(fLog, pipe)
 	else:
-		xStdErr = b''.join(lStdErr)
-		sStdErr = xStdErr.decode('utf-8')
+		fLog.write("Finished Read, %d bytes sent%s"%(
+		           nSent, " (spliced)" if fdSplice != None else ""))
 	
-	return (proc.returncode, sStdErr, bHttpHdrsSent)
+	return (pipe.retCode(), pipe.errText(), bHttpHdrsSent)
+
 
 ##############################################################################
 # Suitable for commands that should produce a few KB of output
@@ -110,6 +200,14 @@ def getCmdOutput(fLog, uCmd):
 	a large amount of output is expected.
 	"""
 	
+	if g_bHaveAsyncio:
+		sink = aiopump.BufferSink()
+		(nRet, xStdErr, nSent) = aiopump.runSync(aiopump.runCmd(uCmd, sink))
+		if len(xStdErr) > 0:
+			fLog.write(xStdErr)
+		fLog.write("Finished Read")
+		return (nRet, _decode(sink.getvalue()), _decode(xStdErr))
+	
 	proc = subprocess.Popen(uCmd, shell=True, stdout=subprocess.PIPE, 
 	                        stderr=subprocess.PIPE, bufsize=-1)
 	
@@ -753,6 +753,70 @@ class Dsdf(object):
 
 		return False
 
+	###########################################################################
+	def getLimits(self, dConf):
+		"""Get the resource limits for reader pipelines of this data source.
+
+		Returns the 4-tuple:
+
+		  (cpu_seconds, memory_MB, wall_seconds, output_MB)
+
+		Each item comes from the DSDF keys limitCpuSec, limitMemMB,
+		limitWallSec and limitOutputMB, or if those are not present, from
+		the server config keys READER_CPU_SEC, READER_MEM_MB, READER_WALL_SEC
+		and READER_MAX_OUT_MB.  Missing limits, and limits of 0, are the None
+		object.
+		"""
+		lKeys = [
+			('limitCpuSec', 'READER_CPU_SEC'), ('limitMemMB', 'READER_MEM_MB'),
+			('limitWallSec', 'READER_WALL_SEC'), ('limitOutputMB', 'READER_MAX_OUT_MB')
+		]
+		lOut = []
+		for (sKey, sConfKey) in lKeys:
+			if sKey in self.d:
+				sVal = self.d[sKey]
+				sFrom = u"DSDF keyword %s"%sKey
+			elif sConfKey in dConf:
+				sVal = dConf[sConfKey]
+				sFrom = u"server config key %s"%sConfKey
+			else:
+				lOut.append(None)
+				continue
+
+			try:
+				rVal = float(sVal)
+			except ValueError:
+				raise errors.ServerError(
+					u"Can't convert value '%s' for %s to a number"%(sVal, sFrom)
+				)
+			if rVal < 0:
+				raise errors.ServerError(u"Negative value for %s"%sFrom)
+
+			lOut.append(rVal if rVal > 0 else None)
+
+		return tuple(lOut)
+
+	###########################################################################
+	def getCacheQuota(self):
+		"""Get the most disk space this data source's cache blocks may use, in
+		bytes, from the DSDF keyword cacheQuotaMB.  Returns None if there is
+		no quota.
+		"""
+		if u'cacheQuotaMB' not in self.d:
+			return None
+
+		try:
+			rVal = float(self.d[u'cacheQuotaMB'])
+		except ValueError:
+			raise errors.ServerError(
+				u"Can't convert value '%s' for DSDF keyword cacheQuotaMB to a number"%(
+				self.d[u'cacheQuotaMB'])
+			)
+		if rVal <= 0:
+			return None
+
+		return int(rVal * 1048576)
+
 	###########################################################################
 	def _getLinks(self, dConf, fLog):
 		"""Return a dictionary of reference objects.  This walks the DSDF
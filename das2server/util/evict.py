@@ -0,0 +1,344 @@
+"""Size bounded eviction for the time-block disk cache
+
+Cache blocks are kept until the cache grows past it's budget.  Two kinds of
+budget are supported:
+
+   CACHE_MAX_MB  - Server config key, total size of all blocks under
+                   CACHE_ROOT/data
+
+   cacheQuotaMB  - DSDF keyword, total size of all blocks for one data source
+
+When a budget is exceeded, blocks are removed until usage falls to LOW_WATER
+times the budget.  Whole parameter sets go first: blocks are ordered by the
+last time any block in their parameter set was read, then by their own last
+read time.  Rarely used params= variants are thus cleared out completely
+before blocks of popular ones are touched.
+
+Last read times are kept in the file system as the access time of each block
+file.  They are set explicitly by touch() whenever a block is served, so
+eviction works the same on volumes mounted noatime.  Files are removed
+with blkindex.removeBlocks() so that block indexes, and thus missList()
+results, always agree with what is on disk.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import time
+from os.path import join as pjoin
+
+from . import errors as E
+from . import blkindex as BI
+from . import dsdf as D
+
+##############################################################################
+# Tuning
+
+# Evict down to this fraction of a budget, so the next few blocks written
+# don't trigger another pass right away
+LOW_WATER = 0.9
+
+# A block's access time is only updated if it is older than this many
+# seconds, most cache hits then cost a stat() per block and no writes
+TOUCH_SLACK = 3600
+
+# Time ranges of a level that have been marked as read are remembered for
+# this many seconds in the level directory, see untouched()
+TOUCHED_NAME = '_touched.idx'
+TOUCHED_TTL = TOUCH_SLACK / 2
+
+##############################################################################
+def touch(sPath):
+	"""Record that a cache block was just read.  Errors are ignored, the
+	block may have been evicted in the meantime."""
+	try:
+		st = os.stat(sPath)
+		rNow = time.time()
+		if st.st_atime < rNow - TOUCH_SLACK:
+			os.utime(sPath, (rNow, st.st_mtime))
+	except OSError:
+		pass
+
+
+def untouched(sLevelDir, sBeg, sEnd):
+	"""Get the parts of [sBeg, sEnd) in a cache level that have not been
+	marked as read in the last TOUCHED_TTL seconds, and remember the whole
+	range as marked.  Callers that mark blocks by time range can then skip
+	the blocks of repeated requests without a stat() for each.  Times are
+	block index keys, see blkindex.timeKey().
+
+	Returns a list of (sBeg, sEnd) tuples, empty if nothing needs marking.
+	"""
+	sPath = pjoin(sLevelDir, TOUCHED_NAME)
+	rNow = time.time()
+	rSince = rNow
+	lSpans = []
+	try:
+		fIn = open(sPath, 'r')
+		try:
+			lLines = fIn.readlines()
+		finally:
+			fIn.close()
+		lHdr = lLines[0].split() if len(lLines) > 0 else []
+		if (len(lHdr) == 3) and (float(lHdr[2]) > rNow - TOUCHED_TTL):
+			rSince = float(lHdr[2])
+			lSpans = [tuple(sLine.split()) for sLine in lLines[1:]
+			          if len(sLine.split()) == 2]
+	except (IOError, OSError, ValueError):
+		pass
+
+	lGaps = BI.gaps(lSpans, sBeg, sEnd)
+	if len(lGaps) == 0:
+		return lGaps
+
+	# Lost updates from concurrent requests only cost some extra stat()s
+	try:
+		sTmp = "%s.%d.tmp"%(sPath, os.getpid())
+		fOut = open(sTmp, 'w')
+		try:
+			fOut.write("# since %.0f\n"%rSince)
+			for (sSpanBeg, sSpanEnd) in BI.merge(lSpans + [(sBeg, sEnd)]):
+				fOut.write("%s %s\n"%(sSpanBeg, sSpanEnd))
+		finally:
+			fOut.close()
+		os.rename(sTmp, sPath)
+	except (IOError, OSError):
+		pass
+
+	return lGaps
+
+
+def maxBytes(dConf):
+	"""Get the global cache budget in bytes from CACHE_MAX_MB, or None if
+	the cache size is not limited."""
+	if 'CACHE_MAX_MB' not in dConf:
+		return None
+	try:
+		rVal = float(dConf['CACHE_MAX_MB'])
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key CACHE_MAX_MB to a number"%(
+			dConf['CACHE_MAX_MB'])
+		)
+	if rVal <= 0:
+		return None
+	return int(rVal * 1048576)
+
+
+def isEnabled(dConf, dsdf=None):
+	"""True if there is a budget that could make blocks of this data
+	source, or any data source if dsdf is None, subject to eviction."""
+	if maxBytes(dConf) != None:
+		return True
+	return (dsdf != None) and (dsdf.getCacheQuota() != None)
+
+##############################################################################
+class Level(object):
+	"""The blocks in one cache level directory"""
+
+	def __init__(self, sDir, sDsdf, sParams):
+		self.sDir = sDir
+		self.sDsdf = sDsdf
+		self.sParams = sParams
+		self.lBlocks = []   # (access_time, size, path) tuples
+
+	def add(self, sPath):
+		st = os.stat(sPath)
+		self.lBlocks.append( (st.st_atime, st.st_size, sPath) )
+
+
+def _isLevelDir(sName):
+	return (sName == 'intrinsic') or sName.startswith('bin-')
+
+
+def survey(fLog, dConf, sOnly=None):
+	"""Find all cache blocks under CACHE_ROOT/data.
+
+	sOnly - If not None, only look at the cache for this data source
+
+	Returns a list of Level objects.  Files that don't have block names,
+	including partially written .tmp files, are not listed.
+	"""
+	sTop = pjoin(dConf['CACHE_ROOT'], 'data')
+	if sOnly != None:
+		sOnly = sOnly.strip('/')
+		sStart = pjoin(sTop, sOnly)
+	else:
+		sStart = sTop
+
+	lLevels = []
+	for (sDir, lDirs, lFiles) in os.walk(sStart):
+		if not _isLevelDir(os.path.basename(sDir)):
+			continue
+
+		# CACHE_ROOT/data/DSDF/PARAMS/RES
+		(sParent, sParams) = os.path.split(os.path.dirname(sDir))
+		sDsdf = os.path.relpath(sParent, sTop)
+		if sDsdf.startswith('..') or sDsdf == '.':
+			continue
+
+		level = Level(sDir, sDsdf, sParams)
+		for (sSub, lSubDirs, lSubFiles) in os.walk(sDir):
+			for sFile in lSubFiles:
+				if not sFile.endswith(BI.BLOCK_EXT) or BI.nameSpan(sFile) is None:
+					continue
+				try:
+					level.add(pjoin(sSub, sFile))
+				except OSError:
+					pass   # Removed while we were looking
+
+		lDirs[:] = []
+		if len(level.lBlocks) > 0:
+			lLevels.append(level)
+
+	return lLevels
+
+##############################################################################
+def _order(lLevels):
+	"""Get (access_time, size, path, level) for all blocks, in eviction
+	order, parameter sets by last use, then blocks by last use"""
+	dLastUse = {}
+	for level in lLevels:
+		tKey = (level.sDsdf, level.sParams)
+		rLast = max([t[0] for t in level.lBlocks])
+		dLastUse[tKey] = max(dLastUse.get(tKey, 0), rLast)
+
+	lOut = []
+	for level in lLevels:
+		rSetUse = dLastUse[(level.sDsdf, level.sParams)]
+		for (rAtime, nSize, sPath) in level.lBlocks:
+			lOut.append( (rSetUse, rAtime, nSize, sPath, level) )
+	lOut.sort(key=lambda t: t[:2])
+	return [t[1:] for t in lOut]
+
+
+def _pick(lLevels, nBudget, setGone):
+	"""Choose blocks to remove from lLevels so that the rest fit in LOW_WATER
+	of nBudget bytes.  Blocks already in setGone are counted as removed.
+
+	Returns a list of (path, size, level) tuples.
+	"""
+	nTotal = 0
+	for level in lLevels:
+		for (rAtime, nSize, sPath) in level.lBlocks:
+			if sPath not in setGone:
+				nTotal += nSize
+	if nTotal <= nBudget:
+		return []
+
+	nTarget = int(nBudget * LOW_WATER)
+	lOut = []
+	for (rAtime, nSize, sPath, level) in _order(lLevels):
+		if nTotal <= nTarget:
+			break
+		if sPath in setGone:
+			continue
+		lOut.append( (sPath, nSize, level) )
+		setGone.add(sPath)
+		nTotal -= nSize
+	return lOut
+
+
+def _quota(fLog, dConf, sDsdf):
+	try:
+		dsdf = D.Dsdf(sDsdf, dConf, None, fLog)
+		return dsdf.getCacheQuota()
+	except (E.DasError, IOError, OSError) as e:
+		fLog.write("   No quota for cache of %s, %s"%(sDsdf, e))
+		return None
+
+
+def _prune(sLevelDir, sPath):
+	"""Remove empty directories between a removed block and it's level
+	directory.  The level directory itself holds the index and it's lock
+	file and is left alone."""
+	sDir = os.path.dirname(sPath)
+	while sDir != sLevelDir and sDir.startswith(sLevelDir):
+		try:
+			os.rmdir(sDir)
+		except OSError:
+			break
+		sDir = os.path.dirname(sDir)
+
+
+def evict(fLog, dConf, sOnly=None, bDryRun=False, fProgress=None):
+	"""Remove least recently used cache blocks until all budgets are met.
+
+	Data source quotas are applied first, then the global CACHE_MAX_MB
+	budget is applied to what remains.
+
+	sOnly - Only apply the quota of this data source, the global budget is
+	   not checked.
+
+	bDryRun - Log what would be removed without removing anything
+
+	fProgress - Optional function called with a fraction and a status
+	   message as blocks are removed
+
+	Returns the tuple (blocks_removed, bytes_freed, bytes_before).
+	"""
+	if not os.path.isdir(pjoin(dConf['CACHE_ROOT'], 'data')):
+		return (0, 0, 0)
+
+	lLevels = survey(fLog, dConf, sOnly)
+	nBefore = sum([sum([t[1] for t in l.lBlocks]) for l in lLevels])
+	fLog.write("   Cache holds %d bytes in %d blocks"%(
+	           nBefore, sum([len(l.lBlocks) for l in lLevels])))
+
+	setGone = set()
+	lRemove = []
+
+	dByDsdf = {}
+	for level in lLevels:
+		dByDsdf.setdefault(level.sDsdf, []).append(level)
+	for sDsdf in sorted(dByDsdf.keys()):
+		nQuota = _quota(fLog, dConf, sDsdf)
+		if nQuota != None:
+			lPick = _pick(dByDsdf[sDsdf], nQuota, setGone)
+			if len(lPick) > 0:
+				fLog.write("   %s is over it's %d byte quota, removing %d blocks"%(
+				           sDsdf, nQuota, len(lPick)))
+			lRemove += lPick
+
+	nMax = maxBytes(dConf)
+	if (sOnly == None) and (nMax != None):
+		lPick = _pick(lLevels, nMax, setGone)
+		if len(lPick) > 0:
+			fLog.write("   Cache is over it's %d byte budget, removing %d blocks"%(
+			           nMax, len(lPick)))
+		lRemove += lPick
+
+	if bDryRun:
+		for (sPath, nSize, level) in lRemove:
+			fLog.write("   Would remove %s (%d bytes)"%(sPath, nSize))
+		return (len(lRemove), sum([t[1] for t in lRemove]), nBefore)
+
+	# Remove blocks a level at a time so each index is rewritten once
+	dByLevel = {}
+	for (sPath, nSize, level) in lRemove:
+		dByLevel.setdefault(level.sDir, []).append( (sPath, nSize) )
+
+	nGone = 0
+	nFreed = 0
+	nDone = 0
+	for sLevelDir in sorted(dByLevel.keys()):
+		dSize = dict(dByLevel[sLevelDir])
+		try:
+			lGone = BI.removeBlocks(sLevelDir, list(dSize.keys()))
+		except (IOError, OSError) as e:
+			fLog.write("ERROR: Couldn't evict blocks from %s, %s"%(sLevelDir, e))
+			continue
+
+		for sPath in lGone:
+			_prune(sLevelDir, sPath)
+			nFreed += dSize[sPath]
+		nGone += len(lGone)
+
+		nDone += len(dSize)
+		if fProgress:
+			fProgress(float(nDone)/len(lRemove), "Evicting: %s"%sLevelDir)
+
+	fLog.write("   Removed %d cache blocks, %d bytes freed"%(nGone, nFreed))
+	return (nGone, nFreed, nBefore)
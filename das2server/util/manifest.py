@@ -0,0 +1,338 @@
+"""Provenance manifests for the time-block disk cache
+
+Cache blocks carry no record of what produced them, so after a reader was
+fixed the old output would be served until someone removed it by hand.
+Each cache level directory, CACHE_ROOT/data/DSDF/PARAMS/RES, therefore
+holds two more files once blocks are written to it:
+
+   _manifest.txt   The fingerprints of the configurations that have written
+                   blocks to the level, and the time spans each one wrote
+
+   _checksums.txt  Size and CRC-32 of each block as it was written, one
+                   line per write, later lines replace earlier ones
+
+A fingerprint covers the DSDF contents, the reader and reducer command
+lines of the level, and the modification times of the programs and
+scripts those commands name.  The manifest is plain text:
+
+   # das2server cache manifest
+   gen 2 0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33
+   item 2 dsdf_sha1 62cdb7020ff920e5aa642c3d4066950dd1f01f4d
+   item 2 dsdf_mtime 1546300800.000000
+   item 2 reader /usr/local/bin/my_reader -v
+   item 2 bin /usr/local/bin/my_reader 1546300000
+   span 2 2019-01-01T00:00:00.000 2019-03-01T00:00:00.000
+
+When a block is written it's span moves to the generation matching the
+current fingerprint.  Spans still held by other generations were made by a
+configuration that no longer exists, cache.missList() reports them as
+missing so they are rebuilt on demand.  Blocks written before a level had a
+manifest are trusted.  The cache verification task re-checksums blocks and
+removes damaged and stale ones, see deftasks/verifytask.py.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import zlib
+import hashlib
+from os.path import join as pjoin
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from . import blkindex as BI
+from . import pipeline as P
+
+MANIFEST_NAME = '_manifest.txt'
+SUMS_NAME = '_checksums.txt'
+
+# Read size when checksumming blocks
+SUM_READ_SZ = 1048576
+
+##############################################################################
+class Generation(object):
+	"""One fingerprint and the spans written under it"""
+
+	def __init__(self, nGen, sDigest):
+		self.nGen = nGen
+		self.sDigest = sDigest
+		self.lItems = []   # (key, value) tuples describing the fingerprint
+		self.lSpans = []   # Merged (sBeg, sEnd) index keys
+
+
+def read(sLevelDir):
+	"""Load the manifest for a cache level directory.
+
+	Returns a list of Generation objects, oldest first, or None if the level
+	has no manifest.
+	"""
+	try:
+		fIn = open(pjoin(sLevelDir, MANIFEST_NAME), 'r')
+	except (IOError, OSError):
+		return None
+
+	dGens = {}
+	try:
+		for sLine in fIn:
+			if sLine.startswith('#'):
+				continue
+			lLine = sLine.rstrip('\n').split(' ', 3)
+			if len(lLine) < 3:
+				continue
+			try:
+				nGen = int(lLine[1], 10)
+			except ValueError:
+				continue
+
+			if lLine[0] == 'gen':
+				dGens[nGen] = Generation(nGen, lLine[2])
+			elif nGen not in dGens:
+				continue
+			elif lLine[0] == 'item':
+				dGens[nGen].lItems.append(
+					(lLine[2], lLine[3] if len(lLine) > 3 else '')
+				)
+			elif lLine[0] == 'span' and len(lLine) > 3:
+				dGens[nGen].lSpans.append( (lLine[2], lLine[3]) )
+	finally:
+		fIn.close()
+
+	return [dGens[n] for n in sorted(dGens.keys())]
+
+
+def _write(sLevelDir, lGens):
+	"""Replace the manifest in a single rename"""
+	sPath = pjoin(sLevelDir, MANIFEST_NAME)
+	sTmp = "%s.%d.tmp"%(sPath, os.getpid())
+	fOut = open(sTmp, 'w')
+	try:
+		fOut.write("# das2server cache manifest\n")
+		for gen in lGens:
+			fOut.write("gen %d %s\n"%(gen.nGen, gen.sDigest))
+			for (sKey, sVal) in gen.lItems:
+				fOut.write("item %d %s %s\n"%(gen.nGen, sKey, sVal))
+			for (sBeg, sEnd) in gen.lSpans:
+				fOut.write("span %d %s %s\n"%(gen.nGen, sBeg, sEnd))
+	finally:
+		fOut.close()
+	os.rename(sTmp, sPath)
+
+
+def _lock(sLevelDir):
+	fLock = open(pjoin(sLevelDir, MANIFEST_NAME + '.lock'), 'a')
+	if fcntl:
+		fcntl.flock(fLock.fileno(), fcntl.LOCK_EX)
+	return fLock
+
+##############################################################################
+def _which(sProg):
+	"""Find a program the way the shell would, or None"""
+	if os.sep in sProg:
+		if os.path.isfile(sProg):
+			return sProg
+		return None
+	for sDir in os.environ.get('PATH', '').split(os.pathsep):
+		sPath = pjoin(sDir, sProg)
+		if os.path.isfile(sPath) and os.access(sPath, os.X_OK):
+			return sPath
+	return None
+
+
+def _progTimes(sCmd):
+	"""Get (path, mtime) for the program run by a command line, and for any
+	other files it names by absolute path, such as interpreter scripts"""
+	try:
+		lWords = P.split(sCmd)
+	except ValueError:
+		return []
+
+	lOut = []
+	for i in range(len(lWords)):
+		if i == 0:
+			sPath = _which(lWords[i])
+		elif os.path.isabs(lWords[i]) and os.path.isfile(lWords[i]):
+			sPath = lWords[i]
+		else:
+			continue
+		if sPath != None:
+			lOut.append( (sPath, int(os.stat(sPath).st_mtime)) )
+	return lOut
+
+
+def fingerprint(dConf, dsdf, nLevel):
+	"""Get the fingerprint of the configuration that writes blocks for a
+	cache level.
+
+	Returns the tuple (digest, items) where items is a list of (key, value)
+	tuples saying what went into the digest.
+	"""
+	(nRes, sUnits, sPeriod, sParams) = dsdf['cacheLevel'][nLevel]
+
+	fIn = open(dsdf.sPath, 'rb')
+	try:
+		xDsdf = fIn.read()
+	finally:
+		fIn.close()
+
+	lItems = [ ('dsdf_sha1', hashlib.sha1(xDsdf).hexdigest()) ]
+
+	lCmds = [dsdf[u'reader']]
+	lItems.append( ('reader', ("%s %s"%(dsdf[u'reader'], sParams or '')).strip()) )
+	if nRes != 0:
+		lCmds.append(dsdf[u'reducer'])
+		lItems.append( ('reducer', dsdf[u'reducer']) )
+
+	for sCmd in lCmds:
+		for (sPath, nMtime) in _progTimes(sCmd):
+			lItems.append( ('bin', "%s %d"%(sPath, nMtime)) )
+
+	sText = '\n'.join(["%s %s"%t for t in lItems])
+	sDigest = hashlib.sha1(sText.encode('utf-8')).hexdigest()
+
+	# Recorded for people reading the manifest, but not part of the digest,
+	# touching a DSDF doesn't change what it's blocks hold
+	lItems.insert(1, ('dsdf_mtime', "%.6f"%os.stat(dsdf.sPath).st_mtime))
+
+	return (sDigest, lItems)
+
+
+def stale(lGens, sDigest, sBeg, sEnd):
+	"""Get the parts of [sBeg, sEnd) written under fingerprints other than
+	sDigest, as a merged list of (sBeg, sEnd) index keys"""
+	lOut = []
+	for gen in lGens:
+		if gen.sDigest == sDigest:
+			continue
+		for (sSpanBeg, sSpanEnd) in gen.lSpans:
+			if (sSpanEnd <= sBeg) or (sSpanBeg >= sEnd):
+				continue
+			lOut.append( (max(sSpanBeg, sBeg), min(sSpanEnd, sEnd)) )
+	return BI.merge(lOut)
+
+##############################################################################
+def checksum(sPath):
+	"""Get the (size, CRC-32) of a file"""
+	nSize = 0
+	nCrc = 0
+	fIn = open(sPath, 'rb')
+	try:
+		while True:
+			xData = fIn.read(SUM_READ_SZ)
+			if len(xData) == 0:
+				break
+			nSize += len(xData)
+			nCrc = zlib.crc32(xData, nCrc)
+	finally:
+		fIn.close()
+	return (nSize, nCrc & 0xffffffff)
+
+
+def checksumData(xData):
+	"""Get the (size, CRC-32) of a block held in memory"""
+	return (len(xData), zlib.crc32(xData) & 0xffffffff)
+
+
+def readSums(sLevelDir):
+	"""Get a dictionary of (size, CRC-32) tuples by block begin key"""
+	dOut = {}
+	try:
+		fIn = open(pjoin(sLevelDir, SUMS_NAME), 'r')
+	except (IOError, OSError):
+		return dOut
+	try:
+		for sLine in fIn:
+			lLine = sLine.split()
+			if len(lLine) != 3 or sLine.startswith('#'):
+				continue
+			try:
+				dOut[lLine[0]] = (int(lLine[1], 10), int(lLine[2], 16))
+			except ValueError:
+				pass
+	finally:
+		fIn.close()
+	return dOut
+
+
+def _writeSums(sLevelDir, dSums):
+	sPath = pjoin(sLevelDir, SUMS_NAME)
+	sTmp = "%s.%d.tmp"%(sPath, os.getpid())
+	fOut = open(sTmp, 'w')
+	try:
+		fOut.write("# das2server cache block checksums, begin size crc32\n")
+		for sKey in sorted(dSums.keys()):
+			fOut.write("%s %d %08x\n"%(sKey, dSums[sKey][0], dSums[sKey][1]))
+	finally:
+		fOut.close()
+	os.rename(sTmp, sPath)
+
+##############################################################################
+def addBlock(sLevelDir, tFinger, sBeg, sEnd, tSum=None):
+	"""Record that the block [sBeg, sEnd) was just written.
+
+	tFinger - The (digest, items) tuple from fingerprint()
+	tSum    - Optional (size, CRC-32) of the block as stored
+	"""
+	(sDigest, lItems) = tFinger
+	fLock = _lock(sLevelDir)
+	try:
+		lGens = read(sLevelDir)
+		if lGens == None:
+			lGens = []
+
+		cur = None
+		for gen in lGens:
+			if gen.sDigest == sDigest:
+				cur = gen
+		if cur == None:
+			cur = Generation(max([g.nGen for g in lGens] + [0]) + 1, sDigest)
+			cur.lItems = lItems
+			lGens.append(cur)
+
+		for gen in lGens:
+			if gen is not cur:
+				gen.lSpans = BI.subtract(gen.lSpans, sBeg, sEnd)
+		cur.lSpans = BI.merge(cur.lSpans + [(sBeg, sEnd)])
+
+		_write(sLevelDir, [g for g in lGens if (g is cur) or len(g.lSpans) > 0])
+
+		if tSum != None:
+			fOut = open(pjoin(sLevelDir, SUMS_NAME), 'a')
+			try:
+				fOut.write("%s %d %08x\n"%(sBeg, tSum[0], tSum[1]))
+			finally:
+				fOut.close()
+	finally:
+		fLock.close()
+
+
+def compact(sLevelDir, lPresent, dSums):
+	"""Rewrite a level's manifest and checksum list keeping only what is
+	still on disk.
+
+	lPresent - Merged (sBeg, sEnd) list of the blocks present, typically
+	   from the level's block index.  If None the spans are left alone.
+	dSums - Checksums to keep, by block begin key
+	"""
+	fLock = _lock(sLevelDir)
+	try:
+		lGens = read(sLevelDir)
+		if (lGens != None) and (lPresent != None):
+			for gen in lGens:
+				lKeep = []
+				for (sBeg, sEnd) in gen.lSpans:
+					lHole = BI.gaps(lPresent, sBeg, sEnd)
+					lSpan = [(sBeg, sEnd)]
+					for (sHoleBeg, sHoleEnd) in lHole:
+						lSpan = BI.subtract(lSpan, sHoleBeg, sHoleEnd)
+					lKeep += lSpan
+				gen.lSpans = BI.merge(lKeep)
+			_write(sLevelDir, [g for g in lGens if len(g.lSpans) > 0] or lGens[-1:])
+
+		_writeSums(sLevelDir, dSums)
+	finally:
+		fLock.close()
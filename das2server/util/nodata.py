@@ -0,0 +1,234 @@
+"""Negative cache, stretches of time known to hold no data
+
+Mission data have large gaps and clients probe them constantly.  Without a
+record of what was empty every such probe runs the reader again, or queues
+cache builds that only produce empty blocks.  When NODATA_CACHE_TTL is set,
+time ranges for which a reader produced no data packets are recorded for
+that many seconds, per data source and normalized parameter set, in:
+
+   CACHE_ROOT/nodata/DSDF/PARAMS.txt
+
+Each line holds a begin and end index key, see blkindex.timeKey(), and the
+time at which the record expires.  Lines are appended under an advisory
+lock, expired lines are dropped when the file grows past COMPACT_LINES.
+
+Requests wholly inside known empty ranges are answered with a
+NoDataInInterval exception without running anything.  Missing cache blocks
+inside them are not read when merging a partial cache hit, and are not
+sent to the cache builder.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import re
+import time
+from os.path import join as pjoin
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+import das2
+
+from . import errors as E
+from . import blkindex as BI
+
+# Rewrite the record file without expired lines once it has this many
+COMPACT_LINES = 1000
+
+# The type of an exception in an out-of-band packet
+g_reExcept = re.compile(br'<exception\s[^>]*type\s*=\s*["\']([^"\']*)["\']')
+
+##############################################################################
+def ttl(dConf):
+	"""Get the number of seconds empty ranges are remembered, 0 if they
+	aren't"""
+	if 'NODATA_CACHE_TTL' not in dConf:
+		return 0.0
+	try:
+		return max(float(dConf['NODATA_CACHE_TTL']), 0.0)
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key NODATA_CACHE_TTL to a number"%(
+			dConf['NODATA_CACHE_TTL'])
+		)
+
+def isEnabled(dConf):
+	return ttl(dConf) > 0.0
+
+def _path(dConf, sDsdf, sNormParam):
+	return pjoin(dConf['CACHE_ROOT'], 'nodata', sDsdf, sNormParam + '.txt')
+
+def _key(sTime):
+	return BI.timeKey(das2.DasTime(sTime))
+
+def _read(sPath, rNow):
+	"""Get the unexpired (sBeg, sEnd, rExpires) records and the number of
+	lines in a record file"""
+	try:
+		fIn = open(sPath, 'r')
+	except (IOError, OSError):
+		return ([], 0)
+	lOut = []
+	nLines = 0
+	try:
+		for sLine in fIn:
+			nLines += 1
+			lLine = sLine.split()
+			if len(lLine) != 3:
+				continue
+			try:
+				rExpires = float(lLine[2])
+			except ValueError:
+				continue
+			if rExpires > rNow:
+				lOut.append( (lLine[0], lLine[1], rExpires) )
+	finally:
+		fIn.close()
+	return (lOut, nLines)
+
+##############################################################################
+def spans(dConf, sDsdf, sNormParam):
+	"""Get the merged list of (sBeg, sEnd) index keys known to be empty"""
+	if not isEnabled(dConf):
+		return []
+	(lRecs, nLines) = _read(_path(dConf, sDsdf, sNormParam), time.time())
+	return BI.merge([(t[0], t[1]) for t in lRecs])
+
+def covered(lEmpty, sBeg, sEnd):
+	"""True if [sBeg, sEnd) lies entirely inside a list of known empty spans
+	from spans()"""
+	if len(lEmpty) == 0:
+		return False
+	sBegKey = _key(sBeg)
+	sEndKey = _key(sEnd)
+	if sBegKey >= sEndKey:
+		return False
+	return len(BI.gaps(lEmpty, sBegKey, sEndKey)) == 0
+
+def isEmpty(dConf, sDsdf, sNormParam, sBeg, sEnd):
+	"""True if [sBeg, sEnd) is known to hold no data"""
+	return covered(spans(dConf, sDsdf, sNormParam), sBeg, sEnd)
+
+def dropKnown(fLog, dConf, sDsdf, sNormParam, lMissing):
+	"""Remove blocks known to be empty from a list of (sBeg, sEnd, nLevel)
+	tuples from cache.missList()"""
+	lEmpty = spans(dConf, sDsdf, sNormParam)
+	if len(lEmpty) == 0:
+		return lMissing
+	lOut = [t for t in lMissing if not covered(lEmpty, t[0], t[1])]
+	if len(lOut) < len(lMissing):
+		fLog.write("   No data cache: Skipping %d blocks known to be empty"%(
+		           len(lMissing) - len(lOut)))
+	return lOut
+
+def record(fLog, dConf, sDsdf, sNormParam, sBeg, sEnd):
+	"""Remember that a reader produced no data for [sBeg, sEnd)"""
+	rTtl = ttl(dConf)
+	if rTtl <= 0.0:
+		return
+	sBegKey = _key(sBeg)
+	sEndKey = _key(sEnd)
+	if sBegKey >= sEndKey:
+		return
+
+	sPath = _path(dConf, sDsdf, sNormParam)
+	rNow = time.time()
+	try:
+		if not os.path.isdir(os.path.dirname(sPath)):
+			os.makedirs(os.path.dirname(sPath))
+		fOut = open(sPath, 'a+')
+		try:
+			if fcntl:
+				fcntl.flock(fOut.fileno(), fcntl.LOCK_EX)
+			fOut.write("%s %s %.0f\n"%(sBegKey, sEndKey, rNow + rTtl))
+			fOut.flush()
+
+			(lRecs, nLines) = _read(sPath, rNow)
+			if nLines > COMPACT_LINES:
+				sTmp = "%s.%d.tmp"%(sPath, os.getpid())
+				fTmp = open(sTmp, 'w')
+				try:
+					for (sRecBeg, sRecEnd, rExpires) in lRecs:
+						fTmp.write("%s %s %.0f\n"%(sRecBeg, sRecEnd, rExpires))
+				finally:
+					fTmp.close()
+				os.rename(sTmp, sPath)
+		finally:
+			fOut.close()
+	except (IOError, OSError) as e:
+		fLog.write("WARNING: Couldn't record empty range in %s, %s"%(sPath, e))
+		return
+
+	fLog.write("   No data cache: %s to %s recorded as empty"%(sBeg, sEnd))
+
+##############################################################################
+def _isError(xPkt):
+	"""True if an out-of-band packet is an exception that doesn't just say
+	there was no data.  Comments and other packets are not errors."""
+	m = g_reExcept.search(xPkt)
+	return (m != None) and (m.group(1) != b'NoDataInInterval')
+
+##############################################################################
+class Sniffer(object):
+	"""Watches a das2 stream response go by, see webio.capture(), to learn if
+	it holds any data packets.  HTTP headers in front of the stream are
+	skipped.  Watching stops at the first data packet, at an exception other
+	than NoDataInInterval, or at anything that doesn't look like a das2
+	stream.
+	"""
+
+	def __init__(self):
+		self.xBuf = b''
+		self.bBody = False
+		self.bData = False
+		self.bBad = False
+
+	def write(self, xData):
+		if self.bData or self.bBad:
+			return
+		self.xBuf += bytes(xData)
+
+		if not self.bBody:
+			i = self.xBuf.find(b'\r\n\r\n')
+			if i < 0:
+				return
+			self.bBody = True
+			self.xBuf = self.xBuf[i+4:]
+
+		i = 0
+		nLen = len(self.xBuf)
+		while i + 4 <= nLen:
+			xTag = self.xBuf[i:i+4]
+			if xTag[0:1] == b':':
+				self.bData = True
+				break
+			if xTag[0:1] != b'[':
+				self.bBad = True
+				break
+			if i + 10 > nLen:
+				break
+			try:
+				iEnd = i + 10 + int(self.xBuf[i+4:i+10], 10)
+			except ValueError:
+				self.bBad = True
+				break
+			if iEnd > nLen:
+				break
+			if (xTag == b'[xx]') and _isError(self.xBuf[i+10:iEnd]):
+				self.bBad = True
+				break
+			i = iEnd
+
+		if self.bData or self.bBad:
+			self.xBuf = b''
+		else:
+			self.xBuf = self.xBuf[i:]
+
+	def isEmpty(self):
+		"""True if a complete stream went by without any data packets"""
+		return self.bBody and not (self.bData or self.bBad) and (len(self.xBuf) == 0)
@@ -0,0 +1,552 @@
+"""Run reader | reducer | converter chains without a sub-shell
+
+Command templates from the server configuration and DSDF files (reader,
+reducer, cacheReader, converters) are split into argument vectors once and
+the stages are connected with pipes directly.  Request values such as the
+begin and end times are appended as whole arguments, they are never seen by
+a shell.
+
+Templates that really do need a shell, for example ones containing
+redirects, environment variables or their own pipes, are run as
+
+   /bin/sh -c 'TEMPLATE "$@"' sh ARG1 ARG2 ...
+
+so the request values are still passed as positional arguments.
+"""
+
+import sys
+import os
+import re
+import time
+import shlex
+import signal
+import select
+import subprocess
+
+from . import errors as E
+
+# Ugg, the python 2/3 mess
+try:
+	unicode
+except NameError:
+	unicode = str
+
+try:
+	from shlex import quote as _quote
+except ImportError:
+	from pipes import quote as _quote
+
+# Resource limits are only available on POSIX systems
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# Seconds to wait for stopped stages to exit, and afterwards for their
+# standard error to close, before giving up on them
+CANCEL_GRACE_SEC = 2.0
+
+##############################################################################
+# Characters that only mean something to a shell
+
+g_reShellChars = re.compile(r'[|&;<>()$`*?~\[\]{}\\\n]')
+
+def needsShell(uCmd):
+	"""Returns True if a command template uses shell syntax"""
+	return g_reShellChars.search(uCmd) != None
+
+def split(uCmd):
+	"""Split a command template or parameter string into words using shell
+	quoting rules.  Returns a list of strings, which may be empty.
+	"""
+	if uCmd == None:
+		return []
+	if sys.version_info[0] == 2 and isinstance(uCmd, unicode):
+		return [s.decode('utf-8') for s in shlex.split(uCmd.encode('utf-8'))]
+	return shlex.split(uCmd)
+
+def _str(item):
+	if isinstance(item, (str, unicode)):
+		return item
+	return str(item)
+
+
+##############################################################################
+class Pipeline(object):
+	"""A chain of commands with the standard output of each stage feeding the
+	standard input of the next.
+
+	Typical use:
+
+	   pipe = Pipeline()
+	   pipe.add(dsdf['reader'], sBeg, sEnd, *pipeline.split(sParams))
+	   pipe.add(dsdf['reducer'], sRes)
+
+	then hand the object to command.sendCmdOutput() or call start() and
+	finish() directly.  str(pipe) gives the equivalent shell command for log
+	messages.
+	"""
+
+	def __init__(self, uCmd=None, *lArgs):
+		self.lStages = []   # Argument vectors, one per stage
+		self.lNames = []    # Short name of each stage for error messages
+		self.lProcs = []
+		self.lRetCodes = []
+		self.lStdErr = []
+		self.sOutFile = None
+		self.fdIn = None       # Optional input for the first stage
+		self.sInName = None
+		self.nPgid = None      # All stages run in one process group
+		self.fPreExec = None   # Extra setup to run in each child before exec
+		self.sCancel = None    # Why the pipeline was stopped early, if it was
+		self.sLimit = None     # Set if stopped early due to a resource limit
+		self.rStart = None
+
+		# Resource limits, None means unlimited
+		self.rCpuSec = None
+		self.rMemMB = None
+		self.rWallSec = None
+		self.rOutMB = None
+
+		if uCmd != None:
+			self.add(uCmd, *lArgs)
+
+	def add(self, uCmd, *lArgs):
+		"""Add a stage.
+
+		uCmd - A command template, possibly with it's own fixed arguments,
+		   as found in a config or DSDF file.
+
+		lArgs - Additional arguments, each is passed as a single argument
+		   no matter what characters it contains.
+
+		Returns the pipeline object so that calls may be chained.
+		"""
+		lArgs = [_str(a) for a in lArgs]
+
+		if needsShell(uCmd):
+			if len(lArgs) > 0:
+				lArgv = ['/bin/sh', '-c', u'%s "$@"'%uCmd, 'sh'] + lArgs
+			else:
+				lArgv = ['/bin/sh', '-c', uCmd]
+			lWords = uCmd.split()
+			sName = lWords[0] if len(lWords) > 0 else 'sh'
+		else:
+			lArgv = split(uCmd) + lArgs
+			if len(lArgv) == 0:
+				raise ValueError("Empty command in pipeline")
+			sName = lArgv[0]
+
+		self.lStages.append(lArgv)
+		self.lNames.append(os.path.basename(sName))
+		return self
+
+	def setLimits(self, rCpuSec=None, rMemMB=None, rWallSec=None, rOutMB=None):
+		"""Set resource limits for the pipeline, each may be None.
+
+		rCpuSec - CPU seconds allowed to each stage
+		rMemMB - Address space allowed to each stage in megabytes
+		rWallSec - Run time allowed to the pipeline as a whole
+		rOutMB - Maximum output of the final stage in megabytes
+
+		The first two are enforced by the kernel (setrlimit), the wall clock
+		and output limits are checked by whatever is reading the output.
+		"""
+		self.rCpuSec = rCpuSec
+		self.rMemMB = rMemMB
+		self.rWallSec = rWallSec
+		self.rOutMB = rOutMB
+		return self
+
+	def maxOutput(self):
+		"""Get the output limit in bytes, or None"""
+		if self.rOutMB == None:
+			return None
+		return int(self.rOutMB * 1048576)
+
+	def deadline(self):
+		"""Get the time.time() value at which the pipeline must be stopped,
+		or None if there is no wall clock limit"""
+		if (self.rWallSec == None) or (self.rStart == None):
+			return None
+		return self.rStart + self.rWallSec
+
+	def setOutput(self, sOutFile):
+		"""Send the output of the last stage to a file instead of a pipe"""
+		self.sOutFile = sOutFile
+		return self
+
+	def setInput(self, fdIn, sName=None):
+		"""Read the input of the first stage from a file descriptor.  The
+		pipeline takes ownership, the descriptor is closed once the first
+		stage has started.  sName describes the source in log messages.
+		"""
+		self.fdIn = fdIn
+		self.sInName = sName
+		return self
+
+	def takeInput(self):
+		"""Get the input descriptor set by setInput(), or None.  It is handed
+		over only once, the caller must close it."""
+		fdIn = self.fdIn
+		self.fdIn = None
+		return fdIn
+
+	def __len__(self):
+		return len(self.lStages)
+
+	def __str__(self):
+		lOut = []
+		for lArgv in self.lStages:
+			if (len(lArgv) > 3) and (lArgv[0] == '/bin/sh') and (lArgv[1] == '-c'):
+				# Show the template as written followed by it's arguments
+				sCmd = lArgv[2][:-len(' "$@"')]
+				lOut.append(' '.join([sCmd] + [_quote(s) for s in lArgv[4:]]))
+			elif (len(lArgv) == 3) and (lArgv[0] == '/bin/sh') and (lArgv[1] == '-c'):
+				lOut.append(lArgv[2])
+			else:
+				lOut.append(' '.join([_quote(s) for s in lArgv]))
+
+		if self.sInName:
+			lOut.insert(0, self.sInName)
+		sCmd = ' | '.join(lOut)
+		if self.sOutFile:
+			sCmd += ' > %s'%_quote(self.sOutFile)
+		return sCmd
+
+	def __unicode__(self):
+		return self.__str__()
+
+	##########################################################################
+	# Synchronous execution
+
+	def start(self, stdin=None, **dKwargs):
+		"""Start all stages.  Extra keyword arguments are passed to each
+		subprocess.Popen call.
+
+		Returns the standard output pipe of the last stage, or None if the
+		output is going to a file.
+		"""
+		self.lProcs = []
+		self.lRetCodes = []
+		self.lStdErr = [ [] for i in range(len(self.lStages))]
+		self.nPgid = None
+		self.sCancel = None
+		self.sLimit = None
+		self.rStart = time.time()
+
+		fOut = None
+		if self.sOutFile:
+			fOut = open(self.sOutFile, 'wb')
+
+		fdIn = stdin
+		if stdin == None:
+			fdIn = self.takeInput()
+		try:
+			for i in range(len(self.lStages)):
+				fdNext = None
+				if i < len(self.lStages) - 1:
+					(fdNext, fdOut) = os.pipe()
+				elif fOut != None:
+					fdOut = fOut
+				else:
+					fdOut = subprocess.PIPE
+
+				bToFile = (fOut != None) and (fdNext == None)
+				dSpawn = dict(dKwargs)
+				dSpawn.update(self.spawnArgs(bToFile))
+				try:
+					proc = subprocess.Popen(
+						self.lStages[i], stdin=fdIn, stdout=fdOut, stderr=subprocess.PIPE,
+						close_fds=True, **dSpawn
+					)
+				except OSError as e:
+					if fdNext != None:
+						os.close(fdNext)
+						os.close(fdOut)
+					raise E.ServerError("Couldn't run pipeline stage %d, %s: %s"%(
+					                    i+1, self.lNames[i], e))
+				self.lProcs.append(proc)
+				self.joined(proc.pid, bToFile)
+
+				# The children have their copies now
+				if (fdIn != None) and (fdIn is not stdin):
+					os.close(fdIn)
+				if fdNext != None:
+					os.close(fdOut)
+				fdIn = fdNext
+		except:
+			if (fdIn != None) and (fdIn is not stdin):
+				os.close(fdIn)
+			self.kill()
+			raise
+		finally:
+			if fOut != None:
+				fOut.close()
+
+		return self.lProcs[-1].stdout
+
+	def errFiles(self):
+		"""Get the stderr pipes of all running stages"""
+		return [proc.stderr for proc in self.lProcs]
+
+	def addErr(self, iStage, xData):
+		self.lStdErr[iStage].append(xData)
+
+	def _limits(self, bToFile):
+		"""Get the (resource, (soft, hard)) setrlimit values for a stage"""
+		lLimits = []
+		if resource != None:
+			if self.rCpuSec != None:
+				# SIGXCPU at the soft limit, SIGKILL shortly after
+				nSec = int(self.rCpuSec + 0.999)
+				lLimits.append( (resource.RLIMIT_CPU, (nSec, nSec + 5)) )
+			if self.rMemMB != None:
+				nBytes = int(self.rMemMB * 1048576)
+				lLimits.append( (resource.RLIMIT_AS, (nBytes, nBytes)) )
+			if bToFile and (self.rOutMB != None):
+				nBytes = self.maxOutput()
+				lLimits.append( (resource.RLIMIT_FSIZE, (nBytes, nBytes)) )
+		return lLimits
+
+	def _noPreExec(self):
+		"""True if the group and limits can be set up without running python
+		code in the child.  A preexec_fn may deadlock the child when the
+		parent has other threads, such as the block writers of a cache build.
+		"""
+		return (self.fPreExec == None) and (sys.version_info >= (3, 11)) and \
+		       (resource != None) and hasattr(resource, 'prlimit')
+
+	def spawnArgs(self, bToFile=False):
+		"""Get the keyword arguments for starting a stage with
+		subprocess.Popen.  Pass each new process to joined() afterwards.
+		"""
+		nPgid = self.nPgid
+		if nPgid == None:
+			nPgid = 0       # First stage leads the group
+		if self._noPreExec():
+			# Limits are applied from the parent by joined()
+			return {'process_group': nPgid}
+		return {'preexec_fn': self.preexec(bToFile)}
+
+	def preexec(self, bToFile=False):
+		"""Get a function to run in each child process before exec.  It moves
+		the child into the pipeline's process group so that the whole
+		pipeline, including any programs the stages start themselves, can be
+		signaled at once, and applies the CPU and memory limits.  If bToFile
+		is true the output limit is applied as a maximum file size.
+		"""
+		nPgid = self.nPgid
+		if nPgid == None:
+			nPgid = 0       # First stage leads the group
+		fExtra = self.fPreExec
+		lLimits = self._limits(bToFile)
+
+		def childSetup():
+			os.setpgid(0, nPgid)
+			for (nRes, tLim) in lLimits:
+				# Never try to raise a hard limit set by the administrator
+				(nSoft, nHard) = resource.getrlimit(nRes)
+				if nHard != resource.RLIM_INFINITY:
+					tLim = (min(tLim[0], nHard), min(tLim[1], nHard))
+				resource.setrlimit(nRes, tLim)
+			if fExtra != None:
+				fExtra()
+
+		return childSetup
+
+	def joined(self, nPid, bToFile=False):
+		"""Record that a stage has started.  The group is also set from the
+		parent side, otherwise there is a race with the next stage's setup.
+		When the stage was started without a preexec function it's limits
+		are applied here.
+		"""
+		if self.nPgid == None:
+			self.nPgid = nPid
+		try:
+			os.setpgid(nPid, self.nPgid)
+		except OSError:
+			pass   # Child has already exec'd, it set it's own group
+
+		if not self._noPreExec():
+			return
+		for (nRes, tLim) in self._limits(bToFile):
+			try:
+				(nSoft, nHard) = resource.prlimit(nPid, nRes)
+				if nHard != resource.RLIM_INFINITY:
+					tLim = (min(tLim[0], nHard), min(tLim[1], nHard))
+				resource.prlimit(nPid, nRes, tLim)
+			except (OSError, ValueError):
+				pass   # Stage has already exited
+
+	def signal(self, nSig):
+		"""Send a signal to the pipeline's process group"""
+		if self.nPgid != None:
+			try:
+				os.killpg(self.nPgid, nSig)
+			except OSError:
+				pass   # Everyone has exited
+
+	def cancel(self, sReason, rGrace=CANCEL_GRACE_SEC):
+		"""Stop a running pipeline early.  All processes in the group are sent
+		SIGTERM, any still running after rGrace seconds are sent SIGKILL.  Call
+		finish() afterwards to collect the exit values.
+		"""
+		self.sCancel = sReason
+		self.signal(signal.SIGTERM)
+
+		rEnd = time.time() + rGrace
+		while time.time() < rEnd:
+			if len([p for p in self.lProcs if p.poll() == None]) == 0:
+				break
+			time.sleep(0.05)
+
+		# Also catches grandchildren that ignored SIGTERM
+		self.signal(signal.SIGKILL)
+
+	def limitHit(self, sWhat):
+		"""Stop the pipeline because it went over a resource limit"""
+		self.sLimit = sWhat
+		self.cancel(sWhat)
+
+	def kill(self, nSig=None):
+		"""Send a signal (default SIGKILL) to every stage still running"""
+		for proc in self.lProcs:
+			if proc.poll() == None:
+				try:
+					if nSig == None:
+						proc.kill()
+					else:
+						proc.send_signal(nSig)
+				except OSError:
+					pass
+
+	def finish(self):
+		"""Read any remaining standard error output from all stages and wait
+		for them to exit.  The standard output of the last stage must already
+		have been consumed or redirected to a file.
+
+		Returns the pipeline return code, see retCode()
+		"""
+		dFds = {}
+		for i in range(len(self.lProcs)):
+			if self.lProcs[i].stderr != None:
+				dFds[self.lProcs[i].stderr.fileno()] = i
+
+		rGiveUp = None
+		while len(dFds) > 0:
+			rDeadline = self.deadline()
+			rWait = None
+			if self.sCancel != None:
+				# The stages are gone, but descendants that left the process
+				# group may hold standard error open for ever
+				if rGiveUp == None:
+					rGiveUp = time.time() + CANCEL_GRACE_SEC
+				rWait = max(rGiveUp - time.time(), 0.0)
+			elif rDeadline != None:
+				rWait = max(rDeadline - time.time(), 0.0)
+
+			lReady = select.select(list(dFds.keys()), [], [], rWait)[0]
+			if (len(lReady) == 0) and (rWait != None):
+				if self.sCancel != None:
+					break
+				self.limitHit("wall clock limit of %g seconds exceeded"%self.rWallSec)
+				continue
+
+			for fd in lReady:
+				xRead = os.read(fd, 16384)
+				if len(xRead) == 0:
+					del dFds[fd]
+				else:
+					self.lStdErr[dFds[fd]].append(xRead)
+
+		for proc in self.lProcs:
+			if proc.stderr != None:
+				proc.stderr.close()
+			if proc.stdout != None:
+				proc.stdout.close()
+
+		self.lRetCodes = [proc.wait() for proc in self.lProcs]
+		self._kernelLimits()
+		return self.retCode()
+
+	def run(self):
+		"""Run the pipeline to completion, the output of the last stage must be
+		going to a file.  Returns the pipeline return code.
+		"""
+		if not self.sOutFile:
+			raise ValueError("Pipeline output must be redirected to use run()")
+		self.start()
+		return self.finish()
+
+	def setResults(self, lRetCodes, lStdErr):
+		"""Record results when the stages were run by some other means, such as
+		an asyncio event loop"""
+		self.lRetCodes = list(lRetCodes)
+		self.lStdErr = [ [x] for x in lStdErr ]
+		self._kernelLimits()
+
+	def _kernelLimits(self):
+		"""Set sLimit if a stage was stopped by a setrlimit signal"""
+		if self.sLimit:
+			return
+		for nRet in self.lRetCodes:
+			if (nRet < 0) and (-nRet == getattr(signal, 'SIGXCPU', None)):
+				self.sLimit = "CPU limit of %g seconds exceeded"%self.rCpuSec
+			elif (nRet < 0) and (-nRet == getattr(signal, 'SIGXFSZ', None)):
+				self.sLimit = "output limit of %g MB exceeded"%self.rOutMB
+
+	##########################################################################
+	# Results
+
+	def retCodes(self):
+		"""The exit value of each stage, negative values indicate the stage was
+		killed by a signal"""
+		return list(self.lRetCodes)
+
+	def retCode(self):
+		"""The exit value of the right most stage that failed, or 0 if all
+		stages succeeded (same as 'set -o pipefail' in bash)"""
+		for nRet in reversed(self.lRetCodes):
+			if nRet != 0:
+				return nRet
+		return 0
+
+	def errBytes(self, iStage=None):
+		"""Standard error output as bytes, for one stage or all stages"""
+		if iStage != None:
+			return b''.join(self.lStdErr[iStage])
+		return b''.join([ b''.join(l) for l in self.lStdErr])
+
+	def errText(self, iStage=None):
+		"""Standard error output as text, for one stage or all stages"""
+		xErr = self.errBytes(iStage)
+		if sys.version_info[0] == 2:
+			return xErr
+		return xErr.decode('utf-8', 'replace')
+
+	def report(self):
+		"""A one line summary of any failed stages"""
+		lOut = []
+		for i in range(len(self.lRetCodes)):
+			nRet = self.lRetCodes[i]
+			if nRet == 0:
+				continue
+			if (nRet < 0) and (-nRet == getattr(signal, 'SIGXCPU', None)):
+				lOut.append("stage %d (%s) exceeded the CPU limit of %g seconds"%(
+				            i+1, self.lNames[i], self.rCpuSec))
+			elif (nRet < 0) and (-nRet == getattr(signal, 'SIGXFSZ', None)):
+				lOut.append("stage %d (%s) exceeded the output limit of %g MB"%(
+				            i+1, self.lNames[i], self.rOutMB))
+			elif nRet < 0:
+				lOut.append("stage %d (%s) killed by signal %d"%(i+1, self.lNames[i], -nRet))
+			else:
+				lOut.append("stage %d (%s) exited with %d"%(i+1, self.lNames[i], nRet))
+
+		if self.sLimit and self.sCancel:
+			return "Pipeline stopped, %s"%self.sLimit
+		if self.sCancel:
+			return "Pipeline cancelled, %s"%self.sCancel
+		if len(lOut) == 0:
+			return "All %d pipeline stages succeeded"%len(self.lRetCodes)
+		return "Pipeline failed, %s"%(", ".join(lOut))
@@ -0,0 +1,375 @@
+"""Whole response cache and HTTP validators for cache hits
+
+Answering a request from the time-block cache still means reading, trimming
+and re-sending every block, and running any format converter, each time it
+is asked for.  Clients that fetch the same ranges over and over, such as
+dashboards and das2_srv_ap_check runs, pay that cost every time.
+
+Responses built entirely from cache blocks are therefore given a strong
+ETag and a Last-Modified time.  The ETag is derived from the request, the
+cache manifest generations that wrote the blocks (see manifest.py), and
+the size and modification time of each block file, so it changes whenever
+any block behind the response is rewritten.  Requests carrying a matching
+If-None-Match, or a later If-Modified-Since, get a 304 Not Modified
+response and cost nothing but a few stat() calls.
+
+If RESPONSE_CACHE_MB is set, the exact bytes sent, headers included, are
+also saved under RESPONSE_CACHE_DIR, one file per request:
+
+   das2server-response 1 "ETAG" CREATED\\n
+   ...the response as sent...
+
+A later identical request with the same ETag is answered with a single
+sendFile() of the saved bytes.  Entries older than RESPONSE_CACHE_TTL
+seconds are not used, and the oldest entries are removed whenever the
+total size goes over budget.  Responses larger than a tenth of the budget
+are not saved.  Only levels with a manifest are handled, so blocks written
+before manifests existed are always read normally.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import time
+import hashlib
+import email.utils
+from os.path import join as pjoin
+
+from . import errors as E
+from . import webio
+from . import blkindex as BI
+from . import manifest as MF
+from . import evict as EV
+from . import cache as C
+
+MAGIC = 'das2server-response'
+VERSION = 1
+
+# Default number of seconds a saved response may be used
+DEF_TTL = 86400
+
+# Saved responses are trimmed to this fraction of the budget
+LOW_WATER = 0.9
+
+# Temporary files left by crashed writers are removed after this many
+# seconds
+TMP_AGE = 3600
+
+##############################################################################
+def _confNum(dConf, sKey, rDefault):
+	if sKey not in dConf:
+		return rDefault
+	try:
+		return float(dConf[sKey])
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key %s to a number"%(
+			dConf[sKey], sKey)
+		)
+
+def maxBytes(dConf):
+	"""Get the response cache budget in bytes, or None if responses are not
+	saved."""
+	rMB = _confNum(dConf, 'RESPONSE_CACHE_MB', 0.0)
+	if rMB <= 0.0:
+		return None
+	return int(rMB * 1048576)
+
+def cacheDir(dConf):
+	if 'RESPONSE_CACHE_DIR' in dConf:
+		return dConf['RESPONSE_CACHE_DIR']
+	return pjoin(dConf['CACHE_ROOT'], 'responses')
+
+##############################################################################
+def validator(rdr, lKey):
+	"""Get the (ETag, last modified time) of a response built from the cache
+	blocks of a CacheReader.
+
+	lKey - List of strings that identify the request, typically the data
+	       source, time range, resolution, normalized parameters and output
+	       format.
+
+	Returns None if the level has no manifest, or if some blocks in the
+	range were written before it had one.
+	"""
+	sLevelDir = C.getLevelDir(rdr.dConf, rdr.dsdf, rdr.sNormParam, rdr.nLevel)
+	lGens = MF.read(sLevelDir)
+	if not lGens:
+		return None
+
+	lBlocks = rdr.blocks()
+	if len(lBlocks) == 0:
+		return None
+	sBeg = BI.timeKey(lBlocks[0][1])
+	sEnd = BI.timeKey(lBlocks[-1][2])
+
+	lSpans = []
+	for gen in lGens:
+		lSpans += gen.lSpans
+	if len(BI.gaps(BI.merge(lSpans), sBeg, sEnd)) > 0:
+		return None
+
+	hash = hashlib.sha1(u'\n'.join(lKey).encode('utf-8'))
+	for gen in lGens:
+		for (sSpanBeg, sSpanEnd) in gen.lSpans:
+			if (sSpanEnd > sBeg) and (sSpanBeg < sEnd):
+				hash.update(("\n%s %s %s"%(gen.sDigest, sSpanBeg, sSpanEnd)).encode('ascii'))
+
+	rModified = 0.0
+	setDone = set()
+	for (sPath, dtBeg, dtEnd) in lBlocks:
+		if sPath in setDone:
+			continue
+		setDone.add(sPath)
+		try:
+			st = os.stat(sPath)
+		except OSError:
+			return None  # Removed since the cache check, let the reader complain
+		hash.update(("\n%s %d %.6f"%(sPath, st.st_size, st.st_mtime)).encode('utf-8'))
+		rModified = max(rModified, st.st_mtime)
+
+	return ('"%s"'%hash.hexdigest(), rModified)
+
+def _etagMatch(sHeader, sEtag):
+	for sItem in sHeader.split(','):
+		sItem = sItem.strip()
+		if sItem.startswith('W/'):
+			sItem = sItem[2:]
+		if (sItem == '*') or (sItem == sEtag):
+			return True
+	return False
+
+##############################################################################
+class Response(object):
+	"""Validators, and maybe a saved copy, for one response built entirely
+	from cache blocks.  Typical use by a handler:
+
+	   resp = Response(fLog, dConf, rdr, lKey)
+	   if resp.answer():
+	      return 0
+	   resp.record()
+	   ... send the response as usual ...
+	   resp.finish(nRet == 0)
+	"""
+
+	def __init__(self, fLog, dConf, rdr, lKey):
+		self.fLog = fLog
+		self.dConf = dConf
+		self.rdr = rdr
+		self.tValid = validator(rdr, lKey)
+		self.nMax = maxBytes(dConf)
+		self.sPath = None
+		if (self.tValid != None) and (self.nMax != None):
+			sName = hashlib.sha1(u'\n'.join(lKey).encode('utf-8')).hexdigest()
+			self.sPath = pjoin(cacheDir(dConf), sName + '.rsp')
+		self.fOut = None
+		self.sTmp = None
+		self.nBytes = 0
+
+	def headers(self):
+		"""Get the validator headers to add to a 200 response"""
+		if self.tValid == None:
+			return []
+		return ['ETag: %s'%self.tValid[0],
+		        'Last-Modified: %s'%email.utils.formatdate(self.tValid[1], usegmt=True)]
+
+	def _touch(self):
+		"""Saved and unchanged responses still count as uses of the blocks"""
+		for sPath in set([t[0] for t in self.rdr.blocks()]):
+			EV.touch(sPath)
+
+	def notModified(self):
+		"""Send 304 Not Modified if the client already has this response.
+		Returns True if a response was sent."""
+		if self.tValid == None:
+			return False
+
+		(sEtag, rModified) = self.tValid
+		sNoneMatch = os.getenv('HTTP_IF_NONE_MATCH')
+		if sNoneMatch != None:
+			if not _etagMatch(sNoneMatch, sEtag):
+				return False
+		else:
+			sSince = os.getenv('HTTP_IF_MODIFIED_SINCE')
+			if sSince == None:
+				return False
+			tSince = email.utils.parsedate_tz(sSince)
+			if (tSince == None) or (int(rModified) > email.utils.mktime_tz(tSince)):
+				return False
+
+		self.fLog.write("   Response cache: Client copy is current, %s"%sEtag)
+		webio.pout("Status: 304 Not Modified\r\n")
+		for sHdr in self.headers():
+			webio.pout("%s\r\n"%sHdr)
+		webio.pout("\r\n")
+		webio.flushOut()
+		self._touch()
+		return True
+
+	def replay(self):
+		"""Send the saved copy of this response if there is a current one.
+		Returns True if the response was sent."""
+		if self.sPath == None:
+			return False
+		try:
+			fIn = open(self.sPath, 'rb')
+		except (IOError, OSError):
+			return False
+		try:
+			xLine = fIn.readline(256)
+		finally:
+			fIn.close()
+
+		lLine = xLine.decode('ascii', 'replace').split()
+		if (len(lLine) != 4) or (lLine[0] != MAGIC) or (lLine[1] != str(VERSION)):
+			return False
+		if lLine[2] != self.tValid[0]:
+			return False
+		try:
+			rCreated = float(lLine[3])
+		except ValueError:
+			return False
+		if rCreated + _confNum(self.dConf, 'RESPONSE_CACHE_TTL', DEF_TTL) < time.time():
+			return False
+
+		try:
+			nSent = webio.sendFile(self.sPath, len(xLine))
+		except (IOError, OSError) as e:
+			self.fLog.write("Client went away, %s"%e)
+			webio.clientGone()
+			return True
+		self.fLog.write("   Response cache: Sent %d saved bytes from %s"%(nSent, self.sPath))
+		self._touch()
+		return True
+
+	def answer(self):
+		"""Answer the request without reading any cache blocks if possible.
+		Returns True if a response was sent."""
+		return self.notModified() or self.replay()
+
+	###########################################################################
+	def record(self):
+		"""Add the validator headers to the response about to be sent, and
+		start saving a copy of it if responses are cached."""
+		webio.g_lRespHdrs += self.headers()
+		if self.sPath == None:
+			return
+
+		sDir = os.path.dirname(self.sPath)
+		try:
+			if not os.path.isdir(sDir):
+				os.makedirs(sDir)
+			self.sTmp = "%s.%d.tmp"%(self.sPath, os.getpid())
+			self.fOut = open(self.sTmp, 'wb')
+			self.fOut.write(("%s %d %s %d\n"%(
+				MAGIC, VERSION, self.tValid[0], int(time.time())
+			)).encode('ascii'))
+		except (IOError, OSError) as e:
+			self.fLog.write("WARNING: Can't save response in %s, %s"%(sDir, e))
+			self._drop()
+			return
+		webio.capture(self)
+
+	def write(self, xData):
+		"""Output capture callback, see webio.capture()"""
+		if self.fOut == None:
+			return
+		self.nBytes += len(xData)
+		if self.nBytes > self.nMax // 10:
+			self._drop()
+			return
+		try:
+			self.fOut.write(xData)
+		except (IOError, OSError) as e:
+			self.fLog.write("WARNING: Can't save response in %s, %s"%(self.sTmp, e))
+			self._drop()
+
+	def _drop(self):
+		if self.fOut != None:
+			self.fOut.close()
+			self.fOut = None
+		if self.sTmp != None:
+			try:
+				os.remove(self.sTmp)
+			except OSError:
+				pass
+			self.sTmp = None
+
+	def finish(self, bOkay):
+		"""Stop recording, keeping the copy if the response was sent
+		completely and without error."""
+		webio.endCapture(self)
+		if self.fOut == None:
+			return
+		if (not bOkay) or (self.nBytes == 0) or webio.g_bClientGone or \
+		   (self.rdr.wait() != None):
+			self._drop()
+			return
+
+		try:
+			self.fOut.close()
+			self.fOut = None
+			os.rename(self.sTmp, self.sPath)
+			self.sTmp = None
+		except (IOError, OSError) as e:
+			self.fLog.write("WARNING: Can't save response in %s, %s"%(self.sPath, e))
+			self._drop()
+			return
+		self.fLog.write("   Response cache: Saved %d bytes as %s"%(self.nBytes, self.sPath))
+
+		prune(self.fLog, self.dConf)
+
+##############################################################################
+def prune(fLog, dConf):
+	"""Remove expired saved responses, then the oldest ones until the total
+	size is back under budget."""
+	nMax = maxBytes(dConf)
+	sDir = cacheDir(dConf)
+	try:
+		lNames = os.listdir(sDir)
+	except OSError:
+		return
+
+	rNow = time.time()
+	rTtl = _confNum(dConf, 'RESPONSE_CACHE_TTL', DEF_TTL)
+	lKeep = []
+	nTotal = 0
+	nRemoved = 0
+	for sName in lNames:
+		sPath = pjoin(sDir, sName)
+		try:
+			st = os.stat(sPath)
+		except OSError:
+			continue
+		if sName.endswith('.tmp'):
+			bOld = (st.st_mtime < rNow - TMP_AGE)
+		else:
+			bOld = (nMax == None) or (st.st_mtime < rNow - rTtl)
+		if bOld:
+			try:
+				os.remove(sPath)
+				nRemoved += 1
+			except OSError:
+				pass
+			continue
+		if sName.endswith('.rsp'):
+			lKeep.append( (st.st_mtime, st.st_size, sPath) )
+		nTotal += st.st_size
+
+	if (nMax != None) and (nTotal > nMax):
+		lKeep.sort()
+		for (rTime, nSize, sPath) in lKeep:
+			if nTotal <= nMax * LOW_WATER:
+				break
+			try:
+				os.remove(sPath)
+				nRemoved += 1
+			except OSError:
+				pass
+			nTotal -= nSize
+
+	if nRemoved > 0:
+		fLog.write("   Response cache: Removed %d old responses, %d bytes remain"%(
+		           nRemoved, nTotal))
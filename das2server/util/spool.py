@@ -0,0 +1,285 @@
+"""Single-flight reader runs for identical concurrent requests
+
+When new data are released many clients ask for the same range at once,
+and each request would run the same reader and queue the same cache
+builds.  If SPOOL_ROOT is set, the first of a set of identical requests
+becomes the leader: it runs the reader as usual and copies every byte it
+sends, HTTP headers included, to a spool file.  Identical requests that
+arrive while it is running follow the spool as it grows, so the reader
+runs once.
+
+For each request key there are two files in SPOOL_ROOT:
+
+   KEY.lock   Held with an exclusive flock() by the current leader
+   KEY.spool  The response so far, behind a fixed size status header
+
+The spool file is also locked by the leader, so a follower can tell a live
+spool from one left by a leader that died.  The header reads RUN while the
+response is being sent, then DONE, or FAIL if the leader's client went
+away before the response was complete.  The leader removes the spool when
+it's done, open copies stay readable until the followers close them.
+Followers that had not sent anything when a leader failed try again, and
+may become the leader themselves.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import os
+import os.path
+import time
+import errno
+import hashlib
+from os.path import join as pjoin
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from . import webio
+
+MAGIC = b'das2spool '
+HDR_SZ = 16
+RUN = b'RUN  '
+DONE = b'DONE '
+FAIL = b'FAIL '
+
+# Seconds between checks for new output while following
+POLL_SEC = 0.05
+
+# Times to look for a leader's spool before running the reader anyway
+MAX_TRIES = 40
+
+# Stop following a leader that sends nothing for this many seconds
+STALL_SEC = 300
+
+READ_SZ = 65536
+
+# _relay() results
+RETRY = 0
+RELAYED = 1
+PARTIAL = 2
+ALONE = 3
+
+##############################################################################
+def isEnabled(dConf):
+	return ('SPOOL_ROOT' in dConf) and (fcntl != None)
+
+def _hdr(xStatus):
+	return MAGIC + xStatus + b'\n'
+
+def _status(fd):
+	os.lseek(fd, 0, os.SEEK_SET)
+	xHdr = os.read(fd, HDR_SZ)
+	if (len(xHdr) < HDR_SZ) or (not xHdr.startswith(MAGIC)):
+		return None
+	return xHdr[len(MAGIC):len(MAGIC) + len(RUN)]
+
+def _tryLock(fd, nMode):
+	"""Take a non-blocking flock(), returns False if someone else holds it"""
+	try:
+		fcntl.flock(fd, nMode | fcntl.LOCK_NB)
+		return True
+	except (IOError, OSError) as e:
+		if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+			return False
+		raise
+
+def _sameFile(sPath, fd):
+	try:
+		return os.stat(sPath).st_ino == os.fstat(fd).st_ino
+	except OSError:
+		return False
+
+##############################################################################
+class Flight(object):
+	"""Shares one reader run among identical concurrent requests.  Typical
+	use by a handler:
+
+	   flight = Flight(fLog, dConf, lKey)
+	   if flight.follow():
+	      return 0
+	   ... run the reader and send the response as usual ...
+	   flight.finish(not webio.g_bClientGone)
+	"""
+
+	def __init__(self, fLog, dConf, lKey):
+		self.fLog = fLog
+		self.bEnabled = isEnabled(dConf)
+		sName = hashlib.sha1(u'\n'.join(lKey).encode('utf-8')).hexdigest()
+		if self.bEnabled:
+			self.sLock = pjoin(dConf['SPOOL_ROOT'], sName + '.lock')
+			self.sSpool = pjoin(dConf['SPOOL_ROOT'], sName + '.spool')
+		self.fdLock = None
+		self.fdSpool = None
+
+	def follow(self):
+		"""Relay the response of an identical request that is already
+		running.  Returns True if a response was sent, or False if the
+		caller should run the request itself, in which case it may now be
+		the leader."""
+		if not self.bEnabled:
+			return False
+
+		for i in range(MAX_TRIES):
+			try:
+				if self._lead():
+					return False
+				nRet = self._relay()
+			except (IOError, OSError) as e:
+				self.fLog.write("WARNING: Single-flight spool %s unusable, %s"%(
+				                self.sSpool, e))
+				self._release()
+				return False
+			if nRet == ALONE:
+				return False
+			if nRet != RETRY:
+				return True
+			time.sleep(POLL_SEC)
+
+		self.fLog.write("   Single-flight: No usable spool at %s, running alone"%self.sSpool)
+		return False
+
+	def _lead(self):
+		"""Become the leader if no one else is, returns True if so"""
+		sDir = os.path.dirname(self.sLock)
+		if not os.path.isdir(sDir):
+			os.makedirs(sDir)
+
+		fd = os.open(self.sLock, os.O_RDWR | os.O_CREAT, 0o644)
+		if not _tryLock(fd, fcntl.LOCK_EX):
+			os.close(fd)
+			return False
+		self.fdLock = fd
+
+		sTmp = "%s.%d.tmp"%(self.sSpool, os.getpid())
+		self.fdSpool = os.open(sTmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		fcntl.flock(self.fdSpool, fcntl.LOCK_EX)
+		os.write(self.fdSpool, _hdr(RUN))
+		os.rename(sTmp, self.sSpool)
+
+		self.fLog.write("   Single-flight: Leading, spooling output to %s"%self.sSpool)
+		webio.capture(self)
+		return True
+
+	def _relay(self):
+		"""Send the output of the current leader"""
+		try:
+			fd = os.open(self.sSpool, os.O_RDONLY)
+		except OSError as e:
+			if e.errno == errno.ENOENT:
+				return RETRY    # Leader just starting or just finished
+			raise
+
+		nSent = 0
+		rLast = time.time()
+		try:
+			if _tryLock(fd, fcntl.LOCK_SH):
+				# No one writing it, usable only if it was finished
+				fcntl.flock(fd, fcntl.LOCK_UN)
+				if _status(fd) != DONE:
+					return RETRY
+			else:
+				self.fLog.write("   Single-flight: Following %s"%self.sSpool)
+
+			nOff = HDR_SZ
+			while True:
+				os.lseek(fd, nOff, os.SEEK_SET)
+				xData = os.read(fd, READ_SZ)
+				if len(xData) > 0:
+					try:
+						webio.pout(xData)
+						webio.flushOut()
+					except (IOError, OSError) as e:
+						self.fLog.write("Client went away after %d bytes, %s"%(nSent, e))
+						webio.clientGone()
+						return PARTIAL
+					nOff += len(xData)
+					nSent += len(xData)
+					rLast = time.time()
+					continue
+
+				xStatus = _status(fd)
+				if xStatus == RUN and _tryLock(fd, fcntl.LOCK_SH):
+					fcntl.flock(fd, fcntl.LOCK_UN)
+					xStatus = _status(fd)  # May have finished just now
+					if xStatus == RUN:
+						xStatus = FAIL
+
+				if xStatus == DONE:
+					# Anything written before the status changed is in by now
+					os.lseek(fd, nOff, os.SEEK_SET)
+					if len(os.read(fd, 1)) > 0:
+						continue
+					self.fLog.write("   Single-flight: Relayed %d bytes"%nSent)
+					return RELAYED
+
+				if xStatus != RUN:
+					if nSent == 0:
+						self.fLog.write("   Single-flight: Leader stopped early, retrying")
+						return RETRY
+					self.fLog.write("ERROR: Single-flight leader stopped after "+\
+					                "%d bytes, response is incomplete"%nSent)
+					return PARTIAL
+
+				if time.time() - rLast > STALL_SEC:
+					if nSent == 0:
+						self.fLog.write("   Single-flight: Leader stalled, running alone")
+						return ALONE
+					self.fLog.write("ERROR: Single-flight leader stalled after "+\
+					                "%d bytes, response is incomplete"%nSent)
+					return PARTIAL
+
+				time.sleep(POLL_SEC)
+		finally:
+			os.close(fd)
+
+	###########################################################################
+	def write(self, xData):
+		"""Output capture callback, see webio.capture()"""
+		if self.fdSpool == None:
+			return
+		try:
+			os.lseek(self.fdSpool, 0, os.SEEK_END)
+			while len(xData) > 0:
+				xData = xData[os.write(self.fdSpool, xData):]
+		except (IOError, OSError) as e:
+			self.fLog.write("WARNING: Can't write single-flight spool %s, %s"%(
+			                self.sSpool, e))
+			self._finishSpool(FAIL)
+
+	def _finishSpool(self, xStatus):
+		webio.endCapture(self)
+		if self.fdSpool == None:
+			return
+		try:
+			os.lseek(self.fdSpool, 0, os.SEEK_SET)
+			os.write(self.fdSpool, _hdr(xStatus))
+			if _sameFile(self.sSpool, self.fdSpool):
+				os.remove(self.sSpool)
+		except (IOError, OSError):
+			pass
+		os.close(self.fdSpool)
+		self.fdSpool = None
+
+	def _release(self):
+		self._finishSpool(FAIL)
+		if self.fdLock != None:
+			if _sameFile(self.sLock, self.fdLock):
+				try:
+					os.remove(self.sLock)
+				except OSError:
+					pass
+			os.close(self.fdLock)
+			self.fdLock = None
+
+	def finish(self, bComplete):
+		"""Mark the spool as finished if this request was the leader.  Set
+		bComplete if the whole response was sent, even if it ended with an
+		error message, since followers would get the same error."""
+		if self.fdLock == None:
+			return
+		if bComplete:
+			self._finishSpool(DONE)
+		self._release()
@@ -4,7 +4,11 @@
 from __future__ import absolute_import
 
 import sys
+import os
+import errno
 import time
+import re
+import socket
 
 try:
 	import redis
@@ -51,15 +55,24 @@ class QueueBroker(object):
 			raise E.ServerError(str(e))
 		return ret
 	
-	def brpoplpush(self, sPopQueue, sPushQueue):
+	def brpoplpush(self, sPopQueue, sPushQueue, nTimeout=0):
+		"""Block until an item can be moved, or for nTimeout seconds if that's
+		not 0.  Returns None on timeout."""
 		try:
-			ret = self.broker.brpoplpush(sPopQueue, sPushQueue)
+			ret = self.broker.brpoplpush(sPopQueue, sPushQueue, nTimeout)
 		except redis.exceptions.ConnectionError as e:
 			raise E.ServerError(str(e))
 		
 			
 		return ret
 			
+	def rpop(self, sQueue):
+		try:
+			ret = self.broker.rpop(sQueue)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
 	def lpop(self, sQueue):
 		try:
 			ret = self.broker.lpop(sQueue)
@@ -80,7 +93,134 @@ class QueueBroker(object):
 		except redis.exceptions.ConnectionError as e:
 			raise E.ServerError(str(e))
 		return ret
-		
+	
+	def llen(self, sKey):
+		try:
+			ret = self.broker.llen(sKey)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def rpoplpush(self, sPopQueue, sPushQueue):
+		try:
+			ret = self.broker.rpoplpush(sPopQueue, sPushQueue)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def hget(self, sKey, sField):
+		try:
+			ret = self.broker.hget(sKey, sField)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def hset(self, sKey, sField, sVal):
+		try:
+			ret = self.broker.hset(sKey, sField, sVal)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def hkeys(self, sKey):
+		try:
+			ret = self.broker.hkeys(sKey)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def hincrby(self, sKey, sField, nAmount=1):
+		try:
+			ret = self.broker.hincrby(sKey, sField, nAmount)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def setex(self, sKey, nSeconds, sVal):
+		try:
+			ret = self.broker.setex(sKey, nSeconds, sVal)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def exists(self, sKey):
+		try:
+			ret = self.broker.exists(sKey)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return (ret > 0)
+	
+	def hdel(self, sKey, sField):
+		try:
+			ret = self.broker.hdel(sKey, sField)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+	
+	def pushUnique(self, sQueue, nRank, sPending, sId, sVal, rNow, rMaxAge):
+		"""Push sVal onto sQueue and record sId in the hash sPending, unless
+		sId was recorded less than rMaxAge seconds before rNow for a queue of
+		the same or better rank.  If it was recorded for a worse rank the old
+		value is removed from it's queue.  All this happens in one server
+		side script so no other client can slip in between.  Returns True if
+		the value was pushed.
+		"""
+		try:
+			ret = self.broker.eval(g_sPushUnique, 2, sQueue, sPending, sId, 
+			                       sVal, "%.3f"%rNow, "%.3f"%rMaxAge, "%d"%nRank)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return (ret == 1)
+	
+	def takeTask(self, sQueue, sWorkQueue, sInflight, sPending):
+		"""Move the oldest value of sQueue onto sWorkQueue, record it in the
+		hash sInflight under sWorkQueue, and remove its job id from the hash
+		sPending, all in one server side script.  Returns the value or None
+		if sQueue is empty.
+		"""
+		try:
+			ret = self.broker.eval(g_sTakeTask, 4, sQueue, sWorkQueue, sInflight,
+			                       sPending)
+		except redis.exceptions.ConnectionError as e:
+			raise E.ServerError(str(e))
+		return ret
+
+# KEYS: queue, working queue, inflight hash, pending hash.  The job id is
+# everything after the 6th '|', see jobId()
+g_sTakeTask = """
+local v = redis.call('rpop', KEYS[1])
+if not v then
+	return false
+end
+redis.call('lpush', KEYS[2], v)
+redis.call('hset', KEYS[3], KEYS[2], v)
+local i = 0
+for n = 1, 6 do
+	i = string.find(v, '|', i + 1, true)
+	if not i then
+		return v
+	end
+end
+redis.call('hdel', KEYS[4], string.sub(v, i + 1))
+return v
+"""
+		
+# KEYS: queue, pending hash  ARGV: job id, task, now, max age, queue rank
+g_sPushUnique = """
+local v = redis.call('hget', KEYS[2], ARGV[1])
+if v then
+	local t, q, r, old = string.match(v, '^(%S+) (%S+) (%S+) (.*)$')
+	if t and (tonumber(t) > tonumber(ARGV[3]) - tonumber(ARGV[4])) then
+		if tonumber(r) <= tonumber(ARGV[5]) then
+			return 0
+		end
+		redis.call('lrem', q, 1, old)
+	end
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[3]..' '..KEYS[1]..' '..ARGV[5]..' '..ARGV[2])
+redis.call('lpush', KEYS[1], ARGV[2])
+return 1
+"""
 
 ##############################################################################
 def getBroker(fLog, dConf):
@@ -150,6 +290,296 @@ def curTime():
 	return sTm
 
 
+##############################################################################
+# Job submission
+
+# Work queue lanes, highest priority first.  Cache builds for cache misses
+# of live requests go in the interactive lane, bulk is for backfills and
+# other jobs submitted by hand.
+LANE_INTERACTIVE = 'interactive'
+LANE_NORMAL = 'normal'
+LANE_BULK = 'bulk'
+LANES = (LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK)
+
+# The normal lane keeps the original queue name
+g_dLaneQueue = {
+	LANE_INTERACTIVE: 'das2_todo_interactive',
+	LANE_NORMAL:      'das2_todo',
+	LANE_BULK:        'das2_todo_bulk'
+}
+
+# Identities of the jobs waiting in any lane, hash of job id to
+# "time_queued queue rank task"
+PENDING_KEY = 'das2_pending'
+
+# Pending entries older than this are ignored.  Entries are removed when the
+# arbiter takes a job, so this only matters if a queue is edited by hand.
+PENDING_MAX_AGE = 7*86400
+
+# Default number of times waiting jobs in a lane may be passed over for
+# jobs in higher priority lanes before one of them is taken anyway
+DEF_STARVE_LIMIT = 10
+
+def laneQueue(sLane):
+	"""Get the broker list for a lane"""
+	if sLane not in g_dLaneQueue:
+		raise E.QueryError("Unknown work queue lane '%s', expected one of %s"%(
+		                   sLane, ', '.join(LANES)))
+	return g_dLaneQueue[sLane]
+
+def jobId(sTask):
+	"""Get the identity of a task, the category and the job arguments.  Tasks
+	with the same identity do the same work no matter who asked for them."""
+	return '|'.join(sTask.split('|')[JOB_FIELDS.CATEGORY:])
+
+def submitTask(broker, sTask, sLane=LANE_NORMAL):
+	"""Add a task to a lane of the todo queue unless an identical one is
+	already waiting in the same or a higher priority lane.  An identical
+	task waiting in a lower priority lane is moved up.  Returns True if the
+	task was queued.
+
+	Raises E.ServerError if the broker can't be reached.
+	"""
+	return broker.pushUnique(laneQueue(sLane), LANES.index(sLane), PENDING_KEY,
+	                         jobId(sTask), sTask, time.time(), PENDING_MAX_AGE)
+
+def starveLimit(dConf):
+	"""Get the ARBITER_STARVE_LIMIT setting"""
+	if 'ARBITER_STARVE_LIMIT' not in dConf:
+		return DEF_STARVE_LIMIT
+	try:
+		return max(int(dConf['ARBITER_STARVE_LIMIT'], 10), 0)
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key ARBITER_STARVE_LIMIT to an integer"%(
+			dConf['ARBITER_STARVE_LIMIT'])
+		)
+
+def takeTask(broker, sWorkQueue, dPassed, nStarveLimit):
+	"""Move the next task to run onto a working queue.  Tasks are taken from
+	the highest priority lane that has any, unless a lower lane has been
+	passed over nStarveLimit times.  A limit of 0 means strict priority.
+
+	dPassed - Dictionary of lane name to times passed over, updated by this
+	          function.  Keep it between calls.
+
+	Returns the task, or None if all lanes are empty.
+	"""
+	lWaiting = [sLane for sLane in LANES if broker.llen(laneQueue(sLane)) > 0]
+	if len(lWaiting) == 0:
+		return None
+
+	sTake = lWaiting[0]
+	for sLane in lWaiting[1:]:
+		if nStarveLimit > 0 and dPassed.get(sLane, 0) >= nStarveLimit:
+			sTake = sLane
+			break
+
+	for sLane in lWaiting:
+		if sLane == sTake:
+			dPassed[sLane] = 0
+		else:
+			dPassed[sLane] = dPassed.get(sLane, 0) + 1
+
+	return broker.takeTask(laneQueue(sTake), sWorkQueue, INFLIGHT_KEY,
+	                       PENDING_KEY)
+
+
+##############################################################################
+# Recovering tasks from arbiters that died
+
+# Tasks that have been moved to a working queue, hash of working queue name to
+# the task as it was queued.  Entries are removed when the task finishes.
+INFLIGHT_KEY = 'das2_inflight'
+
+# Times each job has been put back in the todo queue, hash of job id to count
+ATTEMPTS_KEY = 'das2_attempts'
+
+# Default number of times a job is run before it is given up
+DEF_MAX_ATTEMPTS = 3
+
+# Arbiters refresh a heartbeat key while running.  Working queues that
+# belong to an arbiter without one are considered abandoned.
+HEARTBEAT_SEC = 10
+HEARTBEAT_TTL = 60
+
+def maxAttempts(dConf):
+	"""Get the ARBITER_MAX_ATTEMPTS setting"""
+	if 'ARBITER_MAX_ATTEMPTS' not in dConf:
+		return DEF_MAX_ATTEMPTS
+	try:
+		return max(int(dConf['ARBITER_MAX_ATTEMPTS'], 10), 1)
+	except ValueError:
+		raise E.ServerError(
+			"Can't convert value '%s' for server config key ARBITER_MAX_ATTEMPTS to an integer"%(
+			dConf['ARBITER_MAX_ATTEMPTS'])
+		)
+
+def arbiterId():
+	"""Identify this arbiter process among all those sharing a broker,
+	<hostname>_<pid>"""
+	return '%s_%d'%(socket.gethostname(), os.getpid())
+
+def workQueue(sArbiter, iSlot):
+	"""The working queue for a task slot of an arbiter"""
+	return 'das2_working_%s_%d'%(sArbiter, iSlot)
+
+def heartbeatKey(sArbiter):
+	return 'das2_heartbeat_%s'%sArbiter
+
+def heartbeat(broker, sArbiter):
+	"""Mark an arbiter as alive for HEARTBEAT_TTL seconds"""
+	broker.setex(heartbeatKey(sArbiter), HEARTBEAT_TTL, curTime())
+
+def _queueArbiter(sWorkQueue):
+	"""Get the arbiter ID from das2_working_<arbiter>_<slot>, or None.  For
+	queues of older arbiters this is just the PID."""
+	sRest = sWorkQueue[len('das2_working_'):]
+	if sRest.isdigit():
+		return sRest
+	lParts = sRest.rsplit('_', 1)
+	if len(lParts) < 2 or len(lParts[0]) == 0 or not lParts[1].isdigit():
+		return None
+	return lParts[0]
+
+def finishedTask(broker, sWorkQueue, sTask):
+	"""Record that the task on a working queue has run, successful or not,
+	and should not be recovered"""
+	broker.hdel(INFLIGHT_KEY, sWorkQueue)
+	broker.hdel(ATTEMPTS_KEY, jobId(sTask))
+
+# Fields added to a task by TaskHandler.begin() and end()
+g_reTaskTime = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}$')
+
+def _asQueued(sTask):
+	"""Strip the start, status, progress and end fields from a task found on
+	a working queue"""
+	lTask = sTask.split('|')
+	if len(lTask) >= JOB_FIELDS.CATEGORY + 5 and g_reTaskTime.match(lTask[-4]) \
+	   and g_reTaskTime.match(lTask[-2]) and lTask[-1].lstrip('-').isdigit():
+		return '|'.join(lTask[:-4])
+	if len(lTask) >= JOB_FIELDS.CATEGORY + 4 and g_reTaskTime.match(lTask[-3]):
+		return '|'.join(lTask[:-3])
+	return sTask
+
+# Outcomes of putting back a task, see recoverTask()
+RECOVER_REQUEUED = 'requeued'  # back in the normal lane
+RECOVER_WAITING  = 'waiting'   # an identical job is already waiting
+RECOVER_FAILED   = 'failed'    # given up, moved to das2_finished
+
+def _requeue(broker, sTask, nMaxAttempts, bCount):
+	"""Count an attempt for a task, if bCount is True, and put it back in the
+	normal lane, or give it up.  Returns (attempts, outcome)"""
+	sId = jobId(sTask)
+	if bCount:
+		nAttempts = broker.hincrby(ATTEMPTS_KEY, sId, 1)
+	else:
+		nAttempts = int(broker.hget(ATTEMPTS_KEY, sId) or 0)
+	if bCount and nAttempts >= nMaxAttempts:
+		broker.hdel(ATTEMPTS_KEY, sId)
+		sNow = curTime()
+		broker.lpush('das2_finished', '|'.join([sTask, sNow,
+		             'Given up after %d attempts'%nAttempts, sNow, '13']))
+		return (nAttempts, RECOVER_FAILED)
+	
+	# A pending entry for this very task is left over from before it was
+	# taken, it would make submitTask() think the task is still waiting
+	sPending = broker.hget(PENDING_KEY, sId)
+	if sPending != None and sPending.split(' ', 3)[-1] == sTask:
+		broker.hdel(PENDING_KEY, sId)
+	
+	if submitTask(broker, sTask, LANE_NORMAL):
+		return (nAttempts, RECOVER_REQUEUED)
+	return (nAttempts, RECOVER_WAITING)
+
+def recoverTask(broker, sWorkQueue, nMaxAttempts, bCount=True):
+	"""Put the task held by the working queue of a process that died back in
+	the normal lane of the todo queue, and remove the working queue.  A job
+	that has already been tried nMaxAttempts times is moved to das2_finished
+	with an error status instead.  Set bCount to False for tasks that were
+	cancelled, such as when the arbiter is shut down, so that they are not
+	counted as an attempt.
+
+	Returns a list of (task, attempts, outcome) tuples, one for each task
+	recovered, where outcome is one of the RECOVER_ values.
+	"""
+	lOut = []
+	sTask = broker.hget(INFLIGHT_KEY, sWorkQueue)
+	if sTask != None:
+		# Only one caller gets to remove the entry, it owns the task
+		if broker.hdel(INFLIGHT_KEY, sWorkQueue) == 0:
+			return lOut
+		(nAttempts, sOutcome) = _requeue(broker, sTask, nMaxAttempts, bCount)
+		lOut.append( (sTask, nAttempts, sOutcome) )
+		broker.delete(sWorkQueue)
+		return lOut
+	
+	# Tasks with no inflight entry, such as those left by older arbiters.
+	# Each pop hands a task to only one caller.
+	while True:
+		sLeft = broker.rpop(sWorkQueue)
+		if sLeft == None:
+			break
+		sTask = _asQueued(sLeft)
+		(nAttempts, sOutcome) = _requeue(broker, sTask, nMaxAttempts, bCount)
+		lOut.append( (sTask, nAttempts, sOutcome) )
+	
+	return lOut
+
+def logRecovered(fLog, sWorkQueue, lRecovered):
+	"""Log the results of recoverTask()"""
+	for (sTask, nAttempts, sOutcome) in lRecovered:
+		if sOutcome == RECOVER_REQUEUED:
+			fLog.write("Requeued task from '%s' after %d failed attempts - '%s'"%(
+			           sWorkQueue, nAttempts, sTask))
+		elif sOutcome == RECOVER_WAITING:
+			fLog.write("Task from '%s' is already queued again - '%s'"%(
+			           sWorkQueue, sTask))
+		else:
+			fLog.write("ERROR: Task from '%s' failed %d times, "%(
+			           sWorkQueue, nAttempts) + "giving up - '%s'"%sTask)
+
+def _pidAlive(nPid):
+	"""True if a process ID is in use on this host"""
+	try:
+		os.kill(nPid, 0)
+	except OSError as e:
+		return e.errno != errno.ESRCH
+	return True
+
+def reapWorkQueues(fLog, broker, nMaxAttempts, bLegacy=False):
+	"""Recover the tasks of all working queues that belong to arbiters with
+	no live heartbeat.  Returns the number of tasks found.
+
+	Queues of older arbiters, das2_working_<pid>, have no heartbeat and may
+	belong to one that is still running.  They are left alone unless bLegacy
+	is true, and even then only if no process on this host has the PID.
+	"""
+	lQueues = set(broker.keys('das2_working_*'))
+	lQueues.update(broker.hkeys(INFLIGHT_KEY))
+	
+	dAlive = {}
+	nFound = 0
+	for sQueue in sorted(lQueues):
+		sArbiter = _queueArbiter(sQueue)
+		if sArbiter == None:
+			continue
+		if sArbiter.isdigit():
+			if (not bLegacy) or _pidAlive(int(sArbiter)):
+				continue
+		else:
+			if sArbiter not in dAlive:
+				dAlive[sArbiter] = broker.exists(heartbeatKey(sArbiter))
+			if dAlive[sArbiter]:
+				continue
+		
+		lRecovered = recoverTask(broker, sQueue, nMaxAttempts)
+		logRecovered(fLog, sQueue, lRecovered)
+		nFound += len(lRecovered)
+	
+	return nFound
+
+
 ##############################################################################
 #def makeJobEntry(sReq, sReqEx, sRmtReq, sRmtReqEx, sUser, sCat, lJobArgs):
 #	"""Make generic job enteries
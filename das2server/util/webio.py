@@ -4,6 +4,8 @@ from __future__ import absolute_import
 import os
 import sys
 import time
+import stat
+import errno
 import codecs
 
 from os.path import join as pjoin
@@ -20,24 +22,149 @@ def pout(item):
 	"""Write bytes or strings, in python 2 or 3
 	If input item is bytes, write them, if item is a unicode string encode as
 	utf-8 first"""
+	
+	if g_bClientGone:
+		return
+	
+	if isinstance(item, unicode):
+		item = item.encode('utf-8')
 		
 	if sys.version_info[0] == 2:
-		if isinstance(item, unicode):
-			sys.stdout.write(item.encode('utf-8'))
-		else:
-			sys.stdout.write(item)
+		sys.stdout.write(item)
 	else:
-		if isinstance(item, unicode):
-			sys.stdout.buffer.write(item.encode('utf-8'))
-		else:
-			sys.stdout.buffer.write(item)
+		sys.stdout.buffer.write(item)
+	
+	for obj in g_lCapture:
+		obj.write(item)
 			
 def flushOut():
+	if g_bClientGone:
+		return
 	if sys.version_info[0] == 2:
 		sys.stdout.flush()
 	else:
 		sys.stdout.buffer.flush()
 
+##############################################################################
+# Client disconnect handling
+
+# Set once a write to the client has failed, further output is dropped
+g_bClientGone = False
+
+def clientGone():
+	"""Call when the client has disconnected.  Output sent with pout() is
+	discarded from now on, and if standard output is a real file descriptor
+	it is pointed at /dev/null so that any buffered data or stray writes
+	don't raise errors on exit.
+	"""
+	global g_bClientGone
+	g_bClientGone = True
+
+	fd = _stdoutFd()
+	if fd == None:
+		return
+	try:
+		fdNull = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(fdNull, fd)
+		os.close(fdNull)
+	except OSError:
+		pass
+
+##############################################################################
+# Response capture and extra headers, used by the response cache
+
+# Objects with a write() method that get a copy of everything sent by pout()
+g_lCapture = []
+
+# Extra header lines for the next 200 response, such as cache validators
+g_lRespHdrs = []
+
+def capture(obj):
+	"""Copy all output to obj.write() until endCapture() is called.  Zero
+	copy output is turned off while capturing so that nothing bypasses
+	pout()."""
+	g_lCapture.append(obj)
+
+def endCapture(obj=None):
+	"""Stop copying output to obj, or to anything if obj is None"""
+	if obj == None:
+		del g_lCapture[:]
+	elif obj in g_lCapture:
+		g_lCapture.remove(obj)
+
+##############################################################################
+# Zero copy output, only available when standard output is a real file
+# descriptor, as it is for CGI programs
+
+def _stdoutFd():
+	try:
+		return sys.stdout.fileno()
+	except (AttributeError, ValueError, OSError):
+		return None
+
+def spliceFd():
+	"""Get the file descriptor for standard output if data can be moved to it
+	with os.splice(), otherwise None.  Splicing needs Linux, python 3.10 or
+	better and a pipe or socket on standard output.
+	"""
+	if (not hasattr(os, 'splice')) or (len(g_lCapture) > 0):
+		return None
+
+	fd = _stdoutFd()
+	if fd == None:
+		return None
+
+	try:
+		nMode = os.fstat(fd).st_mode
+	except OSError:
+		return None
+
+	if stat.S_ISFIFO(nMode) or stat.S_ISSOCK(nMode):
+		return fd
+	return None
+
+def sendFile(sPath, nOffset=0, nLen=None):
+	"""Send all or part of a file to standard output.  The file contents are
+	handed to the kernel with os.sendfile() when possible, otherwise they are
+	copied through a buffer.
+
+	Returns the number of bytes sent.
+	"""
+	flushOut()
+	if nLen == None:
+		nLen = os.path.getsize(sPath) - nOffset
+
+	nSent = 0
+	fIn = open(sPath, 'rb')
+	try:
+		fdOut = _stdoutFd()
+		if (fdOut != None) and hasattr(os, 'sendfile') and (len(g_lCapture) == 0):
+			try:
+				while nSent < nLen:
+					n = os.sendfile(fdOut, fIn.fileno(), nOffset + nSent, nLen - nSent)
+					if n == 0:
+						break
+					nSent += n
+				return nSent
+			except OSError as e:
+				# Some output types aren't supported by the kernel, copy the
+				# rest instead
+				if nSent > 0 or e.errno not in (errno.EINVAL, errno.ENOSYS):
+					raise
+
+		fIn.seek(nOffset + nSent)
+		while nSent < nLen:
+			xData = fIn.read(min(65536, nLen - nSent))
+			if len(xData) == 0:
+				break
+			pout(xData)
+			nSent += len(xData)
+		flushOut()
+	finally:
+		fIn.close()
+
+	return nSent
+
 ##############################################################################
 def getScriptUrl():
 	"""Returns an ascii string (not utf-8) that provides the portion of the
@@ -261,6 +388,11 @@ def queryError(fLog, uOut, bHdrSent=False):
 		pout("Status: 400 Bad Request\r\n")
 	dasExcept('BadRequest', uOut, fLog, bHdrSent)
 	
+def limitError(fLog, uOut, bHdrSent=False):
+	if not bHdrSent:
+		pout("Status: 503 Service Unavailable\r\n")
+	dasExcept('ResourceLimit', uOut, fLog, bHdrSent)
+
 def forbidError(fLog, uOut, bHdrSent=False):
 	if not bHdrSent:
 		pout("Status: 403 Forbidden\r\n")
@@ -318,6 +450,9 @@ class DasLogFile(object):
 		
 	def fileno(self):
 		return self._file.fileno()
+	
+	def flush(self):
+		self._file.flush()
 		
 	def write(self, sMsg):
 	
@@ -0,0 +1,261 @@
+"""Long-lived WSGI front end for the das2 server
+
+The CGI program das2_srvcgi_main re-reads the configuration file, re-imports
+das2server.util and re-imports the request handler for every HTTP request.
+The Application object in this module does that work once and then routes
+each request through route.serveReq(), so the existing handleReq() functions
+run unchanged.
+
+Handlers are CGI programs at heart, they read os.environ and write a CGI
+style header block followed by the message body to sys.stdout.  To keep
+them working, each request swaps in a CGI environment and a stdout object
+that turns the header block into a WSGI start_response() call.  Since
+os.environ and sys.stdout are process wide, requests are serialized, run
+the WSGI container with one thread per process (ex: mod_wsgi threads=1)
+and scale with processes instead.
+"""
+
+# make py2 code safer by preventing relative imports
+from __future__ import absolute_import
+
+import sys
+import os
+import io
+import cgi
+import time
+import threading
+
+from . import webio
+from . import misc
+from . import route
+
+# Ugg, the python 2/3 mess
+try:
+	unicode
+except NameError:
+	unicode = str
+
+##############################################################################
+# Environment variables handed down to handlers, all HTTP_* variables are
+# passed as well
+
+g_lCgiVars = [
+	'AUTH_TYPE', 'CONTENT_LENGTH', 'CONTENT_TYPE', 'GATEWAY_INTERFACE',
+	'HTTPS', 'PATH_INFO', 'PATH_TRANSLATED', 'QUERY_STRING', 'REMOTE_ADDR',
+	'REMOTE_HOST', 'REMOTE_USER', 'REQUEST_METHOD', 'REQUEST_URI',
+	'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
+	'SERVER_SOFTWARE'
+]
+
+##############################################################################
+class CgiOutput(io.RawIOBase):
+	"""A raw output stream that collects a CGI header block, converts it to
+	a WSGI start_response() call, and then passes message body bytes on to
+	the WSGI write() callable.
+	"""
+
+	def __init__(self, start_response):
+		io.RawIOBase.__init__(self)
+		self.start_response = start_response
+		self.fWrite = None
+		self.lHdrBuf = []
+		self.nBytes = 0
+		self.bGone = False
+
+	def writable(self):
+		return True
+
+	def _parseHdrs(self, xHdrs):
+		sStatus = '200 OK'
+		lHdrs = []
+		for xLine in xHdrs.splitlines():
+			xLine = xLine.strip()
+			if len(xLine) == 0:
+				continue
+			i = xLine.find(b':')
+			if i < 1:
+				continue
+
+			# Header values must be latin-1 native strings under WSGI
+			sKey = xLine[:i].strip().decode('latin-1')
+			sVal = xLine[i+1:].strip().decode('latin-1')
+			if sKey.lower() == 'status':
+				sStatus = sVal
+			else:
+				lHdrs.append( (sKey, sVal) )
+		return (sStatus, lHdrs)
+
+	def write(self, xData):
+		xData = bytes(xData)
+		nLen = len(xData)
+		if nLen == 0:
+			return 0
+
+		if self.fWrite == None:
+			self.lHdrBuf.append(xData)
+			xBuf = b''.join(self.lHdrBuf)
+
+			iEnd = xBuf.find(b'\r\n\r\n')
+			nSep = 4
+			iAlt = xBuf.find(b'\n\n')
+			if (iAlt != -1) and ((iEnd == -1) or (iAlt < iEnd)):
+				(iEnd, nSep) = (iAlt, 2)
+
+			if iEnd == -1:
+				self.lHdrBuf = [xBuf]
+				return nLen
+
+			(sStatus, lHdrs) = self._parseHdrs(xBuf[:iEnd])
+			self.fWrite = self.start_response(sStatus, lHdrs)
+			self.lHdrBuf = []
+			xData = xBuf[iEnd + nSep:]
+			if len(xData) == 0:
+				return nLen
+
+		# Once the client is gone, quietly drop anything still buffered
+		if self.bGone:
+			return nLen
+		try:
+			self.fWrite(xData)
+		except Exception:
+			self.bGone = True
+			raise
+		self.nBytes += len(xData)
+		return nLen
+
+	def headersSent(self):
+		return (self.fWrite != None)
+
+	def finish(self):
+		"""Call after the handler returns.  Makes sure that start_response()
+		has been called even if the handler never ended it's header block.
+		"""
+		if self.fWrite != None:
+			return
+
+		xBuf = b''.join(self.lHdrBuf)
+		self.lHdrBuf = []
+		if len(xBuf.strip()) > 0:
+			(sStatus, lHdrs) = self._parseHdrs(xBuf)
+		else:
+			sStatus = '500 Internal Server Error'
+			lHdrs = [('Content-Type', 'text/plain; charset=utf-8')]
+
+		self.fWrite = self.start_response(sStatus, lHdrs)
+
+
+class _Py2Stdout(object):
+	"""Python 2 handlers write byte strings to sys.stdout directly"""
+
+	def __init__(self, raw):
+		self.raw = raw
+
+	def write(self, sData):
+		if isinstance(sData, unicode):
+			sData = sData.encode('utf-8')
+		self.raw.write(sData)
+
+	def flush(self):
+		pass
+
+
+##############################################################################
+class Application(object):
+	"""A WSGI application callable that serves das2 requests from a long
+	lived process.
+
+	dConf - The server configuration dictionary, as read by the getConf()
+	        function in each of the das2 server scripts.  The module path
+	        in dConf must already be on sys.path.
+	"""
+
+	def __init__(self, dConf):
+		self.dConf = dConf
+		self.lock = threading.Lock()
+		self.lEnvSet = []
+
+		# The package init file only loads the site module for browsers, but
+		# in a long lived process there is no client yet, load it here.
+		from . import site
+
+		self.U = sys.modules['das2server.util']
+
+		misc.envPathMunge("PATH", dConf['BIN_PATH'])
+		misc.envPathMunge("LD_LIBRARY_PATH", dConf['LIB_PATH'])
+
+	def _setEnv(self, environ):
+		"""Copy the CGI variables for this request into os.environ and remove
+		any left over from the previous request
+		"""
+		for sKey in self.lEnvSet:
+			if sKey in os.environ:
+				del os.environ[sKey]
+		self.lEnvSet = []
+
+		for sKey in environ:
+			if (sKey not in g_lCgiVars) and not sKey.startswith('HTTP_'):
+				continue
+			sVal = environ[sKey]
+			if not isinstance(sVal, str):
+				continue
+			os.environ[sKey] = sVal
+			self.lEnvSet.append(sKey)
+
+		if 'HTTPS' not in environ and environ.get('wsgi.url_scheme') == 'https':
+			os.environ['HTTPS'] = 'on'
+			self.lEnvSet.append('HTTPS')
+
+		for sKey in ('QUERY_STRING', 'SCRIPT_NAME'):
+			if sKey not in os.environ:
+				os.environ[sKey] = ''
+				self.lEnvSet.append(sKey)
+
+	def __call__(self, environ, start_response):
+		with self.lock:
+			return self._serve(environ, start_response)
+
+	def _serve(self, environ, start_response):
+		rStartTime = time.time()
+		U = self.U
+		dConf = self.dConf
+
+		self._setEnv(environ)
+
+		dFormEnv = {'REQUEST_METHOD': environ.get('REQUEST_METHOD', 'GET'),
+		            'QUERY_STRING': environ.get('QUERY_STRING', '')}
+		for sKey in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+			if sKey in environ:
+				dFormEnv[sKey] = environ[sKey]
+		form = cgi.FieldStorage(fp=environ.get('wsgi.input'), environ=dFormEnv)
+
+		if 'LOG_PATH' in dConf:
+			fLog = webio.DasLogFile(dConf['LOG_PATH'], os.getenv('REMOTE_ADDR'))
+		else:
+			fLog = webio.DasLogFile()
+
+		out = CgiOutput(start_response)
+		if sys.version_info[0] == 2:
+			stdout = _Py2Stdout(out)
+		else:
+			stdout = io.TextIOWrapper(
+				io.BufferedWriter(out), encoding='utf-8', newline='',
+				write_through=True
+			)
+
+		# Only ever send one set of headers, per request now
+		webio.g_bHdrSent = False
+		webio.g_bClientGone = False
+		webio.g_lRespHdrs = []
+		webio.endCapture()
+
+		oldStdout = sys.stdout
+		sys.stdout = stdout
+		try:
+			route.serveReq(U, dConf, fLog, form, rStartTime)
+			sys.stdout.flush()
+		finally:
+			sys.stdout = oldStdout
+			fLog.close()
+
+		out.finish()
+		return []
@@ -395,7 +395,8 @@ lPkg = [
 
 lScripts = [ 'scripts/%s'%s for s in [
 	'das2_srv_arbiter', 'das2_srvcgi_logrdr', 'das2_srvcgi_main',
-	'das2_srv_passwd',  'das2_srv_todo'
+	'das2_srvwsgi_main', 'das2_srv_prefork', 'das2_srv_passwd',
+	'das2_srv_todo', 'das2_srv_cache_evict'
 ]]
 
 lDataFiles = [